@@ -0,0 +1,82 @@
+import asyncio
+import json
+import logging
+import random
+import re
+import time
+
+import aiohttp
+
+from benchmarks.report import Report
+
+bench_marker = re.compile(r'#bench(\d+)')
+
+
+class OperatorFleet:
+    """
+    Simulated operators connected to the router over websockets. Each one records how long user messages took
+    to reach it and answers a share of them, so that the way back to the platforms is exercised as well
+    """
+
+    def __init__(self, ws_url: str, tokens: list[str], report: Report, reply_rate: float = 0.5):
+        self.ws_url = ws_url.rstrip('/')
+        self.tokens = tokens
+        self.report = report
+        self.reply_rate = reply_rate
+        # bench id -> (platform send time, user unique id), filled in by the load generator
+        self.pending: dict[int, tuple[float, str]] = {}
+        # reply id -> operator send time, matched against what the platform stand-ins received
+        self.replies: dict[int, float] = {}
+        self.random = random.Random()
+        self._tasks: list[asyncio.Task] = []
+        self._connected = 0
+
+    async def start(self, session: aiohttp.ClientSession) -> None:
+        self._tasks = [asyncio.create_task(self._operate(session, token)) for token in self.tokens]
+        deadline = time.monotonic() + 10
+        while self._connected < len(self.tokens) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if self._connected < len(self.tokens):
+            logging.warning(f"Only {self._connected} of {len(self.tokens)} operators have connected")
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def _operate(self, session: aiohttp.ClientSession, token: str) -> None:
+        try:
+            async with session.ws_connect(f'{self.ws_url}/ws/{token}') as ws:
+                self._connected += 1
+                async for frame in ws:
+                    if frame.type != aiohttp.WSMsgType.TEXT:
+                        continue
+                    await self._handle(ws, json.loads(frame.data))
+        except aiohttp.ClientError as e:
+            self.report.stage('operator_connect').errors += 1
+            logging.warning(f"Operator websocket failed: {e}")
+
+    async def _handle(self, ws: aiohttp.ClientWebSocketResponse, data: dict) -> None:
+        if not data.get('isFromUser'):
+            return
+        await ws.send_str(json.dumps({'type': 'ack', 'id': data['id']}))
+
+        match = bench_marker.search(data.get('text') or '')
+        if not match:
+            return
+        sent = self.pending.pop(int(match.group(1)), None)
+        if sent is None:
+            return
+
+        sent_at, user_unique_id = sent
+        self.report.stage('user_to_operator').latencies.append(time.time() - sent_at)
+
+        if self.random.random() < self.reply_rate:
+            reply_id = len(self.replies) + 1
+            self.replies[reply_id] = time.time()
+            await ws.send_str(json.dumps({
+                'text': f'Відповідь оператора #reply{reply_id}',
+                'chatId': data['chatId'],
+                'isFromUser': False,
+                'userId': user_unique_id,
+            }))
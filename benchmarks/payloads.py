@@ -0,0 +1,119 @@
+import hashlib
+import hmac
+import itertools
+import json
+import random
+import time
+from dataclasses import dataclass
+from os import environ
+
+from dotenv import load_dotenv
+
+from src.platforms.facebook.model import Model as FacebookModel
+from src.platforms.telegram.model import Model as TelegramModel
+from src.platforms.viber.model import Model as ViberModel
+
+load_dotenv()
+
+platforms = ('telegram', 'viber', 'facebook')
+
+sample_texts = (
+    'Привіт',
+    'Мені потрібна допомога',
+    'Дякую!',
+    'Коли оператор відповість?',
+    'Я не можу заснути вже кілька днів і не знаю, до кого звернутися. Чи можете ви мені допомогти?',
+)
+
+
+@dataclass
+class SignedPayload:
+    platform: str
+    user_unique_id: str
+    body: bytes
+    headers: dict[str, str]
+    # Platform send time in seconds, as the router would see it
+    sent_at: float
+
+
+class PayloadFactory:
+    """
+    Builds webhook bodies through the same pydantic models the router validates them with
+    and signs them the way each platform's is_request_authentic expects
+    """
+
+    def __init__(self, users_per_platform: int = 1000, seed: int | None = None):
+        self.users_per_platform = users_per_platform
+        self.random = random.Random(seed)
+        self.sequence = itertools.count(1)
+
+    def create(self, platform: str, user_index: int | None = None, text: str | None = None) -> SignedPayload:
+        user_index = self.random.randrange(self.users_per_platform) if user_index is None else user_index
+        text = self.random.choice(sample_texts) if text is None else text
+        return getattr(self, f'create_{platform}')(user_index, text)
+
+    def create_random(self) -> SignedPayload:
+        return self.create(self.random.choice(platforms))
+
+    def create_telegram(self, user_index: int, text: str) -> SignedPayload:
+        user_id = 100000000 + user_index
+        now = time.time()
+        model = TelegramModel(
+            update_id=next(self.sequence),
+            message={
+                'message_id': next(self.sequence),
+                'from': {'id': user_id, 'is_bot': False, 'first_name': 'Bench', 'username': f'bench{user_index}', 'language_code': 'uk'},
+                'chat': {'id': user_id, 'first_name': 'Bench', 'username': f'bench{user_index}', 'type': 'private'},
+                'date': int(now),
+                'caption': text,
+            },
+        )
+        body = model.json(by_alias=True, exclude_none=True).encode('utf-8')
+        headers = {
+            'Content-Type': 'application/json',
+            'X-Telegram-Bot-Api-Secret-Token': environ['TELEGRAM_VERIFICATION_TOKEN'],
+        }
+        return SignedPayload('telegram', f'telegram_{user_id}', body, headers, now)
+
+    def create_viber(self, user_index: int, text: str) -> SignedPayload:
+        user_id = f'bench{user_index:08d}viberuser=='
+        now = time.time()
+        model = ViberModel(
+            event='message',
+            timestamp=int(now * 1000),
+            chat_hostname='SN-BENCH_',
+            message_token=next(self.sequence),
+            sender={'id': user_id, 'name': 'Bench', 'avatar': '', 'language': 'uk', 'country': 'UA', 'api_version': 10},
+            message={'type': 'text', 'text': text},
+            silent=False,
+        )
+        body = model.json(exclude_none=True).encode('utf-8')
+        signature = hmac.new(environ['VIBER_TOKEN'].encode('utf-8'), body, hashlib.sha256).hexdigest()
+        headers = {'Content-Type': 'application/json', 'X-Viber-Content-Signature': signature}
+        return SignedPayload('viber', f'viber_{user_id}', body, headers, now)
+
+    def create_facebook(self, user_index: int, text: str) -> SignedPayload:
+        user_id = str(7000000000000000 + user_index)
+        page_id = environ['FACEBOOK_PAGE_ID']
+        now = time.time()
+        model = FacebookModel(
+            object='page',
+            entry=[{
+                'id': page_id,
+                'time': int(now * 1000),
+                'messaging': [{
+                    'sender': {'id': user_id},
+                    'recipient': {'id': page_id},
+                    'timestamp': int(now * 1000),
+                    'message': {'mid': f'm_bench{next(self.sequence)}', 'text': text},
+                }],
+            }],
+        )
+        body = model.json(exclude_none=True).encode('utf-8')
+        signature = hmac.new(environ['FACEBOOK_APP_SECRET'].encode('utf-8'), body, hashlib.sha256).hexdigest()
+        headers = {'Content-Type': 'application/json', 'X-Hub-Signature-256': f'sha256={signature}'}
+        return SignedPayload('facebook', f'facebook_{user_id}', body, headers, now)
+
+
+def decode(payload: SignedPayload) -> dict:
+    return json.loads(payload.body)
@@ -0,0 +1,63 @@
+import json
+import math
+from dataclasses import dataclass, field
+
+
+def percentile(values: list[float], q: float) -> float | None:
+    """
+    A function that returns the nearest-rank percentile
+    :param values: observed values
+    :param q: percentile between 0 and 100
+    :return: the percentile or None if there are no values
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(math.ceil(q / 100 * len(ordered)), 1)
+    return ordered[rank - 1]
+
+
+@dataclass
+class StageStats:
+    latencies: list[float] = field(default_factory=list)
+    errors: int = 0
+
+    def summary(self, duration_seconds: float) -> dict:
+        return {
+            'count': len(self.latencies),
+            'errors': self.errors,
+            'throughput': len(self.latencies) / duration_seconds if duration_seconds else 0.0,
+            'p50_ms': to_ms(percentile(self.latencies, 50)),
+            'p99_ms': to_ms(percentile(self.latencies, 99)),
+            'max_ms': to_ms(max(self.latencies, default=None)),
+        }
+
+
+def to_ms(seconds: float | None) -> float | None:
+    return round(seconds * 1000, 2) if seconds is not None else None
+
+
+class Report:
+    def __init__(self):
+        self.stages: dict[str, StageStats] = {}
+
+    def stage(self, name: str) -> StageStats:
+        return self.stages.setdefault(name, StageStats())
+
+    def summary(self, duration_seconds: float) -> dict:
+        return {name: stats.summary(duration_seconds) for name, stats in self.stages.items()}
+
+    def format(self, duration_seconds: float) -> str:
+        columns = ('count', 'errors', 'throughput', 'p50_ms', 'p99_ms', 'max_ms')
+        lines = [f"{'stage':<32}" + ''.join(f'{column:>12}' for column in columns)]
+        for name, summary in self.summary(duration_seconds).items():
+            cells = ''.join(
+                f'{summary[column]:>12.2f}' if isinstance(summary[column], float) else f'{str(summary[column]):>12}'
+                for column in columns
+            )
+            lines.append(f'{name:<32}{cells}')
+        return '\n'.join(lines)
+
+    def dump(self, path: str, duration_seconds: float, parameters: dict) -> None:
+        with open(path, 'w') as f:
+            json.dump({'parameters': parameters, 'durationSeconds': duration_seconds, 'stages': self.summary(duration_seconds)}, f, indent=2)
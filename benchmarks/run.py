@@ -0,0 +1,134 @@
+"""
+Replays signed Telegram, Viber and Facebook webhooks against a running router at a fixed rate and reports
+p50/p99 latency, throughput and errors for every stage of a message's way through it.
+
+The router has to be started with its platform API urls pointing at the stand-ins started here, e.g.
+    TELEGRAM_API_URL=http://127.0.0.1:8081 VIBER_API_URL=http://127.0.0.1:8081 FACEBOOK_GRAPH_URL=http://127.0.0.1:8081
+and operator tokens have to be valid session tokens of personnel in its db.
+
+    python -m benchmarks.run --target http://127.0.0.1:8000 --rate 50 --duration 60 --operator-token <token>
+"""
+import argparse
+import asyncio
+import logging
+import re
+import time
+from os import environ
+
+import aiohttp
+from dotenv import load_dotenv
+
+from benchmarks import standins
+from benchmarks.operators import OperatorFleet
+from benchmarks.payloads import PayloadFactory, platforms
+from benchmarks.report import Report
+
+load_dotenv()
+
+reply_marker = re.compile(r'#reply(\d+)')
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--target', default='http://127.0.0.1:8000', help='base url of the router')
+    parser.add_argument('--webhook-path', default=environ.get('WEBHOOK_PATH', '/webhook'))
+    parser.add_argument('--rate', type=float, default=20, help='webhooks per second')
+    parser.add_argument('--duration', type=float, default=30, help='seconds to generate load for')
+    parser.add_argument('--drain', type=float, default=5, help='seconds to wait for in-flight messages afterwards')
+    parser.add_argument('--users', type=int, default=1000, help='distinct users per platform')
+    parser.add_argument('--platforms', default=','.join(platforms))
+    parser.add_argument('--operator-token', action='append', default=[], help='personnel session token, repeatable')
+    parser.add_argument('--reply-rate', type=float, default=0.5, help='share of user messages operators answer')
+    parser.add_argument('--standin-host', default='127.0.0.1')
+    parser.add_argument('--standin-port', type=int, default=8081)
+    parser.add_argument('--standin-latency', type=float, default=0.0, help='seconds every platform API call takes')
+    parser.add_argument('--standin-failure-rate', type=float, default=0.0, help='share of failing platform API calls')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--json', help='also write the report to this file')
+    return parser.parse_args()
+
+
+async def send_webhook(session: aiohttp.ClientSession, url: str, payload, report: Report) -> None:
+    stage = report.stage(f'webhook_{payload.platform}')
+    started_at = time.perf_counter()
+    try:
+        async with session.post(url, data=payload.body, headers=payload.headers) as resp:
+            body = await resp.json(content_type=None)
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+        stage.errors += 1
+        return
+    elapsed = time.perf_counter() - started_at
+
+    # Rejected events are answered with a serialized HTTPException rather than an error status
+    if resp.status != 200 or (isinstance(body, dict) and body.get('status_code', 200) != 200):
+        stage.errors += 1
+        return
+    stage.latencies.append(elapsed)
+
+
+async def run(args: argparse.Namespace) -> tuple[Report, standins.StandInState, float]:
+    report = Report()
+    state = standins.StandInState()
+    runner = await standins.start(
+        state, args.standin_host, args.standin_port,
+        latency_seconds=args.standin_latency, failure_rate=args.standin_failure_rate
+    )
+
+    factory = PayloadFactory(args.users, args.seed)
+    enabled_platforms = [platform for platform in args.platforms.split(',') if platform]
+    webhook_url = args.target.rstrip('/') + args.webhook_path
+    fleet = OperatorFleet(re.sub(r'^http', 'ws', args.target), args.operator_token, report, args.reply_rate)
+
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0)) as session:
+        await fleet.start(session)
+
+        tasks = []
+        started_at = time.monotonic()
+        total = int(args.rate * args.duration)
+        for i in range(total):
+            # Open loop: requests are sent on schedule no matter how slow the router is
+            delay = started_at + i / args.rate - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            bench_id = i + 1
+            platform = enabled_platforms[i % len(enabled_platforms)]
+            payload = factory.create(platform, text=f'{factory.random.choice(("Привіт", "Допоможіть"))} #bench{bench_id}')
+            fleet.pending[bench_id] = (payload.sent_at, payload.user_unique_id)
+            tasks.append(asyncio.create_task(send_webhook(session, webhook_url, payload, report)))
+
+        await asyncio.gather(*tasks)
+        load_seconds = time.monotonic() - started_at
+        await asyncio.sleep(args.drain)
+        await fleet.stop()
+
+    await runner.cleanup()
+
+    if args.operator_token:
+        report.stage('user_to_operator').errors += len(fleet.pending)
+
+    delivered = set()
+    for message in state.messages:
+        match = reply_marker.search(message.text)
+        if match and int(match.group(1)) in fleet.replies:
+            reply_id = int(match.group(1))
+            delivered.add(reply_id)
+            report.stage(f'operator_to_{message.platform}').latencies.append(message.received_at - fleet.replies[reply_id])
+    if fleet.replies:
+        report.stage('operator_to_platform_lost').errors += len(set(fleet.replies) - delivered)
+
+    return report, state, load_seconds
+
+
+def main() -> None:
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    args = parse_args()
+    report, state, load_seconds = asyncio.run(run(args))
+    print(report.format(load_seconds))
+    print(f"Platform API calls received by stand-ins: {dict(state.requests)}")
+    if args.json:
+        report.dump(args.json, load_seconds, vars(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+import asyncio
+import json
+import time
+from collections import defaultdict
+from dataclasses import dataclass, field
+from urllib.parse import parse_qs
+
+from aiohttp import web
+
+
+@dataclass
+class ReceivedMessage:
+    platform: str
+    chat_id: str
+    text: str
+    received_at: float
+
+
+@dataclass
+class StandInState:
+    messages: list[ReceivedMessage] = field(default_factory=list)
+    requests: dict[str, int] = field(default_factory=lambda: defaultdict(int))
+    # Telegram updates waiting for getUpdates, until it is called with an offset past them
+    updates: list[dict] = field(default_factory=list)
+    update_offsets: list[int] = field(default_factory=list)
+    next_update_id: int = 1
+
+    def record(self, platform: str, chat_id, text: str) -> None:
+        self.messages.append(ReceivedMessage(platform, str(chat_id), text, time.time()))
+        self.requests[platform] += 1
+
+    def push_update(self, update: dict) -> int:
+        update = {**update, 'update_id': self.next_update_id}
+        self.next_update_id += 1
+        self.updates.append(update)
+        return update['update_id']
+
+
+def create_app(state: StandInState, latency_seconds: float = 0.0, failure_rate: float = 0.0) -> web.Application:
+    """
+    A function that creates a local stand-in for the Telegram Bot API, the Viber REST API and the Facebook Graph API,
+    which records every message the router sends and answers the way the real API does
+    :param state: where received messages are recorded
+    :param latency_seconds: artificial delay of every response
+    :param failure_rate: share of send requests answered with a 500
+    :return: an aiohttp application
+    """
+    failures = {'counter': 0.0}
+
+    def fail() -> bool:
+        failures['counter'] += failure_rate
+        if failures['counter'] >= 1:
+            failures['counter'] -= 1
+            return True
+        return False
+
+    async def delay() -> bool:
+        if latency_seconds:
+            await asyncio.sleep(latency_seconds)
+        return fail()
+
+    async def telegram_send_message(request: web.Request) -> web.Response:
+        body = await request.json()
+        if await delay():
+            return web.json_response({'ok': False, 'error_code': 500}, status=500)
+        state.record('telegram', body['chat_id'], body['text'])
+        return web.json_response({'ok': True, 'result': {'message_id': len(state.messages), 'date': int(time.time())}})
+
+    async def telegram_get_file(request: web.Request) -> web.Response:
+        file_id = request.query.get('file_id', 'file')
+        return web.json_response({'ok': True, 'result': {'file_id': file_id, 'file_path': f'photos/{file_id}.jpg'}})
+
+    async def telegram_get_updates(request: web.Request) -> web.Response:
+        params = await request.json() if request.can_read_body else dict(request.query)
+        if params.get('offset') is not None:
+            offset = int(params['offset'])
+            state.update_offsets.append(offset)
+            state.updates = [update for update in state.updates if update['update_id'] >= offset]
+
+        deadline = time.monotonic() + float(params.get('timeout', 0))
+        while not state.updates and time.monotonic() < deadline:
+            await asyncio.sleep(0.01)
+        return web.json_response({'ok': True, 'result': state.updates[:int(params.get('limit', 100))]})
+
+    async def telegram_ok(request: web.Request) -> web.Response:
+        return web.json_response({'ok': True, 'result': True})
+
+    async def viber_send_message(request: web.Request) -> web.Response:
+        body = await request.json()
+        if await delay():
+            return web.json_response({'status': 2, 'status_message': 'internal error'}, status=500)
+        state.record('viber', body['receiver'], body['text'])
+        return web.json_response({'status': 0, 'status_message': 'ok', 'message_token': len(state.messages)})
+
+    async def viber_ok(request: web.Request) -> web.Response:
+        return web.json_response({'status': 0, 'status_message': 'ok'})
+
+    async def facebook_send_message(request: web.Request) -> web.Response:
+        body = await request.json()
+        if await delay():
+            return web.json_response({'error': {'message': 'internal error', 'code': 2}}, status=500)
+        state.record('facebook', body['recipient']['id'], body['message']['text'])
+        return web.json_response({'recipient_id': body['recipient']['id'], 'message_id': f'm_{len(state.messages)}'})
+
+    async def facebook_batch(request: web.Request) -> web.Response:
+        form = await request.post()
+        if latency_seconds:
+            await asyncio.sleep(latency_seconds)
+        results = []
+        for item in json.loads(form['batch']):
+            if fail():
+                results.append({'code': 500, 'headers': [], 'body': json.dumps({'error': {'message': 'internal error', 'code': 2}})})
+                continue
+            body = {key: json.loads(values[0]) if key != 'messaging_type' else values[0]
+                    for key, values in parse_qs(item['body']).items()}
+            state.record('facebook', body['recipient']['id'], body['message']['text'])
+            results.append({'code': 200, 'headers': [], 'body': json.dumps(
+                {'recipient_id': body['recipient']['id'], 'message_id': f'm_{len(state.messages)}'}
+            )})
+        return web.json_response(results)
+
+    async def facebook_ok(request: web.Request) -> web.Response:
+        return web.json_response({'success': True})
+
+    app = web.Application()
+    app.add_routes([
+        web.post('/bot{token}/sendMessage', telegram_send_message),
+        web.get('/bot{token}/getFile', telegram_get_file),
+        web.post('/bot{token}/setWebhook', telegram_ok),
+        web.post('/bot{token}/deleteWebhook', telegram_ok),
+        web.route('*', '/bot{token}/getUpdates', telegram_get_updates),
+        web.post('/pa/send_message', viber_send_message),
+        web.post('/pa/set_webhook', viber_ok),
+        web.post('/v{version}/me/subscribed_apps', facebook_ok),
+        web.post('/v{version}/{page_id}/messages', facebook_send_message),
+        web.post('/v{version}/', facebook_batch),
+    ])
+    return app
+
+
+async def start(state: StandInState, host: str = '127.0.0.1', port: int = 8081, **kwargs) -> web.AppRunner:
+    runner = web.AppRunner(create_app(state, **kwargs))
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
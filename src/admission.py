@@ -0,0 +1,226 @@
+import asyncio
+import base64
+import fcntl
+import json
+import os
+import time
+import uuid
+from contextlib import asynccontextmanager
+from os import environ
+
+from dotenv import load_dotenv
+from starlette.requests import Request
+
+from src.metrics import counter, gauge, histogram
+
+load_dotenv()
+
+webhook_max_concurrency = int(environ.get("WEBHOOK_MAX_CONCURRENCY", 50))
+webhook_max_queue = int(environ.get("WEBHOOK_MAX_QUEUE", 200))
+webhook_queue_timeout_seconds = float(environ.get("WEBHOOK_QUEUE_TIMEOUT_SECONDS", 2))
+# Share of webhook_max_concurrency after which sheddable events are dropped instead of processed
+webhook_shed_threshold = float(environ.get("WEBHOOK_SHED_THRESHOLD", 0.8))
+webhook_retry_after_seconds = int(environ.get("WEBHOOK_RETRY_AFTER_SECONDS", 5))
+# Empty disables spilling, rejected webhooks are then left to the platforms to retry
+webhook_spill_path = environ.get("WEBHOOK_SPILL_PATH", "")
+webhook_spill_replay_interval_seconds = float(environ.get("WEBHOOK_SPILL_REPLAY_INTERVAL_SECONDS", 5))
+webhook_spill_replay_batch_size = int(environ.get("WEBHOOK_SPILL_REPLAY_BATCH_SIZE", 50))
+# Webhooks past this many are turned away with a 503 instead of spilled, so that a flood can't fill the disk. 0 is unlimited
+webhook_spill_max_files = int(environ.get("WEBHOOK_SPILL_MAX_FILES", 100000))
+
+admission_decisions = counter('webhook_admission_total', 'Webhook admission decisions', ['outcome'])
+queue_wait_seconds = histogram('webhook_queue_wait_seconds', 'Time webhooks waited for a processing slot')
+waiting_webhooks = gauge('webhooks_waiting', 'Webhooks waiting for a processing slot')
+spilled_webhooks = gauge('webhooks_spilled', 'Webhooks waiting in the spill directory to be replayed')
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, reason: str):
+        super().__init__(f"Webhook rejected: {reason}")
+        self.reason = reason
+
+
+class AdmissionController:
+    """
+    Limits how many webhooks are processed at once and how long and how many of them may wait for a slot,
+    so that a slow database makes the router reject excess load instead of piling it up
+    """
+
+    def __init__(self, max_concurrency: int, max_queue: int, queue_timeout: float, shed_threshold: float):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.shed_limit = max(int(max_concurrency * shed_threshold), 1)
+        self.in_flight = 0
+        self.waiting = 0
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+
+    def has_spare_capacity(self) -> bool:
+        return not self.waiting and self.in_flight < self.shed_limit
+
+    async def acquire(self, sheddable: bool = False) -> None:
+        """
+        A method that waits for a processing slot
+        :param sheddable: if True, the webhook is rejected as soon as the router is busy rather than overloaded
+        :return: None
+        :raises AdmissionRejected: if there is no slot for the webhook
+        """
+        if sheddable and not self.has_spare_capacity():
+            raise AdmissionRejected('shed')
+        if self.waiting >= self.max_queue:
+            raise AdmissionRejected('queue_full')
+
+        self.waiting += 1
+        waiting_webhooks.set(self.waiting)
+        started_at = time.perf_counter()
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            raise AdmissionRejected('queue_timeout')
+        finally:
+            self.waiting -= 1
+            waiting_webhooks.set(self.waiting)
+            queue_wait_seconds.observe(time.perf_counter() - started_at)
+        self.in_flight += 1
+
+    def release(self) -> None:
+        self.in_flight -= 1
+        self._semaphore.release()
+
+    @asynccontextmanager
+    async def admit(self, sheddable: bool = False):
+        try:
+            await self.acquire(sheddable)
+        except AdmissionRejected as e:
+            admission_decisions.inc(outcome=e.reason)
+            raise
+        admission_decisions.inc(outcome='admitted')
+        try:
+            yield
+        finally:
+            self.release()
+
+
+class SpillQueue:
+    """
+    Durable queue of webhooks that have been rejected under load, one file per webhook.
+    Files are written to a temporary name and renamed, so a crash never leaves a partial webhook behind.
+    Every worker replays from the same directory, a webhook is replayed by whoever holds the lock on its file.
+    Locks go away with the process that holds them, so webhooks of a crashed worker are picked up by others
+    """
+
+    def __init__(self, path: str, max_files: int = 0):
+        self.path = path
+        self.max_files = max_files
+        os.makedirs(path, exist_ok=True)
+        # name -> file descriptor that holds the lock on a webhook this worker is replaying
+        self._claims: dict[str, int] = {}
+        # Other workers spill and replay too, so this is only recounted once it seems to have reached max_files
+        self._count = len(self)
+        spilled_webhooks.set(self._count)
+
+    def is_full(self) -> bool:
+        if not self.max_files or self._count < self.max_files:
+            return False
+        self._count = len(self)
+        return self._count >= self.max_files
+
+    def put(self, body: bytes, headers: dict[str, str]) -> str | None:
+        """
+        A method that durably stores a webhook to be replayed later
+        :param body: a raw request body
+        :param headers: request headers
+        :return: a name of the spilled webhook or None if the queue is full
+        """
+        if self.is_full():
+            return None
+        name = f"{time.time_ns()}-{uuid.uuid4().hex}.json"
+        temporary_path = os.path.join(self.path, name + '.tmp')
+        with open(temporary_path, 'w') as f:
+            # Body is kept byte for byte, platform signatures are computed over it
+            json.dump({'headers': headers, 'body': base64.b64encode(body).decode('ascii')}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary_path, os.path.join(self.path, name))
+        self._count += 1
+        spilled_webhooks.inc()
+        return name
+
+    def pending(self, limit: int) -> list[str]:
+        return sorted(name for name in os.listdir(self.path) if name.endswith('.json'))[:limit]
+
+    def claim(self, name: str) -> tuple[bytes, dict[str, str]] | None:
+        """
+        A method that locks a spilled webhook for this worker and reads it.
+        The lock is held until the webhook is removed, failed or released
+        :param name: a name returned by pending
+        :return: (body, headers) or None if another worker is replaying or has already replayed it
+        """
+        path = os.path.join(self.path, name)
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except FileNotFoundError:
+            return None
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            # It may have been removed by the previous holder of the lock after it has been opened
+            if os.fstat(fd).st_ino != os.stat(path).st_ino:
+                raise FileNotFoundError(path)
+            with os.fdopen(os.dup(fd)) as f:
+                data = json.load(f)
+        except (BlockingIOError, FileNotFoundError):
+            os.close(fd)
+            return None
+        except Exception:
+            os.close(fd)
+            raise
+
+        self._claims[name] = fd
+        return base64.b64decode(data['body']), data['headers']
+
+    def release(self, name: str) -> None:
+        fd = self._claims.pop(name, None)
+        if fd is not None:
+            os.close(fd)
+
+    def remove(self, name: str) -> None:
+        os.remove(os.path.join(self.path, name))
+        self.release(name)
+        self._count -= 1
+        spilled_webhooks.dec()
+
+    def __len__(self) -> int:
+        return sum(1 for name in os.listdir(self.path) if name.endswith('.json'))
+
+    def fail(self, name: str) -> None:
+        # Kept for inspection, but never replayed again
+        os.replace(os.path.join(self.path, name), os.path.join(self.path, name + '.failed'))
+        self.release(name)
+        self._count -= 1
+        spilled_webhooks.dec()
+
+
+def as_request(body: bytes, headers: dict[str, str], path: str) -> Request:
+    """
+    A function that rebuilds a webhook request from a spilled one
+    :param body: a raw request body
+    :param headers: request headers
+    :param path: the webhook path
+    :return: a request object
+    """
+    async def receive():
+        return {'type': 'http.request', 'body': body, 'more_body': False}
+
+    scope = {
+        'type': 'http',
+        'method': 'POST',
+        'path': path,
+        'headers': [(key.lower().encode('latin-1'), value.encode('latin-1')) for key, value in headers.items()],
+    }
+    return Request(scope, receive)
+
+
+webhook_admission = AdmissionController(
+    webhook_max_concurrency, webhook_max_queue, webhook_queue_timeout_seconds, webhook_shed_threshold
+)
+spill_queue = SpillQueue(webhook_spill_path, webhook_spill_max_files) if webhook_spill_path else None
@@ -1,35 +1,303 @@
+import asyncio
+import contextvars
+import logging
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+import requests
+from dotenv import load_dotenv
+from urllib3.exceptions import NewConnectionError
 from pydantic import BaseModel
 from typing import Union, List
 
 from src.util import AbcNoPublicConstructor
 from src.attachment import Attachment
+from src.background import PeriodicTask
+from src.breaker import BreakerState, CircuitBreaker, create_breaker
+from src.metrics import counter, gauge
+from src.tracing import traced
 
 from abc import abstractmethod
 from fastapi import Request
 from os import environ
 
-from src.platforms.viber.api import send_message as sm1
-from src.platforms.facebook.api import send_message as sm2
-from src.platforms.telegram.api import send_message as sm3
+from src.platforms.viber import api as viber_api
+from src.platforms.facebook import api as facebook_api
+from src.platforms.telegram import api as telegram_api
+
+load_dotenv()
 
-platform_sm = {
-    'viber': sm1,
-    'facebook': sm2,
-    'telegram': sm3
+platform_apis = {
+    'viber': viber_api,
+    'facebook': facebook_api,
+    'telegram': telegram_api,
 }
+platform_sm = {platform: api.send_message for platform, api in platform_apis.items()}
+
+# Every platform gets its own threads, so that a hung platform can't take the others' ones
+platform_send_concurrency = int(environ.get("PLATFORM_SEND_CONCURRENCY", 8))
+parked_messages_max = int(environ.get("PARKED_MESSAGES_MAX", 10000))
+parked_message_max_attempts = int(environ.get("PARKED_MESSAGE_MAX_ATTEMPTS", 5))
+parked_messages_retry_interval_seconds = float(environ.get("PARKED_MESSAGES_RETRY_INTERVAL_SECONDS", 5))
+
+send_failures = counter('platform_send_failures_total', 'Failed platform API calls', ['platform', 'reason'])
+parked_messages_gauge = gauge('platform_parked_messages', 'Messages waiting for a platform API to recover', ['platform'])
+dropped_parked_messages = counter('platform_parked_messages_dropped_total', 'Parked messages that have been given up on', ['platform', 'reason'])
+
+
+class ParkedMessages:
+    """
+    Messages that couldn't be sent because a platform API is down, kept in memory to be retried in order
+    """
+
+    def __init__(self, platform: str, max_size: int):
+        self.platform = platform
+        self.max_size = max_size
+        # (unique chat id, text, attempts)
+        self._messages: deque[tuple[str, str, int]] = deque()
+        # Set while taken messages are being retried, as they are no longer in the queue
+        self._draining = False
+        self._lock = Lock()
+        parked_messages_gauge.set_function(lambda: len(self._messages), platform=platform)
+
+    def park(self, unique_chat_id: str, text: str, attempts: int) -> None:
+        with self._lock:
+            self._append(unique_chat_id, text, attempts)
+
+    def park_behind(self, unique_chat_id: str, text: str) -> bool:
+        """
+        A method that parks a new message if older messages are still parked or being retried,
+        so that it doesn't overtake them
+        :param unique_chat_id: a chat id prefixed with a platform name
+        :param text: a text to send
+        :return: True if the message has been parked, False if it may be sent right away
+        """
+        with self._lock:
+            if not self._messages and not self._draining:
+                return False
+            self._append(unique_chat_id, text, 0)
+            return True
+
+    def _append(self, unique_chat_id: str, text: str, attempts: int) -> None:
+        if len(self._messages) >= self.max_size:
+            self._messages.popleft()
+            dropped_parked_messages.inc(platform=self.platform, reason='overflow')
+        self._messages.append((unique_chat_id, text, attempts))
+
+    def restore(self, messages: list[tuple[str, str, int]]) -> None:
+        """
+        A method that puts messages that have been taken but not sent back in front of the queue,
+        ahead of messages that have been parked in the meantime
+        :param messages: messages in their original order
+        :return: None
+        """
+        with self._lock:
+            self._messages.extendleft(reversed(messages))
+            while len(self._messages) > self.max_size:
+                self._messages.popleft()
+                dropped_parked_messages.inc(platform=self.platform, reason='overflow')
+
+    def take(self) -> list[tuple[str, str, int]]:
+        """
+        A method that takes all parked messages to be retried. New messages are parked behind them until finish is called
+        :return: messages in their original order
+        """
+        with self._lock:
+            messages, self._messages = list(self._messages), deque()
+            self._draining = bool(messages)
+        return messages
+
+    def finish(self) -> None:
+        with self._lock:
+            self._draining = False
+
+    def __len__(self) -> int:
+        return len(self._messages)
+
+
+class DeliveryUnknownError(Exception):
+    """
+    A platform API call failed after the request might have reached the platform, e.g. on a read timeout.
+    Such messages aren't sent again, as the user may already have them
+    """
+
+
+breakers: dict[str, CircuitBreaker] = {platform: create_breaker(platform) for platform in platform_apis}
+parked_messages: dict[str, ParkedMessages] = {platform: ParkedMessages(platform, parked_messages_max) for platform in platform_apis}
+executors: dict[str, ThreadPoolExecutor] = {
+    platform: ThreadPoolExecutor(platform_send_concurrency, thread_name_prefix=f'send-{platform}') for platform in platform_apis
+}
+
+
+def is_breaker_failure(resp: requests.Response) -> bool:
+    # Other errors, e.g. a user who has blocked the bot, say nothing about the health of the API
+    return resp.status_code >= 500 or resp.status_code == 429
+
+
+def is_delivered(platform: str, resp: requests.Response) -> bool:
+    try:
+        return platform_apis[platform].is_delivered(resp)
+    except ValueError:
+        return False
+
+
+def get_retry_after(resp: requests.Response) -> float | None:
+    """
+    A function that reads how long a rate limited platform asked to wait
+    :param resp: a 429 response
+    :return: seconds to wait or None if the platform didn't say
+    """
+    try:
+        return float(resp.headers['Retry-After'])
+    except (KeyError, ValueError):
+        pass
+    # Telegram tells it in the body instead
+    try:
+        return float(resp.json()['parameters']['retry_after'])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def is_safe_to_retry(e: requests.RequestException) -> bool:
+    # Only errors of establishing a connection guarantee that the platform has never seen the request
+    if isinstance(e, requests.ConnectTimeout):
+        return True
+    reason = getattr(e.args[0], 'reason', None) if e.args else None
+    return isinstance(e, requests.ConnectionError) and isinstance(reason, NewConnectionError)
 
 
-def send_message(unique_chat_id: str, text: str):
+def call_platform(platform: str, chat_id: str, text: str, breaker: CircuitBreaker | None = None,
+                  **options) -> requests.Response | None:
     """
-    A function that sends a message to a user
+    A function that calls a platform API and reports the outcome to its circuit breaker
+    :param platform: a platform name
+    :param chat_id: a chat id without the platform prefix
+    :param text: a text to send
+    :param breaker: a circuit breaker to report to instead of the platform's live chat one
+    :param options: platform specific options of the send function
+    :return: a platform API response or None if the API is unavailable and the message can be sent again
+    :raises DeliveryUnknownError: if the platform might have accepted the message
+    """
+    breaker = breaker or breakers[platform]
+    started_at = time.perf_counter()
+    try:
+        resp = platform_sm[platform](chat_id, text, timeout=breaker.timeout(), **options)
+    except requests.RequestException as e:
+        breaker.record_failure()
+        send_failures.inc(platform=platform, reason=type(e).__name__)
+        logging.warning(f"Unable to reach {platform}: {e}")
+        if not is_safe_to_retry(e):
+            raise DeliveryUnknownError(f"{platform} might have accepted the message: {e}") from e
+        return None
+
+    if is_breaker_failure(resp):
+        breaker.record_failure(retry_after=get_retry_after(resp) if resp.status_code == 429 else None)
+        send_failures.inc(platform=platform, reason=f'http_{resp.status_code}')
+        return None
+    breaker.record_success(time.perf_counter() - started_at)
+    if not is_delivered(platform, resp):
+        send_failures.inc(platform=platform, reason='rejected')
+    return resp
+
+
+@traced("send_message")
+def send_message(unique_chat_id: str, text: str, attempts: int = 0):
+    """
+    A function that sends a message to a user. If the platform API is down, the message is parked and retried later
     :param unique_chat_id: a chat id prefixed with a platform name (e.g. 'viber_1234567890')
     :param text: a text to send
-    :return: None
+    :param attempts: how many times sending the message has already failed
+    :return: a platform API response or None if the message has been parked or given up on
     """
     platform, chat_id = unique_chat_id.split('_')
 
     if platform not in platform_sm:
         raise ValueError(f"Platform {platform} is not supported")
 
-    print(f"Sending message to {unique_chat_id} via {platform}")
-    platform_sm[platform](chat_id, text)
+    # Only retry_parked_messages probes a platform that is down, so that new messages never overtake parked ones
+    if breakers[platform].state is not BreakerState.Closed:
+        send_failures.inc(platform=platform, reason='circuit_open')
+        parked_messages[platform].park(unique_chat_id, text, attempts)
+        return None
+    if parked_messages[platform].park_behind(unique_chat_id, text):
+        return None
+
+    try:
+        resp = call_platform(platform, chat_id, text)
+    except DeliveryUnknownError as e:
+        dropped_parked_messages.inc(platform=platform, reason='unknown_outcome')
+        logging.error(f"Not retrying a message to {unique_chat_id}: {e}")
+        return None
+    if resp is None:
+        if attempts + 1 < parked_message_max_attempts:
+            parked_messages[platform].park(unique_chat_id, text, attempts + 1)
+        else:
+            dropped_parked_messages.inc(platform=platform, reason='attempts')
+            logging.error(f"Gave up on a message to {unique_chat_id} after {attempts + 1} attempts")
+    return resp
+
+
+async def run_in_platform_executor(platform: str, func, *args):
+    """
+    A function that runs a blocking function that talks to a platform API in the platform's own thread pool
+    :param platform: a platform name
+    :param func: a blocking function
+    :param args: arguments of the function
+    :return: whatever the function returns
+    """
+    executor = executors.get(platform)
+    if executor is None:
+        raise ValueError(f"Platform {platform} is not supported")
+
+    # Keeps the current trace, like asyncio.to_thread does
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(executor, context.run, func, *args)
+
+
+async def send_message_async(unique_chat_id: str, text: str):
+    """
+    A function that sends a message without blocking the event loop
+    :param unique_chat_id: a chat id prefixed with a platform name (e.g. 'viber_1234567890')
+    :param text: a text to send
+    :return: a platform API response or None if the message has been parked
+    """
+    return await run_in_platform_executor(unique_chat_id.split('_')[0], send_message, unique_chat_id, text)
+
+
+def retry_parked_messages() -> int:
+    """
+    A function that retries parked messages in order, platform by platform, until a platform fails again
+    :return: number of messages that have been sent
+    """
+    sent = 0
+    for platform, parked in parked_messages.items():
+        messages = parked.take()
+        try:
+            for i, (unique_chat_id, text, attempts) in enumerate(messages):
+                if not breakers[platform].allow():
+                    parked.restore(messages[i:])
+                    break
+                try:
+                    resp = call_platform(platform, unique_chat_id.split('_')[1], text)
+                except DeliveryUnknownError as e:
+                    dropped_parked_messages.inc(platform=platform, reason='unknown_outcome')
+                    logging.error(f"Not retrying a message to {unique_chat_id}: {e}")
+                    continue
+                if resp is None:
+                    # Messages parked by live sends in the meantime are newer, so the rest goes back in front of them
+                    if attempts + 1 < parked_message_max_attempts:
+                        parked.restore([(unique_chat_id, text, attempts + 1)] + messages[i + 1:])
+                    else:
+                        dropped_parked_messages.inc(platform=platform, reason='attempts')
+                        logging.error(f"Gave up on a message to {unique_chat_id} after {attempts + 1} attempts")
+                        parked.restore(messages[i + 1:])
+                    break
+                sent += 1
+        finally:
+            parked.finish()
+    return sent
+
+
+parked_messages_task = PeriodicTask("parked-messages", parked_messages_retry_interval_seconds, retry_parked_messages)
@@ -0,0 +1,52 @@
+import logging
+import time
+from os import environ
+
+from dotenv import load_dotenv
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+from src.background import PeriodicTask
+from src.db.engine import Session
+from src.db.queries import archive_idle_chats
+
+load_dotenv()
+
+archiver_enabled = environ.get("ARCHIVER_ENABLED", "true").lower() == "true"
+archiver_idle_seconds = int(environ.get("ARCHIVER_IDLE_MINUTES", 24 * 60)) * 60
+archiver_interval_seconds = float(environ.get("ARCHIVER_INTERVAL_SECONDS", 300))
+archiver_batch_size = int(environ.get("ARCHIVER_BATCH_SIZE", 100))
+archiver_batch_pause_seconds = float(environ.get("ARCHIVER_BATCH_PAUSE_SECONDS", 1))
+archiver_lock_timeout_ms = int(environ.get("ARCHIVER_LOCK_TIMEOUT_MS", 1000))
+
+
+def archive_idle_chats_pass() -> tuple[int, int]:
+    """
+    A function that archives idle chats batch by batch until none are left.
+    Batches are separated by a pause and give up on locks quickly, so that the webhook path is never held up
+    :return: (number of archived chats, number of archived messages)
+    """
+    started_at = time.perf_counter()
+    total_chats, total_messages = 0, 0
+
+    while True:
+        try:
+            with Session() as session:
+                session.execute(text(f"SET LOCAL lock_timeout = {archiver_lock_timeout_ms}"))
+                chats, messages = archive_idle_chats(session, archiver_idle_seconds, archiver_batch_size)
+        except OperationalError as e:
+            logging.warning(f"Archiver pass interrupted: {e}")
+            break
+
+        total_chats += chats
+        total_messages += messages
+        if chats < archiver_batch_size:
+            break
+        time.sleep(archiver_batch_pause_seconds)
+
+    elapsed = time.perf_counter() - started_at
+    logging.info(f"Archived {total_chats} chats and {total_messages} messages in {elapsed:.3f}s")
+    return total_chats, total_messages
+
+
+archiver_task = PeriodicTask("archiver", archiver_interval_seconds, archive_idle_chats_pass)
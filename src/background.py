@@ -0,0 +1,42 @@
+import asyncio
+import inspect
+import logging
+from typing import Any, Callable
+
+
+class PeriodicTask:
+    """
+    Runs a blocking function in a worker thread every `interval` seconds, so that it never blocks the event loop.
+    Coroutine functions are awaited on the event loop instead
+    """
+
+    def __init__(self, name: str, interval: float, func: Callable[[], Any]):
+        self.name = name
+        self.interval = interval
+        self.func = func
+        self._task: asyncio.Task | None = None
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(), name=self.name)
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                if inspect.iscoroutinefunction(self.func):
+                    await self.func()
+                else:
+                    await asyncio.to_thread(self.func)
+            except Exception as e:
+                logging.error(f"Background task {self.name} failed: {e}")
+            await asyncio.sleep(self.interval)
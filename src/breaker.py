@@ -0,0 +1,141 @@
+import time
+from collections import deque
+from enum import Enum
+from os import environ
+from threading import Lock
+
+from dotenv import load_dotenv
+
+from src.metrics import counter, gauge
+
+load_dotenv()
+
+breaker_failure_threshold = int(environ.get("PLATFORM_BREAKER_FAILURE_THRESHOLD", 5))
+breaker_reset_seconds = float(environ.get("PLATFORM_BREAKER_RESET_SECONDS", 30))
+platform_min_timeout_seconds = float(environ.get("PLATFORM_MIN_TIMEOUT_SECONDS", 1))
+platform_max_timeout_seconds = float(environ.get("PLATFORM_MAX_TIMEOUT_SECONDS", 10))
+# Timeout is this many times the p99 latency of recent successful calls
+platform_timeout_multiplier = float(environ.get("PLATFORM_TIMEOUT_MULTIPLIER", 3))
+
+breaker_state = gauge('platform_breaker_state', 'Platform circuit breaker state: 0 closed, 1 half-open, 2 open', ['platform'])
+breaker_timeout_seconds = gauge('platform_send_timeout_seconds', 'Current adaptive timeout of platform API calls', ['platform'])
+breaker_transitions = counter('platform_breaker_transitions_total', 'Platform circuit breaker state changes', ['platform', 'state'])
+
+
+class BreakerState(Enum):
+    Closed = 0
+    HalfOpen = 1
+    Open = 2
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    """
+    Stops calling a platform API after failure_threshold failures in a row. After reset_seconds a single probe
+    is let through, which either closes the breaker or keeps it open for another reset_seconds.
+    A breaker that honors retry_after opens on the first rate limited call for as long as the platform asked.
+    Timeouts follow the latency of recent successful calls, so a slowing API is cut off early
+    """
+
+    latency_window = 200
+    min_latency_samples = 20
+
+    def __init__(self, name: str, failure_threshold: int, reset_seconds: float,
+                 min_timeout: float, max_timeout: float, timeout_multiplier: float, honors_retry_after: bool = False):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.honors_retry_after = honors_retry_after
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.timeout_multiplier = timeout_multiplier
+        self.state = BreakerState.Closed
+        self.failures = 0
+        self.opened_at = 0.0
+        # How long the breaker stays open this time, reset_seconds unless the platform asked for another delay
+        self.open_seconds = reset_seconds
+        self._probe_in_flight = False
+        self._latencies: deque[float] = deque(maxlen=self.latency_window)
+        self._lock = Lock()
+        breaker_state.set_function(lambda: self.state.value, platform=name)
+        breaker_timeout_seconds.set_function(self.timeout, platform=name)
+
+    def timeout(self) -> float:
+        with self._lock:
+            latencies = sorted(self._latencies)
+        if len(latencies) < self.min_latency_samples:
+            return self.max_timeout
+        p99 = latencies[min(int(len(latencies) * 0.99), len(latencies) - 1)]
+        return min(self.max_timeout, max(self.min_timeout, p99 * self.timeout_multiplier))
+
+    def allow(self, now: float = None) -> bool:
+        """
+        A method that tells whether a call may be attempted, letting a single probe through once the breaker
+        has been open for long enough
+        :param now: current monotonic time, for tests
+        :return: True if the call may be attempted
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            if self.state is BreakerState.Closed:
+                return True
+            if self.state is BreakerState.Open and now - self.opened_at >= self.open_seconds:
+                self._transition(BreakerState.HalfOpen)
+            if self.state is BreakerState.HalfOpen and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return True
+            return False
+
+    def record_success(self, latency: float) -> None:
+        with self._lock:
+            self._latencies.append(latency)
+            self.failures = 0
+            self._probe_in_flight = False
+            if self.state is not BreakerState.Closed:
+                self._transition(BreakerState.Closed)
+
+    def record_failure(self, now: float = None, retry_after: float | None = None) -> None:
+        """
+        A method that records a failed call and opens the breaker if it is due
+        :param now: current monotonic time, for tests
+        :param retry_after: seconds the platform asked to wait before calling it again, if it did
+        :return: None
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self.failures += 1
+            self._probe_in_flight = False
+            if self.honors_retry_after and retry_after is not None:
+                self.open_seconds = retry_after
+            elif self.state is BreakerState.HalfOpen or self.failures >= self.failure_threshold:
+                self.open_seconds = self.reset_seconds
+            else:
+                return
+            self.opened_at = now
+            if self.state is not BreakerState.Open:
+                self._transition(BreakerState.Open)
+
+    def remaining_seconds(self, now: float = None) -> float:
+        """
+        A method that tells how long the breaker is going to stay open
+        :param now: current monotonic time, for tests
+        :return: seconds until a probe may be let through, 0 if it may be already
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            if self.state is not BreakerState.Open:
+                return 0
+            return max(self.open_seconds - (now - self.opened_at), 0)
+
+    def _transition(self, state: BreakerState) -> None:
+        self.state = state
+        breaker_transitions.inc(platform=self.name, state=state.name.lower())
+
+
+def create_breaker(name: str, honors_retry_after: bool = False) -> CircuitBreaker:
+    return CircuitBreaker(name, breaker_failure_threshold, breaker_reset_seconds,
+                          platform_min_timeout_seconds, platform_max_timeout_seconds, platform_timeout_multiplier,
+                          honors_retry_after)
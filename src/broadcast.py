@@ -0,0 +1,274 @@
+import asyncio
+import functools
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from os import environ
+
+from dotenv import load_dotenv
+from pydantic import BaseModel
+
+from src.api import DeliveryUnknownError, call_platform, is_delivered, platform_apis
+from src.background import PeriodicTask
+from src.breaker import CircuitBreaker, create_breaker
+from src.db.engine import Session
+from src.db.queries import (claim_broadcasts, create_broadcast, finish_broadcast, get_broadcast,
+                            get_broadcast_recipients, save_broadcast_progress)
+from src.metrics import counter, gauge
+
+load_dotenv()
+
+broadcast_page_size = int(environ.get("BROADCAST_PAGE_SIZE", 200))
+# Broadcasts have threads of their own, so that live chat replies never wait behind them
+broadcast_concurrency = int(environ.get("BROADCAST_CONCURRENCY", 16))
+# Live chat shares the platform limits, so these are meant to stay below them
+broadcast_rates = {
+    'telegram': float(environ.get("BROADCAST_TELEGRAM_RATE_PER_SECOND", 25)),
+    'viber': float(environ.get("BROADCAST_VIBER_RATE_PER_SECOND", 40)),
+    'facebook': float(environ.get("BROADCAST_FACEBOOK_RATE_PER_SECOND", 40)),
+}
+broadcast_max_attempts = int(environ.get("BROADCAST_MAX_ATTEMPTS", 3))
+# Unfinished jobs whose worker hasn't renewed its claim for this long are taken over, e.g. after a restart
+broadcast_stale_seconds = float(environ.get("BROADCAST_STALE_SECONDS", 60))
+broadcast_claim_interval_seconds = float(environ.get("BROADCAST_CLAIM_INTERVAL_SECONDS", 15))
+# Facebook rejects messages to users who haven't written within the last 24 hours unless they carry a message tag,
+# e.g. ACCOUNT_UPDATE. Broadcasts skip Facebook if it isn't set
+facebook_broadcast_message_tag = environ.get("FACEBOOK_BROADCAST_MESSAGE_TAG")
+broadcast_options = {'facebook': {'tag': facebook_broadcast_message_tag}}
+
+broadcast_messages = counter('broadcast_messages_total', 'Broadcast messages by how they ended', ['platform', 'outcome'])
+broadcast_pages = counter('broadcast_pages_total', 'Broadcast pages that have been sent and checkpointed', ['platform'])
+broadcasts_running = gauge('broadcasts_running', 'Broadcast jobs this worker is running')
+
+
+broadcast_permissions = ['broadcast:*', 'broadcast:*:*', '*:*', '*:*:*']
+
+
+class BroadcastRequest(BaseModel):
+    text: str
+    # All platforms if not given
+    platforms: list[str] | None = None
+
+
+class Pacer:
+    """
+    Spaces calls out to at most `rate` per second. Every job that sends to a platform shares its pacer,
+    so concurrent broadcasts don't add up past the platform limit
+    """
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate if rate > 0 else 0
+        self._next_at = 0.0
+
+    def delay(self, now: float) -> float:
+        """
+        A method that books the next free slot
+        :param now: current monotonic time
+        :return: how long to wait for the slot
+        """
+        slot = max(self._next_at, now)
+        self._next_at = slot + self.interval
+        return slot - now
+
+
+pacers: dict[str, Pacer] = {platform: Pacer(broadcast_rates[platform]) for platform in platform_apis}
+# Broadcasts have breakers of their own, so that rate limits they run into don't cut live chat off the platform
+breakers: dict[str, CircuitBreaker] = {
+    platform: create_breaker(f'broadcast_{platform}', honors_retry_after=True) for platform in platform_apis
+}
+executors: dict[str, ThreadPoolExecutor] = {
+    platform: ThreadPoolExecutor(broadcast_concurrency, thread_name_prefix=f'broadcast-{platform}') for platform in platform_apis
+}
+
+
+def broadcast_platforms() -> list[str]:
+    """
+    A function that lists platforms broadcasts can be sent to
+    :return: platform names
+    """
+    return [platform for platform in platform_apis if platform != 'facebook' or facebook_broadcast_message_tag]
+
+
+async def send_to(platform: str, user_id: str, text: str) -> bool:
+    """
+    A function that sends a broadcast message to a user. It waits while the platform's circuit breaker is open
+    instead of parking the message, so that a platform outage pauses the broadcast rather than piling it up in memory.
+    A rate limited platform opens the breaker for as long as the platform asked to wait
+    :param platform: a platform name
+    :param user_id: a unique user id
+    :param text: a text to send
+    :return: True if the message has been delivered
+    """
+    chat_id = user_id.split('_')[1]
+    breaker = breakers[platform]
+    call = functools.partial(call_platform, platform, chat_id, text, breaker, **broadcast_options.get(platform, {}))
+    loop = asyncio.get_running_loop()
+    for _ in range(broadcast_max_attempts):
+        while not breaker.allow():
+            # Nothing remains while another send probes the platform
+            await asyncio.sleep(breaker.remaining_seconds() or 1)
+        await asyncio.sleep(pacers[platform].delay(time.monotonic()))
+
+        try:
+            resp = await loop.run_in_executor(executors[platform], call)
+        except DeliveryUnknownError as e:
+            # Sending it again could deliver it twice
+            logging.warning(f"Broadcast message to {user_id} may not have been delivered: {e}")
+            return False
+        if resp is not None:
+            return is_delivered(platform, resp)
+    return False
+
+
+def fetch_recipients(platform: str, after: str | None) -> list[str]:
+    with Session() as session:
+        return get_broadcast_recipients(session, platform, after, broadcast_page_size)
+
+
+def create_job(text: str, platforms: list[str], created_by: str) -> int:
+    with Session() as session:
+        return create_broadcast(session, text, platforms, created_by)
+
+
+def load_job(job_id: int) -> dict | None:
+    with Session() as session:
+        return get_broadcast(session, job_id)
+
+
+def complete_job(job_id: int) -> None:
+    with Session() as session:
+        finish_broadcast(session, job_id)
+
+
+def claim_jobs(running_job_ids: list[int]) -> list[int]:
+    with Session() as session:
+        return claim_broadcasts(session, running_job_ids, broadcast_stale_seconds)
+
+
+def checkpoint(job_id: int, platform: str, last_user_id: str | None, sent: int, failed: int, finished: bool) -> None:
+    with Session() as session:
+        save_broadcast_progress(session, job_id, platform, last_user_id, sent, failed, finished)
+
+
+async def broadcast_to_platform(job_id: int, platform: str, text: str, after: str | None) -> tuple[int, int]:
+    """
+    A function that sends a broadcast to users of a platform page by page, checkpointing after every page.
+    A resumed job may send the page it has been interrupted on once more
+    :param job_id: job id
+    :param platform: a platform name
+    :param text: a text to send
+    :param after: the last user id of the last checkpointed page or None to start from the beginning
+    :return: (number of delivered messages, number of failed messages)
+    """
+    if platform not in broadcast_platforms():
+        # A job created before the platform stopped being supported
+        logging.error(f"Broadcast {job_id} can't be sent to {platform}, skipping it")
+        await asyncio.to_thread(checkpoint, job_id, platform, after, 0, 0, True)
+        return 0, 0
+
+    semaphore = asyncio.Semaphore(broadcast_concurrency)
+
+    async def send(user_id: str) -> bool:
+        async with semaphore:
+            delivered = await send_to(platform, user_id, text)
+        broadcast_messages.inc(platform=platform, outcome='delivered' if delivered else 'failed')
+        return delivered
+
+    total_sent, total_failed = 0, 0
+    while True:
+        user_ids = await asyncio.to_thread(fetch_recipients, platform, after)
+        results = await asyncio.gather(*(send(user_id) for user_id in user_ids))
+        sent = sum(results)
+        failed = len(results) - sent
+        after = user_ids[-1] if user_ids else after
+        finished = len(user_ids) < broadcast_page_size
+        await asyncio.to_thread(checkpoint, job_id, platform, after, sent, failed, finished)
+        broadcast_pages.inc(platform=platform)
+
+        total_sent += sent
+        total_failed += failed
+        if finished:
+            return total_sent, total_failed
+
+
+def broadcast_report(job: dict) -> dict:
+    """
+    A function that summarizes the progress of a broadcast job
+    :param job: a job as returned by get_broadcast
+    :return: a JSON-serializable dict
+    """
+    sent = sum(progress['sent'] for progress in job['progress'])
+    failed = sum(progress['failed'] for progress in job['progress'])
+    return {
+        'id': job['id'],
+        'status': job['status'],
+        'createdAt': job['createdAt'].timestamp(),
+        'finishedAt': job['finishedAt'].timestamp() if job['finishedAt'] else None,
+        'sent': sent,
+        'failed': failed,
+        'messagesPerSecond': (sent + failed) / job['elapsedSeconds'] if job['elapsedSeconds'] else 0,
+        'platforms': {
+            progress['platform']: {
+                'sent': progress['sent'],
+                'failed': progress['failed'],
+                'finished': progress['finishedAt'] is not None,
+            } for progress in job['progress']
+        },
+    }
+
+
+class Broadcaster:
+    """
+    Runs broadcast jobs as tasks on the event loop. Jobs survive restarts through their checkpoints:
+    every worker periodically renews claims on its own jobs and takes over jobs whose claims have gone stale
+    """
+
+    def __init__(self):
+        self._tasks: dict[int, asyncio.Task] = {}
+        broadcasts_running.set_function(lambda: len(self._tasks))
+
+    def start(self, job_id: int) -> None:
+        if job_id in self._tasks:
+            return
+        task = asyncio.create_task(self.run(job_id), name=f'broadcast-{job_id}')
+        self._tasks[job_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(job_id, None))
+
+    async def run(self, job_id: int) -> None:
+        started_at = time.perf_counter()
+        try:
+            job = await asyncio.to_thread(load_job, job_id)
+            if job is None:
+                return
+            results = await asyncio.gather(*(
+                broadcast_to_platform(job_id, progress['platform'], job['text'], progress['lastUserId'])
+                for progress in job['progress'] if progress['finishedAt'] is None
+            ))
+            await asyncio.to_thread(complete_job, job_id)
+        except Exception as e:
+            # The claim goes stale and the job is picked up again from its last checkpoint
+            logging.error(f"Broadcast {job_id} failed: {e}")
+            return
+
+        elapsed = time.perf_counter() - started_at
+        sent, failed = sum(result[0] for result in results), sum(result[1] for result in results)
+        logging.info(f"Broadcast {job_id} finished: {sent} delivered, {failed} failed in {elapsed:.3f}s")
+
+    async def claim(self) -> None:
+        """
+        A method that renews claims on running jobs and starts unfinished jobs that nobody runs anymore
+        :return: None
+        """
+        for job_id in await asyncio.to_thread(claim_jobs, list(self._tasks)):
+            logging.info(f"Resuming broadcast {job_id}")
+            self.start(job_id)
+
+    async def stop(self) -> None:
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+broadcaster = Broadcaster()
+broadcast_claim_task = PeriodicTask("broadcast-claims", broadcast_claim_interval_seconds, broadcaster.claim)
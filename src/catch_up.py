@@ -0,0 +1,120 @@
+import asyncio
+from os import environ
+
+from dotenv import load_dotenv
+from starlette.websockets import WebSocket
+
+from src.db.engine import Session
+from src.db.queries import get_missed_messages, get_open_chats
+from src.metrics import counter, histogram
+
+load_dotenv()
+
+catch_up_frame_size = int(environ.get("CATCH_UP_FRAME_SIZE", 200))
+# Past this many missed messages the operator is told to reload instead, so that a long absence can't flood a socket
+catch_up_max_messages = int(environ.get("CATCH_UP_MAX_MESSAGES", 5000))
+# Catch-up queries that may run at the same time, so that a reconnect storm queues up instead of draining the pool.
+# Slots are only held while querying, a slow socket doesn't keep other operators waiting
+catch_up_concurrency = int(environ.get("CATCH_UP_CONCURRENCY", 10))
+
+catch_up_seconds = histogram('operator_catch_up_seconds', 'Time spent streaming chats and missed messages to a connecting operator')
+catch_up_messages = counter('operator_catch_up_messages_total', 'Missed messages streamed to reconnecting operators')
+catch_up_slots = asyncio.Semaphore(catch_up_concurrency)
+
+
+def serialize_chat(chat: dict) -> dict:
+    return {
+        'id': chat['id'],
+        'userId': chat['userId'],
+        'createdAt': chat['createdAt'].timestamp(),
+        'lastUserMessageAt': chat['lastUserMessageAt'].timestamp() if chat['lastUserMessageAt'] else None,
+        'userLastSeenAt': chat['userLastSeenAt'].timestamp() if chat['userLastSeenAt'] else None,
+    }
+
+
+def serialize_message(message: dict) -> dict:
+    # The same shape as live messages
+    return {
+        'id': message['id'],
+        'text': message['text'],
+        'createdAt': message['createdAt'].timestamp(),
+        'chatId': message['chatId'],
+        'isFromUser': message['isFromUser'],
+    }
+
+
+async def fetch(func, *args):
+    """
+    A function that runs a catch-up query in a thread once a slot is free
+    :param func: a blocking function that queries the db
+    :param args: arguments of the function
+    :return: whatever the function returns
+    """
+    async with catch_up_slots:
+        return await asyncio.to_thread(func, *args)
+
+
+def fetch_open_chats(personnel_id: str, after: int) -> list[dict]:
+    with Session() as session:
+        return get_open_chats(session, personnel_id, after, catch_up_frame_size)
+
+
+def fetch_missed_messages(personnel_id: str, after: int, limit: int) -> list[dict]:
+    with Session() as session:
+        return get_missed_messages(session, personnel_id, after, limit)
+
+
+async def send_open_chats(websocket: WebSocket, personnel_id: str) -> None:
+    """
+    A function that streams every chat assigned to an operator in {"type": "chats", "chats": [...]} frames
+    :param websocket: an accepted websocket
+    :param personnel_id: personnel id
+    :return: None
+    """
+    after = 0
+    while True:
+        chats = await fetch(fetch_open_chats, personnel_id, after)
+        if chats:
+            await websocket.send_json({'type': 'chats', 'chats': [serialize_chat(chat) for chat in chats]})
+        if len(chats) < catch_up_frame_size:
+            return
+        after = chats[-1]['id']
+
+
+async def send_missed_messages(websocket: WebSocket, personnel_id: str, after: int, limit: int) -> tuple[int, bool]:
+    """
+    A function that streams messages an operator has missed in {"type": "messages", "messages": [...]} frames
+    :param websocket: an accepted websocket
+    :param personnel_id: personnel id
+    :param after: the last message id the operator has
+    :param limit: max number of messages to send
+    :return: (the last message id that has been sent, whether there are more messages than the limit)
+    """
+    sent = 0
+    while sent < limit:
+        page_size = min(catch_up_frame_size, limit - sent)
+        messages = await fetch(fetch_missed_messages, personnel_id, after, page_size)
+        if messages:
+            await websocket.send_json({'type': 'messages', 'messages': [serialize_message(message) for message in messages]})
+            after = messages[-1]['id']
+            sent += len(messages)
+            catch_up_messages.inc(len(messages))
+        if len(messages) < page_size:
+            return after, False
+    return after, True
+
+
+async def send_catch_up(websocket: WebSocket, personnel_id: str, last_message_id: int | None) -> tuple[int | None, bool]:
+    """
+    A function that streams an operator's open chats and, if the operator has told the last message id it has,
+    every message since then. Runs before the operator is registered for live delivery
+    :param websocket: an accepted websocket
+    :param personnel_id: personnel id
+    :param last_message_id: the last message id the operator has or None to only send chats
+    :return: (the last message id that has been sent, whether missed messages have been cut off at the limit)
+    """
+    with catch_up_seconds.time():
+        await send_open_chats(websocket, personnel_id)
+        if last_message_id is None:
+            return None, False
+        return await send_missed_messages(websocket, personnel_id, last_message_id, catch_up_max_messages)
@@ -0,0 +1,43 @@
+from collections import OrderedDict
+from os import environ
+from threading import Lock
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+class AffinityCache:
+    """
+    In-memory LRU map of user id -> (personnel id, archived chat id) of the most recent archived chat.
+    It mirrors the "UserAffinity" table, which is the source of truth, so a miss is never final
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._entries: OrderedDict[str, tuple[str, int]] = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, user_id: str) -> tuple[str, int] | None:
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None:
+                self._entries.move_to_end(user_id)
+            return entry
+
+    def put(self, user_id: str, personnel_id: str, archived_chat_id: int) -> None:
+        with self._lock:
+            self._entries[user_id] = (personnel_id, archived_chat_id)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def discard(self, user_id: str) -> None:
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+affinity_cache = AffinityCache(int(environ.get("AFFINITY_CACHE_SIZE", 10000)))
@@ -1,29 +1,123 @@
+import hashlib
+import logging
 import os
+import time
 from dotenv import load_dotenv
 
 # DB API
-from sqlalchemy import create_engine as alch_create_engine
+from sqlalchemy import create_engine as alch_create_engine, text, Connection, Engine
 from sqlalchemy.orm import sessionmaker, declarative_base
 from sqlalchemy_utils import database_exists, create_database
 
+from src.db.pool import InstrumentedQueuePool, register_pool_metrics
 from src.db.queries import register_queries
+from src.db.routing import enable_replica
 
 load_dotenv()
 
+pool_size = int(os.environ.get('DB_POOL_SIZE', 5))
+pool_max_overflow = int(os.environ.get('DB_POOL_MAX_OVERFLOW', 10))
+pool_timeout_seconds = float(os.environ.get('DB_POOL_TIMEOUT_SECONDS', 30))
+pool_recycle_seconds = int(os.environ.get('DB_POOL_RECYCLE_SECONDS', 1800))
+pool_pre_ping = os.environ.get('DB_POOL_PRE_PING', 'true').lower() == 'true'
+statement_timeout_ms = int(os.environ.get('DB_STATEMENT_TIMEOUT_MS', 0))
+# psycopg prepares a query server-side once it has been executed this many times on a connection.
+# Empty disables it, which is required behind pgbouncer in transaction mode
+prepare_threshold = os.environ.get('DB_PREPARE_THRESHOLD', '1')
 
-def create_engine():
-    return alch_create_engine(os.environ['DB_CONNECTION_STRING'],  # echo=True,
-                          future=True)
 
+def create_engine(connection_string: str = None, pool_name: str = 'primary'):
+    url = connection_string or os.environ['DB_CONNECTION_STRING']
+    connect_args = {}
+    if statement_timeout_ms:
+        connect_args['options'] = f'-c statement_timeout={statement_timeout_ms}'
+    if url.startswith('postgresql+psycopg:') or url.startswith('postgresql+psycopg_async:'):
+        connect_args['prepare_threshold'] = int(prepare_threshold) if prepare_threshold else None
 
-engine = create_engine()
+    new_engine = alch_create_engine(url,  # echo=True,
+                                    future=True,
+                                    poolclass=InstrumentedQueuePool,
+                                    pool_size=pool_size,
+                                    max_overflow=pool_max_overflow,
+                                    pool_timeout=pool_timeout_seconds,
+                                    pool_recycle=pool_recycle_seconds,
+                                    pool_pre_ping=pool_pre_ping,
+                                    connect_args=connect_args)
+    register_pool_metrics(new_engine, pool_name)
+    return new_engine
+
+
+# Both are bound by bootstrap(), so that importing this module never touches the db
+engine: Engine | None = None
+Session = sessionmaker()
+BaseModel = declarative_base()
+
+registered_queries_hash = hashlib.sha256('\n'.join(query.text for query in register_queries).encode()).hexdigest()
+
+create_schema_version_table = text("""
+    CREATE TABLE IF NOT EXISTS "RouterSchemaVersion" (
+        "name" TEXT PRIMARY KEY,
+        "hash" TEXT NOT NULL,
+        "appliedAt" TIMESTAMP(3) NOT NULL DEFAULT NOW()
+    )
+""")
+
+get_schema_version_query = text("""
+    SELECT "hash" FROM "RouterSchemaVersion" WHERE "name" = 'register_queries'
+""")
+
+set_schema_version_query = text("""
+    INSERT INTO "RouterSchemaVersion" ("name", "hash") VALUES ('register_queries', :hash)
+    ON CONFLICT ("name") DO UPDATE SET "hash" = EXCLUDED."hash", "appliedAt" = NOW()
+""")
+
+
+def apply_registered_queries(connection: Connection) -> bool:
+    """
+    A function that runs register_queries unless the same version of them has already been applied.
+    Workers that start at the same time wait for each other on an advisory lock instead of racing on DDL
+    :param connection: a db connection, the caller is responsible for committing
+    :return: True if queries have been applied, False if they were up to date
+    """
+    connection.execute(text("SELECT pg_advisory_xact_lock(hashtext('register_queries'))"))
+    connection.execute(create_schema_version_table)
+
+    if connection.execute(get_schema_version_query).scalar_one_or_none() == registered_queries_hash:
+        return False
 
-with engine.connect() as connection:
     for query in register_queries:
         connection.execute(query)
-    connection.commit()
+    connection.execute(set_schema_version_query, {'hash': registered_queries_hash})
+    return True
 
-Session = sessionmaker(engine)
-if not database_exists(engine.url):
-    create_database(engine.url)
-BaseModel = declarative_base()
+
+def bootstrap() -> float:
+    """
+    A function that creates the engine, makes sure the db and registered functions exist and binds Session
+    (and the replica session, if a replica is configured).
+    Safe to call more than once, only the first call does any work
+    :return: time spent in seconds
+    """
+    global engine
+    if engine is not None:
+        return 0.0
+
+    started_at = time.perf_counter()
+    new_engine = create_engine()
+    if not database_exists(new_engine.url):
+        create_database(new_engine.url)
+
+    with new_engine.connect() as connection:
+        applied = apply_registered_queries(connection)
+        connection.commit()
+
+    Session.configure(bind=new_engine)
+    engine = new_engine
+
+    replica_connection_string = os.environ.get('DB_REPLICA_CONNECTION_STRING')
+    if replica_connection_string:
+        enable_replica(create_engine(replica_connection_string, pool_name='replica'))
+
+    elapsed = time.perf_counter() - started_at
+    logging.info(f"Database bootstrapped in {elapsed:.3f}s, registered queries {'applied' if applied else 'up to date'}")
+    return elapsed
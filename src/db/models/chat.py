@@ -15,6 +15,14 @@ class Chat(BaseModel):
     # user = relationship('User', backref=backref('userChat', lazy='select'))
     # personnel = relationship('User', backref=backref('personnelChats', lazy='select'))
     personnel_id = mapped_column('personnelId', ForeignKey('User.id'))
+    # History of a reactivated chat stays in ArchivedMessage and is referenced instead of being copied
+    archived_chat_id = Column('archivedChatId', Integer)
+    # Maintained by a trigger on Message, it is reset once an operator replies
+    last_user_message_at = Column('lastUserMessageAt', DateTime)
+    # Maintained by the same trigger, the archiver finds idle chats by it
+    last_message_at = Column('lastMessageAt', DateTime)
+    # Updated in batches from platform read receipts
+    user_last_seen_at = Column('userLastSeenAt', DateTime)
 
 # Reference model from Prisma
 # model Chat {
@@ -6,6 +6,7 @@ from src.db.engine import BaseModel
 class Message(BaseModel):
     __tablename__ = 'Message'
 
+    # With MESSAGE_PARTITIONING the primary key in db is ("id", "createdAt"), but id stays unique on its own
     id = Column(Integer, primary_key=True, nullable=False)
     created_at = Column('createdAt', DateTime, default=dt.now)
     text = Column(String, nullable=False)
@@ -0,0 +1,252 @@
+import logging
+import re
+from datetime import date
+from os import environ
+
+from dotenv import load_dotenv
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from src.background import PeriodicTask
+from src.db.engine import Session as DBSession
+from src.db.queries import register_queries
+
+load_dotenv()
+
+# Tables are converted offline with `python -m src.db.partitions`, the running router only maintains their partitions
+partitioning_enabled = environ.get("MESSAGE_PARTITIONING", "false").lower() == "true"
+partition_maintenance_interval_seconds = float(environ.get("MESSAGE_PARTITION_MAINTENANCE_INTERVAL_SECONDS", 24 * 60 * 60))
+partitions_ahead_months = int(environ.get("MESSAGE_PARTITIONS_AHEAD_MONTHS", 3))
+# 0 keeps messages forever
+retention_months = int(environ.get("MESSAGE_RETENTION_MONTHS", 0))
+# Creating and dropping partitions briefly locks the whole table, maintenance gives up and retries later instead of waiting
+partition_lock_timeout_ms = int(environ.get("MESSAGE_PARTITION_LOCK_TIMEOUT_MS", 1000))
+
+partitioned_tables = ["Message", "ArchivedMessage"]
+partition_key = "createdAt"
+
+is_partitioned_query = text("""
+    SELECT EXISTS (
+        SELECT 1 FROM pg_partitioned_table pt
+        JOIN pg_class c ON c.oid = pt.partrelid
+        WHERE c.relname = :table AND c.relnamespace = 'public'::regnamespace
+    )
+""")
+
+table_indexes_query = text("""
+    SELECT i.relname AS name, pg_get_indexdef(i.oid) AS definition, ix.indisunique AS is_unique, ix.indisprimary AS is_primary,
+        ARRAY(SELECT a.attname::text FROM pg_attribute a WHERE a.attrelid = ix.indrelid AND a.attnum = ANY(ix.indkey)) AS columns
+    FROM pg_index ix
+    JOIN pg_class i ON i.oid = ix.indexrelid
+    WHERE ix.indrelid = ('public.' || quote_ident(:table))::regclass
+""")
+
+table_foreign_keys_query = text("""
+    SELECT conname AS name, pg_get_constraintdef(oid) AS definition
+    FROM pg_constraint
+    WHERE conrelid = ('public.' || quote_ident(:table))::regclass AND contype = 'f'
+""")
+
+table_triggers_query = text("""
+    SELECT tgname AS name
+    FROM pg_trigger
+    WHERE tgrelid = ('public.' || quote_ident(:table))::regclass AND NOT tgisinternal
+""")
+
+table_partitions_query = text("""
+    SELECT c.relname AS name, pg_get_expr(c.relpartbound, c.oid) AS bound
+    FROM pg_inherits i
+    JOIN pg_class c ON c.oid = i.inhrelid
+    WHERE i.inhparent = ('public.' || quote_ident(:table))::regclass
+""")
+
+upper_bound_pattern = re.compile(r"TO \('(\d{4}-\d{2}-\d{2})")
+
+
+def add_months(month: date, months: int) -> date:
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(table: str, month: date) -> str:
+    return f"{table}_p{month:%Y%m}"
+
+
+class PartitioningError(Exception):
+    pass
+
+
+def is_partitioned(session: Session, table: str) -> bool:
+    return session.execute(is_partitioned_query, {'table': table}).scalar_one()
+
+
+def partition_table(session: Session, table: str) -> bool:
+    """
+    A function that converts a plain table into a table partitioned by month of "createdAt".
+    Existing rows are kept in a single "<table>_legacy" partition that ends with the current month,
+    so that no data is rewritten. Takes an exclusive lock on the table for the duration of the transaction,
+    so it is meant to be run while the router is stopped
+    :param session: a db session
+    :param table: a table name
+    :return: True if the table has been converted, False if it was already partitioned
+    :raises PartitioningError: if the table has a unique index the partitioned table couldn't enforce
+    """
+    if is_partitioned(session, table):
+        return False
+
+    legacy = f"{table}_legacy"
+    indexes = session.execute(table_indexes_query, {'table': table}).all()
+    # Unique indexes of a partitioned table have to include the partition key
+    lost = [index.name for index in indexes if index.is_unique and not index.is_primary and partition_key not in index.columns]
+    if lost:
+        raise PartitioningError(f"Unique indexes {', '.join(lost)} of {table} don't include \"{partition_key}\" "
+                                f"and can't be kept once it is partitioned, drop or change them first")
+    foreign_keys = session.execute(table_foreign_keys_query, {'table': table}).all()
+    triggers = session.execute(table_triggers_query, {'table': table}).scalars().all()
+
+    session.execute(text(f'LOCK TABLE "{table}" IN ACCESS EXCLUSIVE MODE'))
+    session.execute(text(f'ALTER TABLE "{table}" RENAME TO "{legacy}"'))
+    for index in indexes:
+        session.execute(text(f'ALTER INDEX "{index.name}" RENAME TO "{index.name}_legacy"'))
+    for trigger in triggers:
+        # Registered queries recreate triggers on the partitioned table, they would fire twice if kept here
+        session.execute(text(f'DROP TRIGGER "{trigger}" ON "{legacy}"'))
+    for foreign_key in foreign_keys:
+        session.execute(text(f'ALTER TABLE "{legacy}" RENAME CONSTRAINT "{foreign_key.name}" TO "{foreign_key.name}_legacy"'))
+
+    session.execute(text(f"""
+        CREATE TABLE "{table}" (LIKE "{legacy}" INCLUDING DEFAULTS INCLUDING STORAGE)
+        PARTITION BY RANGE ("{partition_key}")
+    """))
+    sequence = session.execute(text("SELECT pg_get_serial_sequence(:table, 'id')"), {'table': f'"{legacy}"'}).scalar_one()
+    if sequence:
+        # The id sequence would otherwise be dropped together with the legacy partition
+        session.execute(text(f'ALTER SEQUENCE {sequence} OWNED BY "{table}"."id"'))
+    session.execute(text(f'ALTER TABLE "{table}" ADD CONSTRAINT "{table}_pkey" PRIMARY KEY ("id", "{partition_key}")'))
+
+    for index in indexes:
+        if index.is_primary:
+            continue
+        session.execute(text(index.definition))
+    for foreign_key in foreign_keys:
+        session.execute(text(f'ALTER TABLE "{table}" ADD CONSTRAINT "{foreign_key.name}" {foreign_key.definition}'))
+
+    for index in indexes:
+        if index.is_primary:
+            # Attaching builds the ("id", "createdAt") key of the partitioned table, a table can't have two
+            session.execute(text(f'ALTER TABLE "{legacy}" DROP CONSTRAINT "{index.name}_legacy"'))
+
+    current_month = date.today().replace(day=1)
+    session.execute(text(f"""
+        ALTER TABLE "{table}" ATTACH PARTITION "{legacy}"
+        FOR VALUES FROM (MINVALUE) TO ('{add_months(current_month, 1)}')
+    """))
+    # Catches rows of months that have no partition yet, e.g. if maintenance hasn't run for a while
+    session.execute(text(f'CREATE TABLE "{table}_default" PARTITION OF "{table}" DEFAULT'))
+    logging.info(f"Converted {table} to a partitioned table")
+    return True
+
+
+def create_partitions(session: Session, table: str, months_ahead: int) -> list[str]:
+    """
+    A function that creates monthly partitions from the current month up to months_ahead months in the future
+    :param session: a db session
+    :param table: a partitioned table name
+    :param months_ahead: number of future months to create partitions for
+    :return: names of created partitions
+    """
+    existing = {row.name: row.bound for row in session.execute(table_partitions_query, {'table': table})}
+    covered_until = max(
+        (date.fromisoformat(match.group(1)) for match in map(upper_bound_pattern.search, existing.values()) if match),
+        default=None
+    )
+
+    created = []
+    month = date.today().replace(day=1)
+    for _ in range(months_ahead + 1):
+        name = partition_name(table, month)
+        if name not in existing and (covered_until is None or month >= covered_until):
+            session.execute(text(f"""
+                CREATE TABLE "{name}" PARTITION OF "{table}"
+                FOR VALUES FROM ('{month}') TO ('{add_months(month, 1)}')
+            """))
+            created.append(name)
+        month = add_months(month, 1)
+    return created
+
+
+def drop_expired_partitions(session: Session, table: str, months: int) -> list[str]:
+    """
+    A function that drops partitions that only hold rows older than the retention period
+    :param session: a db session
+    :param table: a partitioned table name
+    :param months: retention period in months
+    :return: names of dropped partitions
+    """
+    cutoff = add_months(date.today().replace(day=1), -months)
+
+    dropped = []
+    for row in session.execute(table_partitions_query, {'table': table}).all():
+        match = upper_bound_pattern.search(row.bound)
+        if match and date.fromisoformat(match.group(1)) <= cutoff:
+            session.execute(text(f'DROP TABLE "{row.name}"'))
+            dropped.append(row.name)
+    return dropped
+
+
+def convert_tables(session: Session) -> list[str]:
+    """
+    A function that converts message tables to partitioned ones and redefines views and triggers that depend on them.
+    All tables are converted in one transaction, so either all of them are or none
+    :param session: a db session
+    :return: names of converted tables
+    """
+    converted = [table for table in partitioned_tables if partition_table(session, table)]
+    if converted:
+        # Views and triggers keep pointing to the renamed legacy tables until they are redefined
+        for query in register_queries:
+            session.execute(query)
+    for table in converted:
+        create_partitions(session, table, partitions_ahead_months)
+    session.commit()
+    return converted
+
+
+def maintain_partitions(session: Session) -> None:
+    """
+    A function that creates partitions ahead of time and drops partitions that fell out of the retention period.
+    Tables that haven't been converted yet are left alone
+    :param session: a db session
+    :return: None
+    """
+    session.execute(text(f"SET LOCAL lock_timeout = {partition_lock_timeout_ms}"))
+    for table in partitioned_tables:
+        if not is_partitioned(session, table):
+            logging.error(f"MESSAGE_PARTITIONING is enabled, but {table} isn't partitioned, "
+                          f"stop the router and run `python -m src.db.partitions` to convert it")
+            continue
+
+        created = create_partitions(session, table, partitions_ahead_months)
+        dropped = drop_expired_partitions(session, table, retention_months) if retention_months else []
+        if created or dropped:
+            logging.info(f"{table} partitions created: {created}, dropped: {dropped}")
+    session.commit()
+
+
+def run_partition_maintenance() -> None:
+    with DBSession() as session:
+        maintain_partitions(session)
+
+
+partition_maintenance_task = PeriodicTask(
+    "partition-maintenance", partition_maintenance_interval_seconds, run_partition_maintenance
+)
+
+
+if __name__ == "__main__":
+    from src.db.engine import bootstrap
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    bootstrap()
+    with DBSession() as migration_session:
+        logging.info(f"Converted tables: {convert_tables(migration_session) or 'none, all are partitioned already'}")
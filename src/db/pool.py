@@ -0,0 +1,39 @@
+import time
+
+from sqlalchemy import Engine
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
+
+from src.metrics import counter, gauge, histogram
+
+pool_checkout_wait_seconds = histogram(
+    'db_pool_checkout_wait_seconds', 'Time spent waiting for a connection from the pool'
+)
+pool_checkout_timeouts = counter('db_pool_checkout_timeouts_total', 'Checkouts that gave up waiting for a connection')
+pool_size = gauge('db_pool_size', 'Configured number of persistent connections', ['pool'])
+pool_checked_out = gauge('db_pool_checked_out', 'Connections currently in use', ['pool'])
+pool_overflow = gauge('db_pool_overflow', 'Connections open above the pool size', ['pool'])
+
+
+class InstrumentedQueuePool(QueuePool):
+    """
+    QueuePool that records how long every checkout had to wait, which tells pool starvation apart from slow queries
+    """
+
+    def _do_get(self):
+        started_at = time.perf_counter()
+        try:
+            return super()._do_get()
+        except PoolTimeoutError:
+            pool_checkout_timeouts.inc()
+            raise
+        finally:
+            pool_checkout_wait_seconds.observe(time.perf_counter() - started_at)
+
+
+def register_pool_metrics(engine: Engine, name: str) -> None:
+    pool = engine.pool
+    pool_size.set_function(pool.size, pool=name)
+    pool_checked_out.set_function(pool.checkedout, pool=name)
+    # overflow() is negative while the pool hasn't opened all of its connections yet
+    pool_overflow.set_function(lambda: max(pool.overflow(), 0), pool=name)
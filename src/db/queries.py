@@ -1,6 +1,26 @@
+from datetime import datetime
+from os import environ
+
+from dotenv import load_dotenv
 from sqlalchemy import text
 from sqlalchemy.orm import Session
 
+from src.db.affinity import affinity_cache
+from src.db.routing import read_only, mark_written
+from src.metrics import histogram, timed
+from src.tracing import traced
+
+load_dotenv()
+
+query_seconds = histogram('db_query_seconds', 'Time spent in query helpers, including waiting for a connection', ['query'])
+
+
+def timed_query(func):
+    return traced(f"db.{func.__name__}")(timed(query_seconds, query=func.__name__)(func))
+
+
+response_time_half_life_seconds = float(environ.get("RESPONSE_TIME_HALF_LIFE_HOURS", 7 * 24)) * 60 * 60
+
 create_get_personnel_stats_function = text("""
     DROP FUNCTION IF EXISTS get_personnel_stats();
     CREATE OR REPLACE FUNCTION get_personnel_stats()
@@ -37,7 +57,7 @@ create_get_personnel_stats_function = text("""
             FROM (
                 SELECT "personnelId"
                 FROM "Chat"
-                WHERE "personnelId" IS NOT NULL AND "createdAt" >= NOW() - INTERVAL '1 YEAR'
+                WHERE "personnelId" IS NOT NULL AND "archivedChatId" IS NULL AND "createdAt" >= NOW() - INTERVAL '1 YEAR'
                 UNION ALL
                 SELECT "personnelId"
                 FROM "ArchivedChat"
@@ -63,26 +83,11 @@ create_get_personnel_stats_function = text("""
             GROUP BY "personnelId"
         ),
         ResponseTime AS (
+            -- both sums decay at the same rate, so their ratio doesn't have to be decayed up to NOW()
             SELECT
                 "personnelId",
-                AVG(EXTRACT(EPOCH FROM ("nextMessageTime" - "createdAt"))) AS "averageResponseTimeSeconds"
-            FROM (
-                SELECT
-                    "personnelId",
-                    "createdAt",
-                    LEAD("createdAt") OVER (PARTITION BY "chatId" ORDER BY "createdAt") AS "nextMessageTime"
-                FROM (
-                    SELECT "personnelId", "chatId", m."createdAt", "isFromUser" FROM "Message" m
-                    JOIN "Chat" c ON "chatId" = c.id
-                    WHERE m."createdAt" > CURRENT_TIMESTAMP - INTERVAL '1 YEAR'
-                    UNION ALL
-                    SELECT "personnelId", "chatId", am."createdAt", "isFromUser" FROM "ArchivedMessage" am
-                    JOIN "ArchivedChat" ac ON "chatId" = ac.id
-                    WHERE am."createdAt" > CURRENT_TIMESTAMP - INTERVAL '1 YEAR'
-                ) AS messages
-                WHERE "isFromUser" = TRUE
-            ) AS filtered_messages
-            GROUP BY "personnelId"
+                ("decayedResponseSeconds" / NULLIF("decayedResponseCount", 0))::numeric AS "averageResponseTimeSeconds"
+            FROM "PersonnelResponseStats"
         ),
         PerceivedBusyness AS (
             SELECT id AS "personnelId", "busyness" AS "perceivedBusyness"
@@ -125,6 +130,20 @@ create_get_personnel_stats_function = text("""
     $$ LANGUAGE plpgsql;
 """)
 
+# A reactivated chat references its archived history instead of copying it back, so reactivation is O(1)
+create_chat_history_reference = text("""
+    ALTER TABLE "Chat" ADD COLUMN IF NOT EXISTS "archivedChatId" INT REFERENCES "ArchivedChat"("id") ON DELETE SET NULL;
+    CREATE UNIQUE INDEX IF NOT EXISTS "Chat_archivedChatId_key" ON "Chat"("archivedChatId");
+
+    CREATE OR REPLACE VIEW "ChatHistory" AS
+    SELECT m."id", m."chatId", m."createdAt", m."text", m."isFromUser", FALSE AS "isArchived"
+    FROM "Message" m
+    UNION ALL
+    SELECT am."id", c."id" AS "chatId", am."createdAt", am."text", am."isFromUser", TRUE AS "isArchived"
+    FROM "ArchivedMessage" am
+    JOIN "Chat" c ON c."archivedChatId" = am."chatId";
+""")
+
 create_unarchive_function = text("""
     DROP FUNCTION IF EXISTS unarchive_chat(int);
     CREATE OR REPLACE FUNCTION unarchive_chat(chat_id int)
@@ -132,36 +151,346 @@ create_unarchive_function = text("""
     DECLARE 
         new_chat_id int;
     BEGIN
-        INSERT INTO "Chat" ("userId", "personnelId", "createdAt")
-        SELECT "userId", "personnelId", "createdAt"
+        -- the archived chat has been idle, the reactivated one is active from now on
+        INSERT INTO "Chat" ("userId", "personnelId", "createdAt", "archivedChatId", "lastMessageAt")
+        SELECT "userId", "personnelId", "createdAt", "id", NOW()
         FROM "ArchivedChat"
         WHERE "id" = chat_id
+        ON CONFLICT DO NOTHING
         RETURNING "id" INTO new_chat_id;
 
-        INSERT INTO "Message" ("chatId", "text", "createdAt", "isFromUser")
-        SELECT new_chat_id, "text", "createdAt", "isFromUser"
-        FROM "ArchivedMessage"
-        WHERE "chatId" = chat_id;
-
-        DELETE FROM "ArchivedChat"
-        WHERE "id" = chat_id;
-    
-        DELETE FROM "ArchivedMessage"
-        WHERE "chatId" = chat_id;
-        
         RETURN new_chat_id;
     END;
     $$ LANGUAGE plpgsql;
 """)
 
-register_queries = [create_get_personnel_stats_function, create_unarchive_function]
+# Maps every user to the operator of their most recent archived chat, kept up to date by a trigger on archival
+create_user_affinity_index = text("""
+    CREATE TABLE IF NOT EXISTS "UserAffinity" (
+        "userId" TEXT PRIMARY KEY REFERENCES "User"("id") ON DELETE CASCADE,
+        "personnelId" TEXT NOT NULL,
+        "archivedChatId" INT NOT NULL,
+        "endedAt" TIMESTAMP(3) NOT NULL
+    );
+
+    CREATE OR REPLACE FUNCTION update_user_affinity()
+    RETURNS trigger AS $$
+    BEGIN
+        IF NEW."personnelId" IS NULL THEN
+            RETURN NEW;
+        END IF;
+
+        INSERT INTO "UserAffinity" ("userId", "personnelId", "archivedChatId", "endedAt")
+        VALUES (NEW."userId", NEW."personnelId", NEW."id", NEW."endedAt")
+        ON CONFLICT ("userId") DO UPDATE
+        SET "personnelId" = EXCLUDED."personnelId",
+            "archivedChatId" = EXCLUDED."archivedChatId",
+            "endedAt" = EXCLUDED."endedAt"
+        WHERE "UserAffinity"."endedAt" <= EXCLUDED."endedAt";
+
+        RETURN NEW;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    DROP TRIGGER IF EXISTS user_affinity_on_archive ON "ArchivedChat";
+    CREATE TRIGGER user_affinity_on_archive
+    AFTER INSERT OR UPDATE OF "personnelId", "endedAt" ON "ArchivedChat"
+    FOR EACH ROW EXECUTE FUNCTION update_user_affinity();
+
+    -- serves returning users whose last operator is offline, who go to the latest operator of theirs who is online
+    CREATE INDEX IF NOT EXISTS "ArchivedChat_userId_endedAt_idx" ON "ArchivedChat"("userId", "endedAt");
+
+    INSERT INTO "UserAffinity" ("userId", "personnelId", "archivedChatId", "endedAt")
+    SELECT DISTINCT ON ("userId") "userId", "personnelId", "id", "endedAt"
+    FROM "ArchivedChat"
+    WHERE "personnelId" IS NOT NULL
+    ORDER BY "userId", "endedAt" DESC
+    ON CONFLICT ("userId") DO NOTHING;
+""")
+
+# Moves up to batch_size idle chats with their messages to the archive in one set-based statement.
+# The webhook path holds a key share lock on a chat from loading it until its message is stored,
+# so chats that are being written to right now are skipped until the next pass.
+# "lastMessageAt" is kept up to date by the trigger on "Message", so idle chats are found without reading messages
+create_archive_idle_chats_function = text("""
+    ALTER TABLE "Chat" ADD COLUMN IF NOT EXISTS "lastMessageAt" TIMESTAMP(3);
+    UPDATE "Chat" c
+    SET "lastMessageAt" = m."lastMessageAt"
+    FROM (SELECT "chatId", MAX("createdAt") AS "lastMessageAt" FROM "Message" GROUP BY "chatId") m
+    WHERE c."id" = m."chatId" AND c."lastMessageAt" IS NULL;
+    CREATE INDEX IF NOT EXISTS "Chat_lastActivity_idx" ON "Chat"((COALESCE("lastMessageAt", "createdAt")));
+
+    DROP FUNCTION IF EXISTS archive_idle_chats(int, int);
+    CREATE OR REPLACE FUNCTION archive_idle_chats(idle_seconds int, batch_size int)
+    RETURNS TABLE (
+        archivedChats INT,
+        archivedMessages INT,
+        userIds TEXT[]
+    ) AS $$
+    BEGIN
+        RETURN QUERY
+        WITH Idle AS (
+            SELECT
+                c."id",
+                c."userId",
+                c."personnelId",
+                c."createdAt",
+                -- a reactivated chat is merged back into the archived chat it references
+                COALESCE(c."archivedChatId", nextval(pg_get_serial_sequence('"ArchivedChat"', 'id'))::int) AS "archiveId"
+            FROM "Chat" c
+            WHERE COALESCE(c."lastMessageAt", c."createdAt") < NOW() - make_interval(secs => idle_seconds)
+            ORDER BY COALESCE(c."lastMessageAt", c."createdAt")
+            LIMIT batch_size
+            FOR UPDATE SKIP LOCKED
+        ),
+        Archived AS (
+            INSERT INTO "ArchivedChat" ("id", "userId", "personnelId", "createdAt", "endedAt")
+            SELECT "archiveId", "userId", "personnelId", "createdAt", NOW()
+            FROM Idle
+            ON CONFLICT ("id") DO UPDATE
+            SET "personnelId" = EXCLUDED."personnelId",
+                "endedAt" = EXCLUDED."endedAt"
+            RETURNING 1
+        ),
+        Moved AS (
+            DELETE FROM "Message" m
+            USING Idle
+            WHERE m."chatId" = Idle."id"
+            RETURNING Idle."archiveId", m."text", m."createdAt", m."isFromUser"
+        ),
+        Inserted AS (
+            INSERT INTO "ArchivedMessage" ("chatId", "text", "createdAt", "isFromUser")
+            SELECT "archiveId", "text", "createdAt", "isFromUser"
+            FROM Moved
+            RETURNING 1
+        ),
+        Removed AS (
+            DELETE FROM "Chat" c
+            USING Idle
+            WHERE c."id" = Idle."id"
+            RETURNING c."userId"
+        )
+        SELECT
+            (SELECT COUNT(*) FROM Archived)::int,
+            (SELECT COUNT(*) FROM Inserted)::int,
+            (SELECT COALESCE(array_agg("userId"), ARRAY[]::TEXT[]) FROM Removed);
+    END;
+    $$ LANGUAGE plpgsql;
+""")
+
+# Folds the time between the latest user message and the operator reply into running per-operator sums on insert,
+# so that stats never have to scan message history. Decayed sums halve every response_time_half_life_seconds.
+# Unlike the stats this replaced, which averaged the time between consecutive user messages,
+# this is the time users wait for a reply. Sums are backfilled from the last year of messages on registration
+create_response_time_tracking = text(f"""
+    ALTER TABLE "Chat" ADD COLUMN IF NOT EXISTS "lastUserMessageAt" TIMESTAMP(3);
+
+    CREATE TABLE IF NOT EXISTS "PersonnelResponseStats" (
+        "personnelId" TEXT PRIMARY KEY REFERENCES "User"("id") ON DELETE CASCADE,
+        "responseCount" BIGINT NOT NULL DEFAULT 0,
+        "responseSeconds" DOUBLE PRECISION NOT NULL DEFAULT 0,
+        "decayedResponseCount" DOUBLE PRECISION NOT NULL DEFAULT 0,
+        "decayedResponseSeconds" DOUBLE PRECISION NOT NULL DEFAULT 0,
+        "updatedAt" TIMESTAMP(3) NOT NULL DEFAULT NOW()
+    );
+
+    CREATE OR REPLACE FUNCTION track_response_time()
+    RETURNS trigger AS $$
+    DECLARE
+        half_life DOUBLE PRECISION := TG_ARGV[0]::DOUBLE PRECISION;
+        personnel_id TEXT;
+        waiting_since TIMESTAMP(3);
+        response_seconds DOUBLE PRECISION;
+    BEGIN
+        IF NEW."isFromUser" THEN
+            UPDATE "Chat"
+            SET "lastUserMessageAt" = NEW."createdAt",
+                "lastMessageAt" = GREATEST("lastMessageAt", NEW."createdAt")
+            WHERE "id" = NEW."chatId";
+            RETURN NEW;
+        END IF;
+
+        -- no key update doesn't wait for the key share lock the webhook path holds on the chat
+        UPDATE "Chat" c
+        SET "lastUserMessageAt" = NULL,
+            "lastMessageAt" = GREATEST(c."lastMessageAt", NEW."createdAt")
+        FROM (SELECT "id", "personnelId", "lastUserMessageAt" FROM "Chat" WHERE "id" = NEW."chatId" FOR NO KEY UPDATE) previous
+        WHERE c."id" = previous."id"
+        RETURNING previous."personnelId", previous."lastUserMessageAt" INTO personnel_id, waiting_since;
+
+        IF personnel_id IS NULL OR waiting_since IS NULL THEN
+            RETURN NEW;
+        END IF;
+
+        response_seconds := GREATEST(EXTRACT(EPOCH FROM (NEW."createdAt" - waiting_since)), 0);
+
+        INSERT INTO "PersonnelResponseStats" AS s (
+            "personnelId", "responseCount", "responseSeconds", "decayedResponseCount", "decayedResponseSeconds", "updatedAt"
+        )
+        VALUES (personnel_id, 1, response_seconds, 1, response_seconds, NEW."createdAt")
+        ON CONFLICT ("personnelId") DO UPDATE
+        SET "responseCount" = s."responseCount" + 1,
+            "responseSeconds" = s."responseSeconds" + response_seconds,
+            "decayedResponseCount" = s."decayedResponseCount"
+                * power(0.5, GREATEST(EXTRACT(EPOCH FROM (NEW."createdAt" - s."updatedAt")), 0) / half_life) + 1,
+            "decayedResponseSeconds" = s."decayedResponseSeconds"
+                * power(0.5, GREATEST(EXTRACT(EPOCH FROM (NEW."createdAt" - s."updatedAt")), 0) / half_life) + response_seconds,
+            "updatedAt" = GREATEST(s."updatedAt", NEW."createdAt");
+
+        RETURN NEW;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    DROP TRIGGER IF EXISTS track_response_time_on_message ON "Message";
+    CREATE TRIGGER track_response_time_on_message
+    AFTER INSERT ON "Message"
+    FOR EACH ROW EXECUTE FUNCTION track_response_time('{response_time_half_life_seconds}');
+
+    -- Operators get the stats the trigger would have collected over the last year, so that nobody starts from 0.
+    -- Operators who already have stats keep them, which also makes this safe to run again
+    INSERT INTO "PersonnelResponseStats" (
+        "personnelId", "responseCount", "responseSeconds", "decayedResponseCount", "decayedResponseSeconds", "updatedAt"
+    )
+    SELECT
+        "personnelId",
+        COUNT(*),
+        SUM("responseSeconds"),
+        SUM("weight"),
+        SUM("weight" * "responseSeconds"),
+        NOW()
+    FROM (
+        SELECT
+            "personnelId",
+            GREATEST(EXTRACT(EPOCH FROM ("createdAt" - "previousCreatedAt")), 0) AS "responseSeconds",
+            power(0.5, GREATEST(EXTRACT(EPOCH FROM (NOW() - "createdAt")), 0) / {response_time_half_life_seconds}) AS "weight"
+        FROM (
+            SELECT
+                "personnelId",
+                "createdAt",
+                "isFromUser",
+                LAG("createdAt") OVER w AS "previousCreatedAt",
+                LAG("isFromUser") OVER w AS "previousIsFromUser"
+            FROM (
+                SELECT c."personnelId", 'live' AS "source", m."chatId", m."id", m."createdAt", m."isFromUser"
+                FROM "Message" m
+                JOIN "Chat" c ON c."id" = m."chatId"
+                WHERE m."createdAt" > NOW() - INTERVAL '1 YEAR'
+                UNION ALL
+                SELECT ac."personnelId", 'archived', am."chatId", am."id", am."createdAt", am."isFromUser"
+                FROM "ArchivedMessage" am
+                JOIN "ArchivedChat" ac ON ac."id" = am."chatId"
+                WHERE am."createdAt" > NOW() - INTERVAL '1 YEAR'
+            ) messages
+            WINDOW w AS (PARTITION BY "source", "chatId" ORDER BY "createdAt", "id")
+        ) ordered
+        -- the first reply after a user message, timed from the latest user message
+        WHERE "personnelId" IS NOT NULL AND NOT "isFromUser" AND "previousIsFromUser"
+    ) responses
+    GROUP BY "personnelId"
+    ON CONFLICT ("personnelId") DO NOTHING;
+
+    -- Chats whose user is waiting for a reply right now
+    UPDATE "Chat" c
+    SET "lastUserMessageAt" = latest."createdAt"
+    FROM (
+        SELECT DISTINCT ON ("chatId") "chatId", "createdAt", "isFromUser"
+        FROM "Message"
+        ORDER BY "chatId", "createdAt" DESC, "id" DESC
+    ) latest
+    WHERE c."id" = latest."chatId" AND latest."isFromUser" AND c."lastUserMessageAt" IS NULL;
+""")
+
+create_read_state = text("""
+    ALTER TABLE "Chat" ADD COLUMN IF NOT EXISTS "userLastSeenAt" TIMESTAMP(3);
+""")
+
+# Broadcast jobs checkpoint the last user id they have sent to per platform, so that they can be resumed.
+# A job belongs to the worker that has last claimed it and is taken over once the claim goes stale
+create_broadcast_jobs = text("""
+    CREATE TABLE IF NOT EXISTS "BroadcastJob" (
+        "id" SERIAL PRIMARY KEY,
+        "text" TEXT NOT NULL,
+        "createdBy" TEXT REFERENCES "User"("id") ON DELETE SET NULL,
+        "status" TEXT NOT NULL DEFAULT 'running',
+        "createdAt" TIMESTAMP(3) NOT NULL DEFAULT NOW(),
+        "finishedAt" TIMESTAMP(3),
+        "claimedAt" TIMESTAMP(3) NOT NULL DEFAULT NOW()
+    );
+    CREATE INDEX IF NOT EXISTS "BroadcastJob_running_idx" ON "BroadcastJob"("claimedAt") WHERE "status" = 'running';
+
+    CREATE TABLE IF NOT EXISTS "BroadcastProgress" (
+        "jobId" INT NOT NULL REFERENCES "BroadcastJob"("id") ON DELETE CASCADE,
+        "platform" TEXT NOT NULL,
+        "lastUserId" TEXT,
+        "sent" INT NOT NULL DEFAULT 0,
+        "failed" INT NOT NULL DEFAULT 0,
+        "finishedAt" TIMESTAMP(3),
+        PRIMARY KEY ("jobId", "platform")
+    );
+""")
+
+# Keyset pages of an operator's chats and of messages in them, which reconnecting operators catch up with
+create_catch_up_indexes = text("""
+    CREATE INDEX IF NOT EXISTS "Chat_personnelId_id_idx" ON "Chat"("personnelId", "id");
+    CREATE INDEX IF NOT EXISTS "Message_chatId_id_idx" ON "Message"("chatId", "id");
+""")
+
+create_history_indexes = text("""
+    -- Unlike the Prisma index on ("chatId", "createdAt"), these also serve keyset pages of history, which end on id
+    CREATE INDEX IF NOT EXISTS "Message_chatId_createdAt_id_idx" ON "Message"("chatId", "createdAt", "id");
+    CREATE INDEX IF NOT EXISTS "ArchivedMessage_chatId_createdAt_id_idx" ON "ArchivedMessage"("chatId", "createdAt", "id");
+    CREATE INDEX IF NOT EXISTS "ArchivedChat_userId_idx" ON "ArchivedChat"("userId");
+""")
+
+create_waiting_chats_index = text("""
+    CREATE INDEX IF NOT EXISTS "Chat_waiting_idx" ON "Chat"("createdAt") WHERE "personnelId" IS NULL;
+""")
+
+register_queries = [
+    create_chat_history_reference,
+    create_response_time_tracking,
+    create_get_personnel_stats_function,
+    create_unarchive_function,
+    create_user_affinity_index,
+    create_archive_idle_chats_function,
+    create_read_state,
+    create_broadcast_jobs,
+    create_catch_up_indexes,
+    create_history_indexes,
+    create_waiting_chats_index,
+]
 
 get_personnel_stats_query = text("""
     SELECT personnelId, normalizedScore FROM get_personnel_stats() WHERE personnelId = ANY(:available_personnel_ids) ORDER BY normalizedScore ASC;
 """)
 
+get_personnel_stats_table_query = text("""
+    SELECT * FROM get_personnel_stats();
+""")
+
+@timed_query
+@read_only
+def get_personnel_stats(session: Session) -> list[dict]:
+    """
+    A function that returns stats of all personnel, ordered from the least to the most busy
+    :param session: a db session
+    :return: a list of rows as dicts
+    """
+    return [dict(row) for row in session.execute(get_personnel_stats_table_query).mappings()]
+
+@timed_query
+@read_only
 def get_least_busy_personnel_id(session: Session, available_personnel_ids: list[str]):
     personnel_by_busyness = session.execute(get_personnel_stats_query, {'available_personnel_ids': available_personnel_ids}).scalars().all() or []
+    return pick_least_busy_personnel_id(personnel_by_busyness, available_personnel_ids)
+
+def pick_least_busy_personnel_id(personnel_by_busyness: list[str], available_personnel_ids: list[str]):
+    """
+    A function that picks personnel to assign a chat to. Personnel without stats yet go first
+    :param personnel_by_busyness: available personnel ids ordered from the least to the most busy
+    :param available_personnel_ids: ids of personnel who are online
+    :return: personnel id or None
+    """
     unmentioned_online_personnel = list(set(available_personnel_ids) - set(personnel_by_busyness))
 
     if not personnel_by_busyness and not unmentioned_online_personnel:
@@ -172,7 +501,9 @@ unarchive_chat_query = text("""
     SELECT unarchive_chat(:chat_id);
 """)
 
+@timed_query
 def unarchive_chat(session: Session, chat_id: int):
+    mark_written(session)
     result = session.execute(unarchive_chat_query, {'chat_id': chat_id}).scalars().one_or_none()
     session.commit()
     return result
@@ -190,24 +521,552 @@ get_user_ids_by_permission_query = text("""
     AND u.id = ANY(:available_personnel_ids)
 """)
 
+@timed_query
+@read_only
 def get_personnel(session: Session, available_personnel_ids: list[str], role_titles: list[str] = None):
     if not role_titles:
         role_titles = ['chat:*', 'chat:*:*', '*:*', '*:*:*']
     return session.execute(get_user_ids_by_permission_query, {'titles': role_titles, 'available_personnel_ids': available_personnel_ids}).scalars().all()
 
+get_user_affinity_query = text("""
+    SELECT "personnelId", "archivedChatId"
+    FROM "UserAffinity"
+    WHERE "userId" = :user_id
+""")
+
+def get_user_affinity(session: Session, user_id: str) -> tuple[str, int] | None:
+    """
+    A function that returns the operator and the archived chat the user has last talked to
+    :param session: a db session
+    :param user_id: a unique user id
+    :return: (personnel id, archived chat id) or None if the user has no archived chats
+    """
+    affinity = affinity_cache.get(user_id)
+    if affinity is not None:
+        return affinity
+
+    affinity = fetch_user_affinity(session, user_id)
+    if affinity is not None:
+        affinity_cache.put(user_id, *affinity)
+    return affinity
+
+@timed_query
+@read_only
+def fetch_user_affinity(session: Session, user_id: str) -> tuple[str, int] | None:
+    row = session.execute(get_user_affinity_query, {'user_id': user_id}).one_or_none()
+    return (row.personnelId, row.archivedChatId) if row else None
+
 get_chat_id_acquainted_with_client_query = text("""
-    SELECT c.id
-    FROM "User" u
-    LEFT JOIN "ArchivedChat" c ON u.id = c."personnelId"
-    WHERE (c."userId" = :user_id)
-    AND c."personnelId" IS NOT NULL
-    AND u.id = ANY(:available_personnel_ids)
-    ORDER BY c."endedAt" DESC
+    SELECT "id"
+    FROM "ArchivedChat"
+    WHERE "userId" = :user_id
+    AND "personnelId" = ANY(:available_personnel_ids)
+    ORDER BY "endedAt" DESC
     LIMIT 1
 """)
 
+@timed_query
+@read_only
+def fetch_acquainted_chat(session: Session, available_personnel_ids: list[str], user_id: str) -> int | None:
+    return session.execute(get_chat_id_acquainted_with_client_query, {'user_id': user_id, 'available_personnel_ids': available_personnel_ids}).scalars().first()
+
 def get_acquainted_chat(session: Session, available_personnel_ids: list[str], user_id: str):
-    return session.execute(get_chat_id_acquainted_with_client_query, {'user_id': user_id, 'available_personnel_ids': available_personnel_ids}).scalars().one_or_none()
+    """
+    A function that finds the latest archived chat of a user with an operator who is online. The operator the user
+    has last talked to is looked up through the affinity index, earlier operators only if they are offline
+    :param session: a db session
+    :param available_personnel_ids: ids of personnel who are online
+    :param user_id: a unique user id
+    :return: an archived chat id or None
+    """
+    affinity = get_user_affinity(session, user_id)
+    if affinity is None or not available_personnel_ids:
+        return None
+
+    personnel_id, archived_chat_id = affinity
+    if personnel_id in available_personnel_ids:
+        return archived_chat_id
+    return fetch_acquainted_chat(session, available_personnel_ids, user_id)
+
+def reactivate_acquainted_chat(session: Session, available_personnel_ids: list[str], user_id: str):
+    """
+    A function that unarchives the latest chat of a user if its operator is available
+    :param session: a db session
+    :param available_personnel_ids: ids of personnel who are online
+    :param user_id: a unique user id
+    :return: an id of the reactivated chat or None
+    """
+    acq_chat_id = get_acquainted_chat(session, available_personnel_ids, user_id)
+    if not acq_chat_id:
+        return None
+
+    chat_id = unarchive_chat(session, acq_chat_id)
+    if chat_id is None:
+        # The cached chat is gone or was reactivated elsewhere in the meantime, so only the db is trusted on retry
+        affinity_cache.discard(user_id)
+        acq_chat_id = get_acquainted_chat(session, available_personnel_ids, user_id)
+        chat_id = unarchive_chat(session, acq_chat_id) if acq_chat_id else None
+
+    affinity_cache.discard(user_id)
+    return chat_id
 
+archive_idle_chats_query = text("""
+    SELECT archivedChats, archivedMessages, userIds FROM archive_idle_chats(:idle_seconds, :batch_size);
+""")
+
+@timed_query
+def archive_idle_chats(session: Session, idle_seconds: int, batch_size: int) -> tuple[int, int]:
+    """
+    A function that archives one batch of chats that have had no messages for idle_seconds
+    :param session: a db session
+    :param idle_seconds: how long a chat has to be idle to be archived
+    :param batch_size: max number of chats to archive
+    :return: (number of archived chats, number of archived messages)
+    """
+    chats, messages, user_ids = session.execute(
+        archive_idle_chats_query, {'idle_seconds': idle_seconds, 'batch_size': batch_size}
+    ).one()
+    session.commit()
+
+    for user_id in user_ids:
+        affinity_cache.discard(user_id)
+    return chats, messages
+
+@timed_query
+@read_only
 def get_user_email(session: Session, personnel_id: str):
     return session.execute(text('SELECT email FROM "User" WHERE id = :id'), {'id': personnel_id}).scalar_one()
+
+@timed_query
+def get_personnel_id_by_session_token(session: Session, session_token: str) -> str | None:
+    return session.execute(text('SELECT user_id FROM "Session" WHERE session_token = :token'), {'token': session_token}).scalars().one_or_none()
+
+suspend_users_query = text("""
+    UPDATE "User" SET suspended = true WHERE id = ANY(:user_ids) AND suspended IS NOT true
+""")
+
+@timed_query
+def suspend_users(session: Session, user_ids: list[str]) -> int:
+    """
+    A function that suspends users in one statement
+    :param session: a db session
+    :param user_ids: unique user ids
+    :return: number of users that have been suspended, already suspended ones are not counted
+    """
+    mark_written(session)
+    suspended = session.execute(suspend_users_query, {'user_ids': user_ids}).rowcount
+    session.commit()
+    return suspended
+
+mark_chats_seen_query = text("""
+    UPDATE "Chat" c
+    SET "userLastSeenAt" = GREATEST(c."userLastSeenAt", s.seen_at)
+    FROM unnest(CAST(:user_ids AS TEXT[]), CAST(:seen_at AS TIMESTAMP(3)[])) AS s(user_id, seen_at)
+    WHERE c."userId" = s.user_id
+""")
+
+@timed_query
+def mark_chats_seen(session: Session, seen_at_by_user_id: dict[str, datetime]) -> int:
+    """
+    A function that records in one statement when users have last seen their chats
+    :param session: a db session
+    :param seen_at_by_user_id: unique user id -> when the user has seen the chat
+    :return: number of updated chats
+    """
+    mark_written(session)
+    updated = session.execute(mark_chats_seen_query, {
+        'user_ids': list(seen_at_by_user_id),
+        'seen_at': list(seen_at_by_user_id.values()),
+    }).rowcount
+    session.commit()
+    return updated
+
+create_broadcast_query = text("""
+    WITH Job AS (
+        INSERT INTO "BroadcastJob" ("text", "createdBy")
+        VALUES (:text, :created_by)
+        RETURNING "id"
+    ),
+    Progress AS (
+        INSERT INTO "BroadcastProgress" ("jobId", "platform")
+        SELECT Job."id", p.platform
+        FROM Job, unnest(CAST(:platforms AS TEXT[])) AS p(platform)
+    )
+    SELECT "id" FROM Job
+""")
+
+@timed_query
+def create_broadcast(session: Session, broadcast_text: str, platforms: list[str], created_by: str) -> int:
+    """
+    A function that creates a broadcast job claimed by the calling worker
+    :param session: a db session
+    :param broadcast_text: a text to send
+    :param platforms: platform names to send to
+    :param created_by: personnel id
+    :return: job id
+    """
+    mark_written(session)
+    job_id = session.execute(create_broadcast_query, {
+        'text': broadcast_text, 'created_by': created_by, 'platforms': platforms,
+    }).scalar_one()
+    session.commit()
+    return job_id
+
+get_broadcast_query = text("""
+    SELECT "id", "text", "status", "createdBy", "createdAt", "finishedAt",
+        EXTRACT(EPOCH FROM COALESCE("finishedAt", NOW()) - "createdAt")::float AS "elapsedSeconds"
+    FROM "BroadcastJob"
+    WHERE "id" = :job_id
+""")
+
+get_broadcast_progress_query = text("""
+    SELECT "platform", "lastUserId", "sent", "failed", "finishedAt"
+    FROM "BroadcastProgress"
+    WHERE "jobId" = :job_id
+    ORDER BY "platform"
+""")
+
+@timed_query
+def get_broadcast(session: Session, job_id: int) -> dict | None:
+    """
+    A function that returns a broadcast job with its progress on every platform
+    :param session: a db session
+    :param job_id: job id
+    :return: job row as a dict with a 'progress' list or None if there is no such job
+    """
+    job = session.execute(get_broadcast_query, {'job_id': job_id}).mappings().one_or_none()
+    if job is None:
+        return None
+    progress = session.execute(get_broadcast_progress_query, {'job_id': job_id}).mappings()
+    return {**job, 'progress': [dict(row) for row in progress]}
+
+renew_broadcast_claims_query = text("""
+    UPDATE "BroadcastJob" SET "claimedAt" = NOW() WHERE "id" = ANY(:job_ids) AND "status" = 'running'
+""")
+
+claim_stale_broadcasts_query = text("""
+    UPDATE "BroadcastJob" SET "claimedAt" = NOW()
+    WHERE "id" IN (
+        SELECT "id" FROM "BroadcastJob"
+        WHERE "status" = 'running' AND "claimedAt" < NOW() - make_interval(secs => :stale_seconds)
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING "id"
+""")
+
+@timed_query
+def claim_broadcasts(session: Session, running_job_ids: list[int], stale_seconds: float) -> list[int]:
+    """
+    A function that renews claims of jobs the worker is running and claims unfinished jobs nobody runs anymore
+    :param session: a db session
+    :param running_job_ids: ids of jobs the worker is running
+    :param stale_seconds: how long a claim lasts without being renewed
+    :return: ids of newly claimed jobs
+    """
+    mark_written(session)
+    if running_job_ids:
+        session.execute(renew_broadcast_claims_query, {'job_ids': running_job_ids})
+    job_ids = session.execute(claim_stale_broadcasts_query, {'stale_seconds': stale_seconds}).scalars().all()
+    session.commit()
+    return job_ids
+
+get_broadcast_recipients_query = text("""
+    SELECT "id" FROM "User"
+    WHERE "id" LIKE :prefix AND "id" > :after AND "suspended" IS NOT true
+    ORDER BY "id"
+    LIMIT :limit
+""")
+
+@timed_query
+@read_only
+def get_broadcast_recipients(session: Session, platform: str, after: str | None, limit: int) -> list[str]:
+    """
+    A function that returns the next page of users of a platform, ordered by id
+    :param session: a db session
+    :param platform: a platform name
+    :param after: the last user id of the previous page or None for the first page
+    :param limit: max number of user ids
+    :return: unique user ids
+    """
+    return session.execute(get_broadcast_recipients_query, {
+        'prefix': f'{platform}\\_%', 'after': after or '', 'limit': limit,
+    }).scalars().all()
+
+save_broadcast_progress_query = text("""
+    UPDATE "BroadcastProgress"
+    SET "lastUserId" = :last_user_id,
+        "sent" = "sent" + :sent,
+        "failed" = "failed" + :failed,
+        "finishedAt" = CASE WHEN :finished THEN NOW() END
+    WHERE "jobId" = :job_id AND "platform" = :platform
+""")
+
+@timed_query
+def save_broadcast_progress(session: Session, job_id: int, platform: str, last_user_id: str | None,
+                            sent: int, failed: int, finished: bool) -> None:
+    """
+    A function that checkpoints a page of a broadcast on a platform
+    :param session: a db session
+    :param job_id: job id
+    :param platform: a platform name
+    :param last_user_id: the last user id the page has been sent to
+    :param sent: number of users the page has been delivered to
+    :param failed: number of users the page couldn't be delivered to
+    :param finished: whether there are no users left on the platform
+    :return: None
+    """
+    mark_written(session)
+    session.execute(save_broadcast_progress_query, {
+        'job_id': job_id, 'platform': platform, 'last_user_id': last_user_id,
+        'sent': sent, 'failed': failed, 'finished': finished,
+    })
+    session.commit()
+
+finish_broadcast_query = text("""
+    UPDATE "BroadcastJob" SET "status" = 'finished', "finishedAt" = NOW() WHERE "id" = :job_id
+""")
+
+@timed_query
+def finish_broadcast(session: Session, job_id: int) -> None:
+    mark_written(session)
+    session.execute(finish_broadcast_query, {'job_id': job_id})
+    session.commit()
+
+get_open_chats_query = text("""
+    SELECT "id", "userId", "createdAt", "lastUserMessageAt", "userLastSeenAt"
+    FROM "Chat"
+    WHERE "personnelId" = :personnel_id AND "id" > :after
+    ORDER BY "id"
+    LIMIT :limit
+""")
+
+@timed_query
+def get_open_chats(session: Session, personnel_id: str, after: int, limit: int) -> list[dict]:
+    """
+    A function that returns the next page of chats assigned to an operator, ordered by id
+    :param session: a db session
+    :param personnel_id: personnel id
+    :param after: the last chat id of the previous page or 0 for the first page
+    :param limit: max number of chats
+    :return: a list of rows as dicts
+    """
+    return [dict(row) for row in session.execute(get_open_chats_query, {
+        'personnel_id': personnel_id, 'after': after, 'limit': limit,
+    }).mappings()]
+
+# Walks the operator's chats and takes at most a page of each one's messages from ("chatId", "id"),
+# instead of scanning every message past :after and throwing away those of other operators' chats
+get_missed_messages_query = text("""
+    SELECT m."id", m."text", m."createdAt", m."chatId", m."isFromUser"
+    FROM "Chat" c
+    CROSS JOIN LATERAL (
+        SELECT "id", "text", "createdAt", "chatId", "isFromUser"
+        FROM "Message"
+        WHERE "chatId" = c."id" AND "id" > :after
+        ORDER BY "id"
+        LIMIT :limit
+    ) m
+    WHERE c."personnelId" = :personnel_id
+    ORDER BY m."id"
+    LIMIT :limit
+""")
+
+@timed_query
+def get_missed_messages(session: Session, personnel_id: str, after: int, limit: int) -> list[dict]:
+    """
+    A function that returns the next page of messages in chats assigned to an operator, ordered by id.
+    It doesn't go to the replica, which may not have the messages an operator has just missed yet
+    :param session: a db session
+    :param personnel_id: personnel id
+    :param after: the last message id the operator has
+    :param limit: max number of messages
+    :return: a list of rows as dicts
+    """
+    return [dict(row) for row in session.execute(get_missed_messages_query, {
+        'personnel_id': personnel_id, 'after': after, 'limit': limit,
+    }).mappings()]
+
+# Live and archived ids come from different sequences, so history is ordered by ("createdAt", live first, "id").
+# Every branch is a keyset range scan over its own ("chatId", "createdAt", "id") index
+history_page_template = """
+    (SELECT m."id", m."chatId", m."createdAt", m."text", m."isFromUser", FALSE AS "isArchived"
+    FROM "Message" m
+    {live_join}
+    WHERE {live_filter} AND (m."createdAt", m."id") < (:created_at, :live_id)
+    ORDER BY m."createdAt" DESC, m."id" DESC
+    LIMIT :limit)
+    UNION ALL
+    (SELECT am."id", am."chatId", am."createdAt", am."text", am."isFromUser", TRUE AS "isArchived"
+    FROM "ArchivedMessage" am
+    {archived_join}
+    WHERE {archived_filter} AND (am."createdAt", am."id") < (:created_at, :archived_id)
+    ORDER BY am."createdAt" DESC, am."id" DESC
+    LIMIT :limit)
+    ORDER BY "createdAt" DESC, "isArchived", "id" DESC
+    LIMIT :limit
+"""
+
+get_chat_history_page_query = text(history_page_template.format(
+    live_join='',
+    live_filter='m."chatId" = :chat_id',
+    archived_join='',
+    archived_filter='am."chatId" = (SELECT "archivedChatId" FROM "Chat" WHERE "id" = :chat_id)',
+))
+
+get_user_history_page_query = text(history_page_template.format(
+    live_join='JOIN "Chat" c ON c."id" = m."chatId"',
+    live_filter='c."userId" = :user_id',
+    archived_join='JOIN "ArchivedChat" ac ON ac."id" = am."chatId"',
+    archived_filter='ac."userId" = :user_id',
+))
+
+# The live part of an archived chat is its reactivation, if it has one
+get_archived_chat_history_page_query = text(history_page_template.format(
+    live_join='',
+    live_filter='m."chatId" = (SELECT "id" FROM "Chat" WHERE "archivedChatId" = :archived_chat_id)',
+    archived_join='',
+    archived_filter='am."chatId" = :archived_chat_id',
+))
+
+history_start = (datetime(9999, 12, 31), False, 2 ** 31 - 1)
+
+@timed_query
+@read_only
+def get_history_page(session: Session, chat_id: int | None, user_id: str | None,
+                     before: tuple[datetime, bool, int] | None, limit: int, archived_chat_id: int | None = None) -> list[dict]:
+    """
+    A function that returns the next page of history of a chat, including its archived part, or of all chats of a user,
+    newest first
+    :param session: a db session
+    :param chat_id: a live chat id or None to read a user's or an archived chat's history
+    :param user_id: a unique user id, used if chat_id is None
+    :param before: ("createdAt", "isArchived", "id") of the last message of the previous page or None for the first page
+    :param limit: max number of messages
+    :param archived_chat_id: an archived chat id, used if both chat_id and user_id are None
+    :return: a list of rows as dicts
+    """
+    created_at, is_archived, message_id = before or history_start
+    params = {
+        'created_at': created_at,
+        # Live messages go before archived ones created at the same time
+        'live_id': 0 if is_archived else message_id,
+        'archived_id': message_id if is_archived else 2 ** 31 - 1,
+        'limit': limit,
+    }
+    if chat_id is not None:
+        query, params['chat_id'] = get_chat_history_page_query, chat_id
+    elif user_id is not None:
+        query, params['user_id'] = get_user_history_page_query, user_id
+    else:
+        query, params['archived_chat_id'] = get_archived_chat_history_page_query, archived_chat_id
+    return [dict(row) for row in session.execute(query, params).mappings()]
+
+# Live and archived chat ids come from different sequences, so each is only looked up in its own table
+is_history_visible_query = text("""
+    SELECT EXISTS (
+        SELECT 1 FROM "Chat"
+        WHERE "personnelId" = :personnel_id AND ("id" = :chat_id OR "userId" = :user_id OR "archivedChatId" = :archived_chat_id)
+    ) OR EXISTS (
+        SELECT 1 FROM "ArchivedChat"
+        WHERE "personnelId" = :personnel_id AND ("id" = :archived_chat_id OR "userId" = :user_id)
+    )
+""")
+
+@timed_query
+def is_history_visible(session: Session, personnel_id: str, chat_id: int | None, user_id: str | None,
+                       archived_chat_id: int | None) -> bool:
+    """
+    A function that tells whether an operator has been in charge of a chat, so that they may read its history.
+    It doesn't go to the replica, which may not know of a chat that has just been assigned yet
+    :param session: a db session
+    :param personnel_id: personnel id
+    :param chat_id: a live chat id or None
+    :param user_id: a unique user id or None
+    :param archived_chat_id: an archived chat id or None
+    :return: True if the operator is or was assigned to the chat or to one of the user's chats
+    """
+    return session.execute(is_history_visible_query, {
+        'personnel_id': personnel_id, 'chat_id': chat_id, 'user_id': user_id, 'archived_chat_id': archived_chat_id,
+    }).scalar_one()
+
+get_waiting_chats_query = text("""
+    SELECT c."id", c."userId", c."createdAt", ua."personnelId" AS "affinityPersonnelId"
+    FROM "Chat" c
+    LEFT JOIN "UserAffinity" ua ON ua."userId" = c."userId"
+    WHERE c."personnelId" IS NULL
+    FOR NO KEY UPDATE OF c SKIP LOCKED
+""")
+
+@timed_query
+def get_waiting_chats(session: Session) -> list[dict]:
+    """
+    A function that claims chats that haven't been assigned to an operator, with the operator the user has
+    last talked to. Chats are locked until the transaction ends and chats another worker has claimed are skipped,
+    so that workers never plan the same chats. It doesn't block webhooks, which only take key share locks
+    :param session: a db session
+    :return: a list of rows as dicts
+    """
+    return [dict(row) for row in session.execute(get_waiting_chats_query).mappings()]
+
+get_open_chat_counts_query = text("""
+    SELECT "personnelId", COUNT(*) AS "chats"
+    FROM "Chat"
+    WHERE "personnelId" = ANY(:personnel_ids)
+    GROUP BY "personnelId"
+""")
+
+@timed_query
+def get_open_chat_counts(session: Session, personnel_ids: list[str]) -> dict[str, int]:
+    rows = session.execute(get_open_chat_counts_query, {'personnel_ids': personnel_ids})
+    return {row.personnelId: row.chats for row in rows}
+
+assign_chats_query = text("""
+    UPDATE "Chat" c
+    SET "personnelId" = a.personnel_id
+    FROM unnest(CAST(:chat_ids AS INT[]), CAST(:personnel_ids AS TEXT[])) AS a(chat_id, personnel_id)
+    WHERE c."id" = a.chat_id AND c."personnelId" IS NULL
+    RETURNING c."id", c."userId", c."personnelId", c."createdAt", c."lastUserMessageAt", c."userLastSeenAt"
+""")
+
+@timed_query
+def assign_chats(session: Session, personnel_id_by_chat_id: dict[int, str]) -> list[dict]:
+    """
+    A function that assigns waiting chats to operators in one statement.
+    Chats that have been assigned or archived in the meantime are left alone
+    :param session: a db session
+    :param personnel_id_by_chat_id: chat id -> personnel id
+    :return: assigned chats as dicts
+    """
+    mark_written(session)
+    chats = [dict(row) for row in session.execute(assign_chats_query, {
+        'chat_ids': list(personnel_id_by_chat_id),
+        'personnel_ids': list(personnel_id_by_chat_id.values()),
+    }).mappings()]
+    session.commit()
+    return chats
+
+record_presence_query = text("""
+    UPDATE "User" u
+    SET "latestStatusConfirmationAt" = GREATEST(u."latestStatusConfirmationAt", s.seen_at),
+        "busyness" = COALESCE(s.busyness, u."busyness")
+    FROM unnest(CAST(:personnel_ids AS TEXT[]), CAST(:seen_at AS TIMESTAMP(3)[]), CAST(:busyness AS INT[]))
+        AS s(personnel_id, seen_at, busyness)
+    WHERE u."id" = s.personnel_id
+""")
+
+@timed_query
+def record_presence(session: Session, heartbeats: dict[str, tuple[datetime, int | None]]) -> int:
+    """
+    A function that records the latest heartbeats of operators in one statement
+    :param session: a db session
+    :param heartbeats: personnel id -> (when the last heartbeat has come, busyness it has reported or None)
+    :return: number of updated users
+    """
+    mark_written(session)
+    updated = session.execute(record_presence_query, {
+        'personnel_ids': list(heartbeats),
+        'seen_at': [seen_at for seen_at, _ in heartbeats.values()],
+        'busyness': [busyness for _, busyness in heartbeats.values()],
+    }).rowcount
+    session.commit()
+    return updated
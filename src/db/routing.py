@@ -0,0 +1,62 @@
+import logging
+from functools import wraps
+from typing import Callable, TypeVar
+
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session, sessionmaker
+
+from src.metrics import counter
+
+T = TypeVar("T")
+
+# Bound by src.db.engine.bootstrap() when DB_REPLICA_CONNECTION_STRING is set
+ReplicaSession = sessionmaker()
+replica_enabled = False
+
+query_routes = counter('db_query_routes_total', 'Read-only queries by the database they were sent to', ['query', 'target'])
+
+
+def enable_replica(bind) -> None:
+    global replica_enabled
+    ReplicaSession.configure(bind=bind)
+    replica_enabled = True
+
+
+def mark_written(session: Session) -> None:
+    """
+    A function that pins the rest of the session's reads to the primary, so that they see what it has just written
+    :param session: a db session
+    :return: None
+    """
+    session.info['has_writes'] = True
+
+
+@event.listens_for(Session, 'after_flush')
+def mark_flushed_session_written(session: Session, flush_context) -> None:
+    mark_written(session)
+
+
+def read_only(func: Callable[..., T]) -> Callable[..., T]:
+    """
+    A decorator for query helpers that take a session as their first argument and never write.
+    Such helpers run on the replica unless the session has already written something, and fall back to the primary
+    if the replica can't be reached
+    """
+    @wraps(func)
+    def wrapper(session: Session, *args, **kwargs) -> T:
+        if not replica_enabled or session.info.get('has_writes'):
+            query_routes.inc(query=func.__name__, target='primary')
+            return func(session, *args, **kwargs)
+
+        try:
+            with ReplicaSession() as replica_session:
+                result = func(replica_session, *args, **kwargs)
+        except OperationalError as e:
+            logging.warning(f"Replica is unavailable for {func.__name__}, falling back to primary: {e}")
+            query_routes.inc(query=func.__name__, target='primary_fallback')
+            return func(session, *args, **kwargs)
+
+        query_routes.inc(query=func.__name__, target='replica')
+        return result
+    return wrapper
@@ -0,0 +1,112 @@
+import heapq
+import time
+from os import environ
+from threading import Lock
+
+from dotenv import load_dotenv
+
+from src.metrics import counter, histogram
+
+load_dotenv()
+
+# Messages that haven't been acknowledged by then are counted as unacknowledged and forgotten
+delivery_ack_timeout_seconds = float(environ.get("DELIVERY_ACK_TIMEOUT_SECONDS", 300))
+
+# Platform timestamps have a 1 second resolution at best, so buckets start there
+delivery_buckets = (0.25, 0.5, 1, 2, 3, 5, 10, 30, 60, 120, 300)
+
+delivery_seconds = histogram(
+    'message_delivery_seconds',
+    'Time from a message being sent to it being acknowledged by the recipient side',
+    ['direction', 'platform', 'operator'],
+    delivery_buckets
+)
+unacknowledged_messages = counter(
+    'message_delivery_unacknowledged_total',
+    'Messages that did not reach the recipient side in time',
+    ['direction', 'platform']
+)
+
+
+class DeliveryTracker:
+    """
+    Keeps user messages that have been pushed to operators until their clients acknowledge them
+    """
+
+    def __init__(self, ack_timeout: float):
+        self.ack_timeout = ack_timeout
+        # message id -> (sent at, pushed at, platform, personnel id)
+        self._pending: dict[int, tuple[float, float, str, str]] = {}
+        # (pushed at, message id). Messages expire ack_timeout after they have been pushed, not after the user sent them,
+        # so that late arrivals, e.g. retried or replayed webhooks, still get their slow acks observed.
+        # Entries of acknowledged messages are left behind and skipped once they come up
+        self._expiry: list[tuple[float, int]] = []
+        self._lock = Lock()
+
+    def expect(self, message_id: int, sent_at: float, platform: str, personnel_id: str) -> None:
+        """
+        A method that starts waiting for an ack of a message pushed to an operator
+        :param message_id: a message id
+        :param sent_at: a unix timestamp of when the user sent the message
+        :param platform: a platform name
+        :param personnel_id: an id of the operator the message was pushed to
+        :return: None
+        """
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            self._pending[message_id] = (sent_at, now, platform, personnel_id)
+            heapq.heappush(self._expiry, (now, message_id))
+
+    def ack(self, message_id: int, personnel_id: str) -> float | None:
+        """
+        A method that records that an operator's client has received a message
+        :param message_id: a message id
+        :param personnel_id: an id of the operator who acknowledged it
+        :return: delivery time in seconds or None if the message wasn't expected from this operator
+        """
+        with self._lock:
+            pending = self._pending.get(message_id)
+            if pending is None or pending[3] != personnel_id:
+                return None
+            del self._pending[message_id]
+
+        sent_at, _, platform, _ = pending
+        # Platform clocks may be slightly ahead of ours
+        elapsed = max(time.time() - sent_at, 0)
+        delivery_seconds.observe(elapsed, direction='inbound', platform=platform, operator=personnel_id)
+        return elapsed
+
+    def _expire(self, now: float) -> None:
+        while self._expiry and now - self._expiry[0][0] >= self.ack_timeout:
+            pushed_at, message_id = heapq.heappop(self._expiry)
+            pending = self._pending.get(message_id)
+            if pending is None or pending[1] != pushed_at:
+                continue
+            del self._pending[message_id]
+            unacknowledged_messages.inc(direction='inbound', platform=pending[2])
+
+        if len(self._expiry) > 2 * len(self._pending) + 1000:
+            self._expiry = [(pending[1], message_id) for message_id, pending in self._pending.items()]
+            heapq.heapify(self._expiry)
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+
+def observe_outbound(received_at: float, platform: str, personnel_id: str, delivered: bool) -> None:
+    """
+    A function that records how long an operator's message took to be accepted by a platform API
+    :param received_at: a unix timestamp of when the operator's message has reached the router
+    :param platform: a platform name
+    :param personnel_id: an id of the operator who sent the message
+    :param delivered: whether the platform API has accepted the message
+    :return: None
+    """
+    if not delivered:
+        unacknowledged_messages.inc(direction='outbound', platform=platform)
+        return
+    delivery_seconds.observe(time.time() - received_at, direction='outbound', platform=platform, operator=personnel_id)
+
+
+delivery_tracker = DeliveryTracker(delivery_ack_timeout_seconds)
@@ -3,6 +3,7 @@ from typing import Union, List
 
 from src.util import AbcNoPublicConstructor
 from src.attachment import Attachment
+from src.tracing import traced
 
 from abc import abstractmethod
 from fastapi import Request
@@ -69,6 +70,15 @@ class Event(metaclass=AbcNoPublicConstructor):
         """
         raise NotImplementedError("text is a subclass-implemented property")
 
+    @property
+    @abstractmethod
+    def timestamp(self) -> float:
+        """
+        A property that returns when the platform has received the message
+        :return: a unix timestamp in seconds
+        """
+        raise NotImplementedError("timestamp is a subclass-implemented property")
+
     @property
     @abstractmethod
     def attachments(self) -> List[Attachment]:
@@ -116,7 +126,9 @@ class Event(metaclass=AbcNoPublicConstructor):
         :param request: an incoming request object
         :return: True if request is valid, False otherwise
         """
-        return (await cls.is_request_authentic(request)) and cls.is_json_valid(await request.json())
+        if not await cls.is_request_authentic(request):
+            return None
+        return cls.is_json_valid(await request.json())
 
     @staticmethod
     @abstractmethod
@@ -150,14 +162,16 @@ class Event(metaclass=AbcNoPublicConstructor):
 
 class EventFactory:
     @staticmethod
-    async def create_event(request: Request, is_message_required=True) -> Event:
+    @traced("EventFactory.create_event")
+    async def create_event(request: Request, is_message_required=True, messenger: type[Event] = None) -> Event:
         """
         A static method that decides exact class for an event and creates it from json
         :param request: an incoming request object
         :param is_message_required: if True, raises ValueError if message is not present in the request, even if event is valid
+        :param messenger: the only event class to try, if the platform is already known
         :return an event object
         """
-        for messenger in Event.__subclasses__():
+        for messenger in [messenger] if messenger else Event.__subclasses__():
             evt = await messenger.create_if_valid(request)
             if evt is None:
                 continue
@@ -0,0 +1,154 @@
+import logging
+import time
+from collections import OrderedDict
+from os import environ
+from threading import Lock
+
+from dotenv import load_dotenv
+
+from src.background import PeriodicTask
+from src.db.engine import Session
+from src.db.queries import suspend_users
+from src.metrics import counter
+
+load_dotenv()
+
+flood_protection_enabled = environ.get("FLOOD_PROTECTION_ENABLED", "false").lower() == "true"
+flood_rate_per_minute = float(environ.get("FLOOD_RATE_PER_MINUTE", 20))
+flood_burst = int(environ.get("FLOOD_BURST", 10))
+flood_max_tracked_users = int(environ.get("FLOOD_MAX_TRACKED_USERS", 100000))
+# Users who keep flooding are suspended after this many dropped messages in a row, 0 never suspends
+flood_suspend_after_drops = int(environ.get("FLOOD_SUSPEND_AFTER_DROPS", 0))
+flood_suspend_interval_seconds = float(environ.get("FLOOD_SUSPEND_INTERVAL_SECONDS", 10))
+
+dropped_messages = counter('flood_dropped_messages_total', 'User messages dropped by flood protection', ['platform'])
+suspended_users = counter('flood_suspended_users_total', 'Users suspended by flood protection')
+
+# Sent once when a user starts being throttled, the messages that follow are dropped silently
+flood_notice = "Ви надсилаєте повідомлення занадто часто, тому деякі з них не буде доставлено оператору. Будь ласка, зачекайте хвилину."
+
+
+class TokenBucketLimiter:
+    """
+    In-memory token buckets keyed by user id. Buckets of users who haven't written for a while are evicted
+    least recently used first, which only ever makes the limiter more lenient
+    """
+
+    def __init__(self, rate: float, burst: int, max_keys: int):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        # key -> [tokens, last refill time, drops since the last allowed message]
+        self._buckets: OrderedDict[str, list] = OrderedDict()
+        self._lock = Lock()
+
+    def allow(self, key: str, now: float = None) -> tuple[bool, int]:
+        """
+        A method that takes a token from the key's bucket if there is one
+        :param key: a user id
+        :param now: current monotonic time, for tests
+        :return: (whether the message is allowed, number of messages dropped in a row including this one)
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [float(self.burst), now, 0]
+                while len(self._buckets) > self.max_keys:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                bucket[2] = 0
+                return True, 0
+            bucket[2] += 1
+            return False, bucket[2]
+
+    def forget(self, key: str) -> None:
+        with self._lock:
+            self._buckets.pop(key, None)
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+
+class FloodProtection:
+    """
+    Drops messages of users who exceed the rate limit and, optionally, queues persistent offenders for suspension,
+    which is written to the db in batches rather than on the webhook path.
+    Users are due a notice on the first dropped message of every run of them, so that they know they are throttled
+    """
+
+    def __init__(self, limiter: TokenBucketLimiter, suspend_after_drops: int):
+        self.limiter = limiter
+        self.suspend_after_drops = suspend_after_drops
+        self._pending_suspensions: set[str] = set()
+        self._pending_notices: set[str] = set()
+        self._lock = Lock()
+
+    def allow(self, user_id: str, platform: str) -> bool:
+        """
+        A method that decides whether a user message goes any further
+        :param user_id: a unique user id
+        :param platform: a platform name
+        :return: True if the message should be processed
+        """
+        allowed, drops = self.limiter.allow(user_id)
+        if allowed:
+            return True
+
+        dropped_messages.inc(platform=platform)
+        if drops == 1:
+            with self._lock:
+                self._pending_notices.add(user_id)
+        if self.suspend_after_drops and drops == self.suspend_after_drops:
+            logging.warning(f"User {user_id} has been flooding and will be suspended")
+            with self._lock:
+                self._pending_suspensions.add(user_id)
+        return False
+
+    def take_notice(self, user_id: str) -> bool:
+        """
+        A method that tells whether a user who has just been throttled is yet to be told about it
+        :param user_id: a unique user id
+        :return: True once per run of dropped messages
+        """
+        with self._lock:
+            if user_id not in self._pending_notices:
+                return False
+            self._pending_notices.discard(user_id)
+            return True
+
+    def flush_suspensions(self) -> int:
+        """
+        A method that suspends all users queued for suspension in one statement
+        :return: number of suspended users
+        """
+        with self._lock:
+            user_ids, self._pending_suspensions = list(self._pending_suspensions), set()
+        if not user_ids:
+            return 0
+
+        try:
+            with Session() as session:
+                suspended = suspend_users(session, user_ids)
+        except Exception:
+            with self._lock:
+                self._pending_suspensions.update(user_ids)
+            raise
+
+        for user_id in user_ids:
+            self.limiter.forget(user_id)
+        suspended_users.inc(suspended)
+        return suspended
+
+
+flood_protection = FloodProtection(
+    TokenBucketLimiter(flood_rate_per_minute / 60, flood_burst, flood_max_tracked_users),
+    flood_suspend_after_drops
+)
+flood_suspension_task = PeriodicTask("flood-suspensions", flood_suspend_interval_seconds, flood_protection.flush_suspensions)
@@ -0,0 +1,95 @@
+import asyncio
+import base64
+import json
+from datetime import datetime
+from os import environ
+from typing import AsyncIterator
+
+from dotenv import load_dotenv
+
+from src.db.engine import Session
+from src.db.queries import get_history_page, get_personnel, is_history_visible
+from src.metrics import counter
+
+load_dotenv()
+
+history_page_size = int(environ.get("HISTORY_PAGE_SIZE", 500))
+history_max_limit = int(environ.get("HISTORY_MAX_LIMIT", 5000))
+
+# Personnel with one of these may read the history of any chat, others only of chats they are or were assigned to
+history_permissions = ['history:*', 'history:*:*', '*:*', '*:*:*']
+
+history_messages = counter('history_messages_total', 'Messages streamed by the history API')
+
+
+def encode_cursor(message: dict) -> str:
+    key = f"{message['createdAt'].isoformat()}|{int(message['isArchived'])}|{message['id']}"
+    return base64.urlsafe_b64encode(key.encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, bool, int]:
+    """
+    A function that reads a cursor of a history page
+    :param cursor: a cursor from encode_cursor
+    :return: ("createdAt", "isArchived", "id") of the last message of the page
+    :raises ValueError: if the cursor is malformed
+    """
+    try:
+        created_at, is_archived, message_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return datetime.fromisoformat(created_at), is_archived == '1', int(message_id)
+    except (ValueError, UnicodeDecodeError):
+        raise ValueError("Invalid cursor")
+
+
+def serialize_message(message: dict) -> dict:
+    return {
+        'id': message['id'],
+        'chatId': message['chatId'],
+        'text': message['text'],
+        'createdAt': message['createdAt'].timestamp(),
+        'isFromUser': message['isFromUser'],
+        'isArchived': message['isArchived'],
+    }
+
+
+def can_read_history(personnel_id: str, chat_id: int | None, user_id: str | None, archived_chat_id: int | None) -> bool:
+    with Session() as session:
+        return bool(get_personnel(session, [personnel_id], history_permissions)) or \
+            is_history_visible(session, personnel_id, chat_id, user_id, archived_chat_id)
+
+
+def fetch_history_page(chat_id: int | None, user_id: str | None, before: tuple | None, limit: int,
+                       archived_chat_id: int | None = None) -> list[dict]:
+    with Session() as session:
+        return get_history_page(session, chat_id, user_id, before, limit, archived_chat_id)
+
+
+async def stream_history(chat_id: int | None, user_id: str | None, cursor: str | None, limit: int,
+                         archived_chat_id: int | None = None) -> AsyncIterator[str]:
+    """
+    A function that streams history newest first as newline-delimited JSON, reading it in keyset pages.
+    Every message is a line of its own, the last line is {"nextCursor": ...}, which is null at the start of history
+    :param chat_id: a live chat id or None to read a user's or an archived chat's history
+    :param user_id: a unique user id, used if chat_id is None
+    :param cursor: nextCursor of the previous response or None to start from the newest message
+    :param limit: max number of messages
+    :param archived_chat_id: an archived chat id, used if both chat_id and user_id are None
+    :return: lines of the response
+    """
+    before = decode_cursor(cursor) if cursor else None
+    next_cursor = None
+    remaining = limit
+    while remaining > 0:
+        page_size = min(history_page_size, remaining)
+        messages = await asyncio.to_thread(fetch_history_page, chat_id, user_id, before, page_size, archived_chat_id)
+        if messages:
+            yield ''.join(json.dumps(serialize_message(message), ensure_ascii=False) + '\n' for message in messages)
+            history_messages.inc(len(messages))
+            last = messages[-1]
+            before = (last['createdAt'], last['isArchived'], last['id'])
+            next_cursor = encode_cursor(last)
+        remaining -= len(messages)
+        if len(messages) < page_size:
+            next_cursor = None
+            break
+    yield json.dumps({'nextCursor': next_cursor}) + '\n'
@@ -1,20 +1,48 @@
+import asyncio
+import hmac
 import json
 import logging
+import time
+from contextlib import asynccontextmanager
 from os import environ
 
 from sqlalchemy import select
-from sqlalchemy import text
 from starlette.websockets import WebSocketDisconnect
-from fastapi import FastAPI, HTTPException, Query, Request, WebSocket
-
-from src.api import send_message
-from src.db.engine import Session
+from fastapi import Depends, FastAPI, Header, HTTPException, Query, Request, Response, WebSocket
+from fastapi.responses import PlainTextResponse, StreamingResponse
+
+from src.admission import (AdmissionRejected, as_request, spill_queue, webhook_admission,
+                           webhook_retry_after_seconds, webhook_spill_replay_batch_size,
+                           webhook_spill_replay_interval_seconds)
+from src.api import is_delivered, parked_messages_task, platform_apis, run_in_platform_executor, send_message_async
+from src.archiver import archiver_enabled, archiver_task
+from src.background import PeriodicTask
+from src.broadcast import (BroadcastRequest, broadcast_claim_task, broadcast_permissions, broadcast_platforms,
+                           broadcast_report, broadcaster, create_job, load_job)
+from src.catch_up import catch_up_frame_size, send_catch_up, send_missed_messages, serialize_chat, serialize_message
+from src.db.engine import Session, bootstrap
+from src.db.partitions import partitioning_enabled, partition_maintenance_task
 from src.db.models.chat import Chat
 from src.db.models.message import Message
 from src.db.models.user import User
-from src.db.queries import get_personnel, get_acquainted_chat, unarchive_chat, get_user_email, get_least_busy_personnel_id
-from src.event import EventFactory
+from src.delivery import delivery_tracker, observe_outbound
+from src.db.queries import (get_personnel, reactivate_acquainted_chat, get_user_affinity, get_user_email,
+                            get_personnel_id_by_session_token)
+from src.history import can_read_history, decode_cursor, fetch_history_page, history_max_limit, stream_history
+from src.flood import (flood_notice, flood_protection, flood_protection_enabled, flood_suspend_after_drops,
+                       flood_suspension_task)
+from src.metrics import registry as metrics_registry, counter, gauge, webhook_stage_seconds
+from src.normalized_event import NormalizedEvent, decode_event
+from src.platforms.telegram.polling import create_poller, telegram_polling_enabled
+from src.prefilter import (classify_event, create_normalized_event, detect_platform, handle_non_message_event,
+                           is_authentic, prefiltered_events, read_receipts_task)
+from src.presence import (parse_busyness, presence, presence_flush_task, presence_reap_interval_seconds,
+                          reaped_connections, stale_operators)
+from src.profiler import ProfilerBusyError, profiler, profiler_max_seconds, profiling_token
+from src.stats_snapshot import personnel_stats_snapshot, snapshot_enabled, snapshot_task
+from src.tracing import find_traces, get_trace_id, start_trace, trace_id_header
 from src.webhooks import init as webhooks_init
+from src.waiting_room import WaitingChat, waiting_room, waiting_room_drain_interval_seconds
 from src.websocket_manager import WebSocketManager
 from src.util import no_personnel_error, choose_personnel, send_missed_a_message_email
 
@@ -23,19 +51,202 @@ from src import platforms
 
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
-app = FastAPI()
 
 webhook_path = environ["WEBHOOK_PATH"]
 
 
 ws_manager = WebSocketManager()
 
+webhook_requests = counter('webhook_requests_total', 'Webhook requests by how they ended', ['outcome'])
+webhooks_in_flight = gauge('webhooks_in_flight', 'Webhook requests that are being processed right now')
+connected_operators = gauge('connected_operators', 'Operators with an open websocket')
+connected_operators.set_function(lambda: len(ws_manager.clients))
+stale_operators.set_function(lambda: len(ws_manager.clients) - len(presence.alive(ws_manager.get_client_ids())))
+
+
+def available_personnel_ids() -> list[str]:
+    # Connected operators, except for zombie connections that have stopped sending heartbeats
+    return presence.alive(ws_manager.get_client_ids())
+
+
+async def reap_stale_operators() -> None:
+    """
+    A function that closes websockets of operators who have stopped sending heartbeats
+    :return: None
+    """
+    for personnel_id in ws_manager.get_client_ids():
+        if presence.is_stale(personnel_id):
+            logging.warning(f"Closing a websocket of {personnel_id}, which has stopped sending heartbeats")
+            reaped_connections.inc()
+            presence.forget(personnel_id)
+            await ws_manager.disconnect(personnel_id)
+
+
+presence_reap_task = PeriodicTask("presence-reaper", presence_reap_interval_seconds, reap_stale_operators)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    started_at = time.perf_counter()
+    bootstrap_seconds = await asyncio.to_thread(bootstrap)
+    app.state.startup_seconds = time.perf_counter() - started_at
+    logging.info(f"Started in {app.state.startup_seconds:.3f}s (db bootstrap {bootstrap_seconds:.3f}s)")
+
+    if partitioning_enabled:
+        partition_maintenance_task.start()
+    if archiver_enabled:
+        archiver_task.start()
+    if snapshot_enabled:
+        snapshot_task.start()
+    if spill_queue is not None:
+        spill_replay_task.start()
+    if flood_protection_enabled and flood_suspend_after_drops:
+        flood_suspension_task.start()
+    read_receipts_task.start()
+    parked_messages_task.start()
+    broadcast_claim_task.start()
+    if telegram_polling_enabled:
+        telegram_poller.start()
+    waiting_room_task.start()
+    presence_flush_task.start()
+    presence_reap_task.start()
+
+    yield
+
+    await presence_reap_task.stop()
+    await presence_flush_task.stop()
+    await waiting_room_task.stop()
+    await telegram_poller.stop()
+    await broadcast_claim_task.stop()
+    await broadcaster.stop()
+    await parked_messages_task.stop()
+    await read_receipts_task.stop()
+    await flood_suspension_task.stop()
+    await spill_replay_task.stop()
+    await snapshot_task.stop()
+    await archiver_task.stop()
+    await partition_maintenance_task.stop()
+
+
+app = FastAPI(lifespan=lifespan)
+
 
 @app.get("/")
 async def index():
     return "I'm ok"
 
 
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    return PlainTextResponse(metrics_registry.render(), media_type="text/plain; version=0.0.4")
+
+
+def authenticate_personnel(authorization: str = Header(None)) -> str:
+    """
+    A dependency that resolves a personnel id from an "Authorization: Bearer <session token>" header
+    :param authorization: the header value
+    :return: personnel id
+    """
+    token = authorization.removeprefix("Bearer ").strip() if authorization else None
+    if not token:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+
+    with Session() as session:
+        personnel_id = get_personnel_id_by_session_token(session, token)
+        if not personnel_id or not get_personnel(session, [personnel_id]):
+            raise HTTPException(status_code=401, detail="Unauthorized")
+    return personnel_id
+
+
+@app.get("/personnel/stats")
+async def personnel_stats(personnel_id: str = Depends(authenticate_personnel)):
+    return {
+        "ageSeconds": personnel_stats_snapshot.age() if personnel_stats_snapshot.refreshed_at is not None else None,
+        "personnel": personnel_stats_snapshot.rows,
+    }
+
+
+@app.get("/history")
+async def history(chat_id: int = Query(None, alias="chatId"), user_id: str = Query(None, alias="userId"),
+                  archived_chat_id: int = Query(None, alias="archivedChatId"),
+                  cursor: str = Query(None), limit: int = Query(100, ge=1),
+                  personnel_id: str = Depends(authenticate_personnel)):
+    if [chat_id, user_id, archived_chat_id].count(None) != 2:
+        raise HTTPException(status_code=400, detail="Exactly one of chatId, userId or archivedChatId is required")
+    if cursor:
+        try:
+            decode_cursor(cursor)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    if not await asyncio.to_thread(can_read_history, personnel_id, chat_id, user_id, archived_chat_id):
+        raise HTTPException(status_code=403, detail="Forbidden")
+    return StreamingResponse(stream_history(chat_id, user_id, cursor, min(limit, history_max_limit), archived_chat_id),
+                             media_type="application/x-ndjson")
+
+
+def authorize_broadcast(personnel_id: str = Depends(authenticate_personnel)) -> str:
+    """
+    A dependency that only lets personnel with a broadcast permission through
+    :param personnel_id: an authenticated personnel id
+    :return: personnel id
+    """
+    with Session() as session:
+        if not get_personnel(session, [personnel_id], broadcast_permissions):
+            raise HTTPException(status_code=403, detail="Forbidden")
+    return personnel_id
+
+
+@app.post("/broadcasts", status_code=202)
+async def create_broadcast_job(broadcast: BroadcastRequest, personnel_id: str = Depends(authorize_broadcast)):
+    job_platforms = broadcast.platforms or broadcast_platforms()
+    unsupported = set(job_platforms) - set(platform_apis)
+    if unsupported:
+        raise HTTPException(status_code=400, detail=f"Platforms {', '.join(sorted(unsupported))} are not supported")
+    if 'facebook' in job_platforms and 'facebook' not in broadcast_platforms():
+        raise HTTPException(status_code=400, detail="Facebook only accepts broadcasts with a message tag, "
+                                                    "set FACEBOOK_BROADCAST_MESSAGE_TAG to send them")
+    if not broadcast.text.strip():
+        raise HTTPException(status_code=400, detail="Text is empty")
+
+    job_id = await asyncio.to_thread(create_job, broadcast.text, job_platforms, personnel_id)
+    broadcaster.start(job_id)
+    return {"id": job_id}
+
+
+@app.get("/broadcasts/{job_id}")
+async def broadcast_status(job_id: int, personnel_id: str = Depends(authorize_broadcast)):
+    job = await asyncio.to_thread(load_job, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Not Found")
+    return broadcast_report(job)
+
+
+def authenticate_debug(x_profiling_token: str = Header(None)) -> None:
+    """
+    A dependency that only lets requests with the PROFILING_TOKEN through. The endpoints are hidden if it isn't set
+    :param x_profiling_token: the header value
+    :return: None
+    """
+    if not profiling_token:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not x_profiling_token or not hmac.compare_digest(x_profiling_token, profiling_token):
+        raise HTTPException(status_code=401, detail="Unauthorized")
+
+
+@app.get("/debug/traces", dependencies=[Depends(authenticate_debug)])
+async def debug_traces(trace_id: str = Query(None, alias="traceId"), limit: int = Query(50, ge=1, le=1000)):
+    return find_traces(trace_id, limit)
+
+
+@app.get("/debug/profile", response_class=PlainTextResponse, dependencies=[Depends(authenticate_debug)])
+async def debug_profile(seconds: float = Query(10, gt=0)):
+    try:
+        stacks = await asyncio.to_thread(profiler.profile, min(seconds, profiler_max_seconds))
+    except ProfilerBusyError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return PlainTextResponse(stacks, headers={"Content-Disposition": 'attachment; filename="profile.collapsed"'})
+
+
 @app.get("/init")
 async def webhook_init():
     try:
@@ -45,83 +256,239 @@ async def webhook_init():
         return HTTPException(500, f"Error: {e}")
 
 @app.post(webhook_path)
-async def webhook_callback(request: Request):
+async def webhook_callback(request: Request, response: Response):
+    body = await request.body()
+    platform = detect_platform(request.headers)
+    with webhook_stage_seconds.time(stage='prefilter'):
+        kind, data = classify_event(platform, body)
+    if platform is not None and kind != 'message':
+        await handle_non_message_event(request, platform, kind, data)
+        return "OK"
+
+    # Whatever isn't recognised as a message is most likely junk and the first to go under load
+    sheddable = kind != 'message'
+    try:
+        async with webhook_admission.admit(sheddable):
+            webhooks_in_flight.inc()
+            try:
+                with start_trace('webhook', request.headers.get(trace_id_header)) as trace, webhook_stage_seconds.time(stage='total'):
+                    response.headers[trace_id_header] = trace.trace_id
+                    return await handle_webhook(request, platform, data)
+            finally:
+                webhooks_in_flight.dec()
+    except AdmissionRejected as e:
+        if sheddable:
+            # Not worth a retry, so the platform is told it has been handled
+            return "Shed"
+        if spill_queue is not None:
+            # Only authentic webhooks are written to disk, so that forged traffic can't fill it
+            if not await is_authentic(request, platform):
+                webhook_requests.inc(outcome='invalid')
+                return HTTPException(status_code=400, detail="Unknown request origin")
+            if await asyncio.to_thread(spill_queue.put, body, dict(request.headers)) is not None:
+                return "Spilled"
+            logging.warning(f"{e}, the spill queue is full, asking the platform to retry")
+            return Response(status_code=503, headers={"Retry-After": str(webhook_retry_after_seconds)})
+        logging.warning(f"{e}, asking the platform to retry")
+        return Response(status_code=503, headers={"Retry-After": str(webhook_retry_after_seconds)})
+
+
+async def replay_spilled_webhooks() -> None:
+    """
+    A function that processes webhooks that have been spilled to disk under load, oldest first.
+    It leaves them be while live webhooks are busy enough to be shed
+    :return: None
+    """
+    for name in await asyncio.to_thread(spill_queue.pending, webhook_spill_replay_batch_size):
+        if not webhook_admission.has_spare_capacity():
+            return
+
+        claimed = await asyncio.to_thread(spill_queue.claim, name)
+        if claimed is None:
+            # Another worker is replaying it
+            continue
+
+        body, headers = claimed
+        try:
+            async with webhook_admission.admit():
+                with start_trace('webhook_replay', headers.get(trace_id_header.lower())):
+                    request = as_request(body, headers, webhook_path)
+                    platform = detect_platform(request.headers)
+                    await handle_webhook(request, platform, classify_event(platform, body)[1])
+        except AdmissionRejected:
+            spill_queue.release(name)
+            return
+        except Exception as e:
+            logging.error(f"Unable to replay spilled webhook {name}: {e}")
+            await asyncio.to_thread(spill_queue.fail, name)
+            continue
+        await asyncio.to_thread(spill_queue.remove, name)
+
+
+spill_replay_task = PeriodicTask("webhook-spill-replay", webhook_spill_replay_interval_seconds, replay_spilled_webhooks)
+
+
+async def handle_webhook(request: Request, platform: str | None, data: dict | None):
     try:
-        event = await EventFactory.create_event(request)
+        event = await create_normalized_event(request, platform, data)
     except ValueError as e:
         logging.warning(f"Error: {e}")
+        webhook_requests.inc(outcome='invalid')
         return HTTPException(status_code=400, detail=str(e))
+    return await process_event(event)
+
+
+async def handle_telegram_update(update: dict) -> None:
+    """
+    A function that processes an update received with getUpdates the way a Telegram webhook is processed.
+    Updates come from the Bot API itself, so there is nothing to authenticate
+    :param update: a Telegram update
+    :return: None
+    :raises AdmissionRejected: if the router is too busy, so that the update is polled again later
+    """
+    event = decode_event('telegram', update)
+    if event is None or not event.text:
+        prefiltered_events.inc(platform='telegram', kind='other' if event is None else 'empty')
+        return
+
+    async with webhook_admission.admit():
+        with start_trace('telegram_update'), webhook_stage_seconds.time(stage='total'):
+            await process_event(event)
+
+
+telegram_poller = create_poller(handle_telegram_update)
+
+
+async def process_event(event: NormalizedEvent):
+    user_id = event.user_id
+    if flood_protection_enabled and not flood_protection.allow(user_id, event.platform):
+        if flood_protection.take_notice(user_id):
+            await send_message_async(user_id, flood_notice)
+        # Acknowledged, so that the platform doesn't retry the flood
+        webhook_requests.inc(outcome='flood_dropped')
+        return "OK"
 
-    user_id = event.user_unique_id
     with Session() as session:
-        user: User = session.get(User, user_id)
-        if not user:
-            user = User(
-                id=user_id,
-            )
-            session.add(user)
-            session.commit()
+        with webhook_stage_seconds.time(stage='load_user'):
+            user: User = session.get(User, user_id)
+            if not user:
+                user = User(
+                    id=user_id,
+                )
+                session.add(user)
+                session.commit()
 
         if user.suspended:
-            event.send_message("Ви були заблоковані. Якщо вважаєте, що це помилка - зверніться на пошту unban@soulful.pp.ua для розблокування.")
+            await send_message_async(user_id, "Ви були заблоковані. Якщо вважаєте, що це помилка - зверніться на пошту unban@soulful.pp.ua для розблокування.")
+            webhook_requests.inc(outcome='suspended')
             return
 
-        chat = session.execute(select(Chat).where(Chat.user_id == user_id)).scalar_one_or_none()
+        with webhook_stage_seconds.time(stage='load_chat'):
+            # Held until the message is stored, so that the archiver can't move the chat away in the meantime
+            chat = session.execute(
+                select(Chat).where(Chat.user_id == user_id).with_for_update(key_share=True)
+            ).scalar_one_or_none()
+        restored = False
         if not chat:
             # The following could be used to continuously verify user access to chat, probably unnecessary
             # personnel = get_personnel(session, personnel_ids)
 
-            if not ws_manager.get_client_ids():
-                no_personnel_error(event, user_id)
+            if not available_personnel_ids():
+                await run_in_platform_executor(event.platform, no_personnel_error, event, user_id)
 
-            acq_chat_id = get_acquainted_chat(session, ws_manager.get_client_ids(), user_id)
+            chat_id = reactivate_acquainted_chat(session, available_personnel_ids(), user_id)
+            restored = chat_id is not None
 
-            if acq_chat_id:
-                chat_id = unarchive_chat(session, acq_chat_id)
-                chat = session.execute(select(Chat).where(Chat.id == chat_id)).scalar_one_or_none()
-                event.send_message("Вітаємо! Ваше попереднє звернення було відновлено. Як ми можемо вам допомогти?")
+            if chat_id:
+                chat = session.execute(select(Chat).where(Chat.id == chat_id).with_for_update(key_share=True)).scalar_one_or_none()
             else:
-                personnel_id = get_least_busy_personnel_id(session, ws_manager.get_client_ids())
-                chat = Chat(
-                    user_id=user_id,
-                    personnel_id=personnel_id,
-                )
-                session.add(chat)
-                session.commit()
+                with webhook_stage_seconds.time(stage='assign_personnel'):
+                    personnel_id = personnel_stats_snapshot.least_busy_personnel_id(session, available_personnel_ids())
+                with webhook_stage_seconds.time(stage='create_chat'):
+                    chat = Chat(
+                        user_id=user_id,
+                        personnel_id=personnel_id,
+                    )
+                    session.add(chat)
+                    session.commit()
                 if personnel_id:
-                    event.send_message("Привіт! Як ми можемо вам допомогти? Оператор незабаром відповість вам.")
-
-        message = Message(
-            text=event.text,
-            is_from_user=True,
-            chat_id=chat.id,
-        )
-        session.add(message)
-        session.commit()
-
-        if chat.personnel_id not in ws_manager.get_client_ids():
-            no_personnel_error(event, user_id, is_assigned=True)
+                    await send_message_async(user_id, "Привіт! Як ми можемо вам допомогти? Оператор незабаром відповість вам.")
+
+        with webhook_stage_seconds.time(stage='store_message'):
+            message = Message(
+                text=event.text,
+                is_from_user=True,
+                chat_id=chat.id,
+            )
+            session.add(message)
+            session.commit()
+
+        # Sent once the message is stored and the chat lock is released, so that a slow platform doesn't hold them
+        if restored:
+            await send_message_async(user_id, "Вітаємо! Ваше попереднє звернення було відновлено. Як ми можемо вам допомогти?")
+
+        if chat.personnel_id is None:
+            # The user has been told there is nobody online, the chat waits for the first operator with room for it
+            if chat.id not in waiting_room:
+                affinity = get_user_affinity(session, user_id)
+                waiting_room.add(chat.id, user_id, chat.created_at.timestamp(), affinity[0] if affinity else None)
+            webhook_requests.inc(outcome='waiting')
+            return "OK"
+
+        if chat.personnel_id not in available_personnel_ids():
+            await run_in_platform_executor(event.platform, no_personnel_error, event, user_id, True)
             if chat.personnel_id:
                 send_missed_a_message_email(get_user_email(session, chat.personnel_id), chat.id)
+            webhook_requests.inc(outcome='operator_offline')
             return
 
         try:
-            await ws_manager.send_json(chat.personnel_id, {
-                'id': message.id,
-                'text': message.text,
-                'createdAt': message.created_at.timestamp(),
-                'chatId': chat.id,
-                'isFromUser': message.is_from_user,
-            })
+            with webhook_stage_seconds.time(stage='websocket_push'):
+                await ws_manager.send_json(chat.personnel_id, {
+                    'id': message.id,
+                    'text': message.text,
+                    'createdAt': message.created_at.timestamp(),
+                    'chatId': chat.id,
+                    'isFromUser': message.is_from_user,
+                    'platformTimestamp': event.timestamp,
+                    'traceId': get_trace_id(),
+                })
+            delivery_tracker.expect(message.id, event.timestamp, event.platform, chat.personnel_id)
         except Exception as e:
             if e == WebSocketDisconnect:
                 await ws_manager.disconnect(chat.personnel_id)
 
             logging.error(f"Unable to reach an operator who was previously connected: {e}")
 
+    webhook_requests.inc(outcome='delivered')
     return "OK"
 
 
+async def announce_assignment(chat: dict, waiting: WaitingChat) -> None:
+    """
+    A function that hands a chat from the waiting room to its operator, with the messages it has got so far,
+    and lets the user know
+    :param chat: the assigned chat
+    :param waiting: the chat as it has been waiting
+    :return: None
+    """
+    messages = await asyncio.to_thread(fetch_history_page, chat['id'], None, None, catch_up_frame_size)
+    await ws_manager.send_json(chat['personnelId'], {
+        'type': 'assigned',
+        'chat': serialize_chat(chat),
+        'messages': [serialize_message(message) for message in reversed(messages)],
+    })
+    await send_message_async(chat['userId'], "Оператор приєднався до чату та незабаром відповість вам.")
+
+
+async def drain_waiting_room() -> None:
+    await waiting_room.drain(available_personnel_ids())
+
+
+waiting_room.announce = announce_assignment
+waiting_room_task = PeriodicTask("waiting-room", waiting_room_drain_interval_seconds, drain_waiting_room)
+
+
 # Following code must be moved or removed
 facebook_verification_token = environ["FACEBOOK_VERIFICATION_TOKEN"]
 
@@ -136,16 +503,31 @@ async def facebook_subscribe(mode: str = Query(None, alias="hub.mode"),
 
 
 @app.websocket("/ws/{personnel_token}")
-async def websocket_endpoint(websocket: WebSocket, personnel_token: str):
+async def websocket_endpoint(websocket: WebSocket, personnel_token: str,
+                             last_message_id: int = Query(None, alias="lastMessageId")):
     with Session() as session:
-        personnel_id = session.execute(text("SELECT user_id FROM \"Session\" WHERE session_token = :token"), {'token': personnel_token}).scalars().one_or_none()
+        personnel_id = get_personnel_id_by_session_token(session, personnel_token)
 
         user = get_personnel(session, [personnel_id])
 
     if not personnel_id or not user:
         return HTTPException(status_code=401, detail="Unauthorized")
 
-    await ws_manager.connect(personnel_id, websocket)
+    # Open chats and missed messages go first, then live delivery starts and a final pass picks up
+    # whatever has been stored in the meantime. A message may come twice, so clients dedupe by id
+    await websocket.accept()
+    # Heartbeats of a previous connection say nothing about this one
+    presence.forget(personnel_id)
+    after, truncated = await send_catch_up(websocket, personnel_id, last_message_id)
+    await ws_manager.register(personnel_id, websocket)
+    if last_message_id is not None and not truncated:
+        after, truncated = await send_missed_messages(websocket, personnel_id, after, catch_up_frame_size)
+    await ws_manager.send_json(personnel_id, {'type': 'synced', 'lastMessageId': after, 'truncated': truncated})
+
+    try:
+        await drain_waiting_room()
+    except Exception as e:
+        logging.error(f"Unable to drain the waiting room: {e}")
 
     while ws_manager.get_client(personnel_id):
         data = await ws_manager.receive_text(personnel_id)
@@ -155,7 +537,19 @@ async def websocket_endpoint(websocket: WebSocket, personnel_token: str):
 
         data = json.loads(data)
 
-        with Session() as session:
+        # Operator clients acknowledge every user message they have received with {"type": "ack", "id": <message id>}
+        if data.get('type') == 'ack':
+            delivery_tracker.ack(data['id'], personnel_id)
+            continue
+
+        # Operator clients send {"type": "heartbeat"} every few seconds, optionally with their "busyness"
+        if data.get('type') == 'heartbeat':
+            presence.beat(personnel_id, parse_busyness(data.get('busyness')))
+            continue
+
+        received_at = time.time()
+        # Operator clients echo the traceId of the message they reply to, which ties the reply to the webhook
+        with start_trace('operator_message', data.get('traceId')) as trace, Session() as session:
             message = Message(
                 text=data['text'],
                 chat_id=data['chatId'],
@@ -164,7 +558,9 @@ async def websocket_endpoint(websocket: WebSocket, personnel_token: str):
             session.add(message)
             session.commit()
 
-            send_message(data['userId'], data['text'])
+            resp = await send_message_async(data['userId'], data['text'])
+            platform = data['userId'].split('_')[0]
+            observe_outbound(received_at, platform, personnel_id, resp is not None and is_delivered(platform, resp))
 
             await ws_manager.send_json(personnel_id, {
                 'id': message.id,
@@ -172,4 +568,5 @@ async def websocket_endpoint(websocket: WebSocket, personnel_token: str):
                 'createdAt': message.created_at.timestamp(),
                 'chatId': message.chat_id,
                 'isFromUser': message.is_from_user,
+                'traceId': trace.trace_id,
             })
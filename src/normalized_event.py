@@ -0,0 +1,133 @@
+from dataclasses import dataclass
+from os import path
+
+from src.api import send_message
+from src.attachment import AttachmentType
+from src.tracing import traced
+
+
+@dataclass(frozen=True, slots=True)
+class AttachmentRef:
+    """
+    What is needed to download an attachment later. Nothing is fetched while decoding
+    """
+    type: str
+    # A url, or a Telegram file id that still has to be resolved with getFile
+    reference: str
+    name: str = ''
+    extension: str = ''
+
+
+@dataclass(frozen=True, slots=True)
+class NormalizedEvent:
+    """
+    A platform independent user message, decoded once per webhook. Small, immutable and picklable,
+    so that it can be queued, batched and kept in memory in large numbers
+    """
+    platform: str
+    chat_id: str
+    user_id: str
+    text: str
+    message_id: str
+    timestamp: float
+    attachments: tuple[AttachmentRef, ...] = ()
+
+    def send_message(self, text: str) -> None:
+        """
+        A method that sends given message to the chat in the messenger the event was received from
+        :param text: a message to send
+        :return: None
+        """
+        send_message(self.user_id, text)
+
+
+def split_file_name(file_name: str) -> tuple[str, str]:
+    return path.splitext(file_name.split('/')[-1].split('?')[0])
+
+
+def decode_telegram(data: dict) -> NormalizedEvent:
+    message = data['message']
+    chat_id = str(message['chat']['id'])
+    attachments = ()
+    if message.get('photo'):
+        # Telegram sends every size of a photo, the last one is the largest
+        attachments = (AttachmentRef(AttachmentType.Image.value, message['photo'][-1]['file_id']),)
+    return NormalizedEvent(
+        platform='telegram',
+        chat_id=chat_id,
+        user_id=f'telegram_{chat_id}',
+        text=message.get('text') or message.get('caption') or '',
+        message_id=str(message['message_id']),
+        timestamp=message['date'],
+        attachments=attachments,
+    )
+
+
+# Viber has picture instead of image
+viber_attachment_types = {'picture': AttachmentType.Image.value}
+
+
+def decode_viber(data: dict) -> NormalizedEvent:
+    message = data['message']
+    chat_id = data['sender']['id']
+    attachments = ()
+    if message.get('file_name') or message.get('media'):
+        attachment_type = viber_attachment_types.get(message['type'], message['type'])
+        if attachment_type in AttachmentType._value2member_map_:
+            name, extension = split_file_name(message.get('file_name') or message['media'])
+            attachments = (AttachmentRef(attachment_type, message['media'], name, extension),)
+    return NormalizedEvent(
+        platform='viber',
+        chat_id=chat_id,
+        user_id=f'viber_{chat_id}',
+        text=message.get('text') or '',
+        message_id=str(data['message_token']),
+        # Viber timestamps are in milliseconds
+        timestamp=data['timestamp'] / 1000,
+        attachments=attachments,
+    )
+
+
+def decode_facebook(data: dict) -> NormalizedEvent:
+    item = data['entry'][0]['messaging'][0]
+    message = item['message']
+    chat_id = item['sender']['id']
+    attachments = tuple(
+        AttachmentRef(attachment['type'], attachment['payload']['url'], *split_file_name(attachment['payload']['url']))
+        for attachment in message.get('attachments') or ()
+        if attachment['type'] in AttachmentType._value2member_map_
+    )
+    return NormalizedEvent(
+        platform='facebook',
+        chat_id=chat_id,
+        user_id=f'facebook_{chat_id}',
+        text=message.get('text') or '',
+        message_id=message['mid'],
+        # Facebook timestamps are in milliseconds
+        timestamp=item['timestamp'] / 1000,
+        attachments=attachments,
+    )
+
+
+decoders = {
+    'telegram': decode_telegram,
+    'viber': decode_viber,
+    'facebook': decode_facebook,
+}
+
+
+@traced("decode_event")
+def decode_event(platform: str, data: dict) -> NormalizedEvent | None:
+    """
+    A function that picks what the router needs out of an already parsed webhook body
+    :param platform: a platform name
+    :param data: a parsed request body
+    :return: a normalized event or None if the body is not a valid message of the platform
+    """
+    decoder = decoders.get(platform)
+    if decoder is None:
+        return None
+    try:
+        return decoder(data)
+    except (KeyError, IndexError, TypeError, AttributeError):
+        return None
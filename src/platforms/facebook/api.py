@@ -1,21 +1,55 @@
 import requests
 from os import environ
+from dotenv import load_dotenv
 
+from src.breaker import platform_max_timeout_seconds
+from src.metrics import platform_send_seconds, timed
+from src.platforms.facebook.batch import (FacebookBatchSender, facebook_batch_enabled, facebook_batch_item_retries,
+                                          facebook_batch_linger_seconds, facebook_batch_max_size, messaging_type)
+
+load_dotenv()
+
+# Overridable to point the router at a local stand-in, e.g. for benchmarks
+facebook_graph_url = environ.get('FACEBOOK_GRAPH_URL', 'https://graph.facebook.com')
+
+batch_sender: FacebookBatchSender | None = None
+
+
+def get_batch_sender() -> FacebookBatchSender:
+    global batch_sender
+    if batch_sender is None:
+        page_id, page_token, api_version = environ['FACEBOOK_PAGE_ID'], environ['FACEBOOK_PAGE_TOKEN'], \
+            environ['FACEBOOK_API_VERSION']
+        batch_sender = FacebookBatchSender(f'{facebook_graph_url}/v{api_version}/', page_id, page_token,
+                                           facebook_batch_linger_seconds, facebook_batch_max_size,
+                                           facebook_batch_item_retries)
+    return batch_sender
+
+
+@timed(platform_send_seconds, platform='facebook')
+def send_message(chat_id, text: str, timeout: float = platform_max_timeout_seconds, tag: str | None = None):
+    if facebook_batch_enabled:
+        return get_batch_sender().send(chat_id, text, timeout, tag)
 
-def send_message(chat_id, text: str):
     page_id, page_token, api_version = environ['FACEBOOK_PAGE_ID'], environ['FACEBOOK_PAGE_TOKEN'], \
         environ['FACEBOOK_API_VERSION']
-    send_message_url = f'https://graph.facebook.com/v{api_version}/{page_id}/messages?access_token={page_token}'
+    send_message_url = f'{facebook_graph_url}/v{api_version}/{page_id}/messages?access_token={page_token}'
     resp = requests.post(send_message_url,
                          json={
                              "recipient": {
                                  "id": chat_id
                              },
-                             "messaging_type": "RESPONSE",
                              "message": {
                                  "text": text
-                             }
+                             },
+                             **messaging_type(tag),
                          },
+                         timeout=timeout,
                          headers={
                              'Content-Type': 'application/json',
                          })
+    return resp
+
+
+def is_delivered(resp: requests.Response) -> bool:
+    return resp.ok
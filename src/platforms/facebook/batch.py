@@ -0,0 +1,207 @@
+import json
+import logging
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from dataclasses import dataclass, field
+from os import environ
+from urllib.parse import urlencode
+
+import requests
+from dotenv import load_dotenv
+
+from src.metrics import counter, histogram
+
+load_dotenv()
+
+facebook_batch_enabled = environ.get("FACEBOOK_BATCH_ENABLED", "false").lower() == "true"
+facebook_batch_linger_seconds = float(environ.get("FACEBOOK_BATCH_LINGER_MS", 20)) / 1000
+# Graph API accepts at most 50 requests in a batch
+facebook_batch_max_size = min(int(environ.get("FACEBOOK_BATCH_MAX_SIZE", 50)), 50)
+facebook_batch_item_retries = int(environ.get("FACEBOOK_BATCH_ITEM_RETRIES", 2))
+
+batch_sizes = histogram('facebook_batch_size', 'Messages per Graph API batch request', buckets=(1, 2, 5, 10, 20, 30, 40, 50))
+batch_item_retries = counter('facebook_batch_item_retries_total', 'Batch items that failed on their own and have been retried')
+
+
+def messaging_type(tag: str | None) -> dict:
+    # Messages outside of the 24-hour window after the user's last message are only accepted with a message tag
+    return {'messaging_type': 'MESSAGE_TAG', 'tag': tag} if tag else {'messaging_type': 'RESPONSE'}
+
+
+class BatchItemResponse:
+    """
+    Result of a single request of a batch, which quacks like the requests.Response of a standalone request
+    """
+
+    def __init__(self, status_code: int, text: str):
+        self.status_code = status_code
+        self.text = text
+
+    @property
+    def ok(self) -> bool:
+        return 200 <= self.status_code < 400
+
+    def json(self):
+        return json.loads(self.text)
+
+
+@dataclass
+class BatchItem:
+    chat_id: str
+    text: str
+    timeout: float
+    tag: str | None = None
+    future: Future = field(default_factory=Future)
+    attempts: int = 0
+    # Set once the caller has stopped waiting for an item that is already in flight, so that it isn't retried
+    abandoned: bool = False
+
+    def as_request(self, page_id: str) -> dict:
+        return {
+            'method': 'POST',
+            'relative_url': f'{page_id}/messages',
+            'body': urlencode({
+                'recipient': json.dumps({'id': self.chat_id}),
+                'message': json.dumps({'text': self.text}),
+                **messaging_type(self.tag),
+            }),
+        }
+
+
+class FacebookBatchSender:
+    """
+    Groups messages that are sent at about the same time into Graph API batch requests.
+    Callers block until their own message has been sent, so that it behaves like a standalone request to them.
+    Batches are sent one at a time by a single background thread. Graph runs requests of a batch in parallel,
+    so a batch holds at most one message per recipient and later messages to the same recipient wait for the next one
+    """
+
+    def __init__(self, url: str, page_id: str, page_token: str, linger: float, max_size: int, item_retries: int):
+        self.url = url
+        self.page_id = page_id
+        self.page_token = page_token
+        self.linger = linger
+        self.max_size = max_size
+        self.item_retries = item_retries
+        self._queue: queue.Queue[BatchItem] = queue.Queue()
+        # Messages taken from the queue that haven't made it into a batch yet or are to be retried, in order.
+        # Only touched by the background thread
+        self._backlog: deque[BatchItem] = deque()
+        self._thread: threading.Thread | None = None
+        self._lock = threading.Lock()
+
+    def send(self, chat_id: str, text: str, timeout: float, tag: str | None = None) -> BatchItemResponse:
+        """
+        A method that sends a message as a part of the next batch
+        :param chat_id: a chat id
+        :param text: a text to send
+        :param timeout: how long a batch request may take
+        :param tag: a message tag for messages outside of the 24-hour window
+        :return: the result of the message's own request
+        """
+        self._ensure_started()
+        item = BatchItem(chat_id, text, timeout, tag)
+        self._queue.put(item)
+        try:
+            return item.future.result(timeout=(self.linger + timeout) * (self.item_retries + 1))
+        except FutureTimeoutError:
+            if item.future.cancel():
+                # The message has never left the queue, so it is safe to send it again
+                raise requests.ConnectTimeout("Facebook batch request timed out before the message was sent")
+            item.abandoned = True
+            raise requests.Timeout("Facebook batch request timed out")
+
+    def _ensure_started(self) -> None:
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='facebook-batch', daemon=True)
+                self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            if not self._backlog:
+                self._backlog.append(self._queue.get())
+            deadline = time.monotonic() + self.linger
+            while len(self._backlog) < self.max_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    self._backlog.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            batch = self.take_batch()
+            if not batch:
+                continue
+            try:
+                self.send_batch(batch)
+            except Exception as e:
+                logging.error(f"Facebook batch failed: {e}")
+                for item in batch:
+                    if not item.future.done():
+                        item.future.set_exception(e)
+
+    def take_batch(self) -> list[BatchItem]:
+        """
+        A method that takes the oldest message of every recipient from the backlog, up to max_size messages.
+        Messages whose callers have given up before they were sent are dropped
+        :return: messages to send in one request
+        """
+        batch, held, recipients = [], deque(), set()
+        for item in self._backlog:
+            if item.abandoned or item.future.cancelled():
+                continue
+            if len(batch) >= self.max_size or item.chat_id in recipients:
+                held.append(item)
+            elif item.future.running() or item.future.set_running_or_notify_cancel():
+                batch.append(item)
+            recipients.add(item.chat_id)
+        self._backlog = held
+        return batch
+
+    def send_batch(self, batch: list[BatchItem]) -> None:
+        """
+        A method that sends messages in one request and resolves each message with its own result.
+        Messages that failed on their own are put back in front of the backlog, if they have retries left
+        :param batch: up to max_size messages
+        :return: None
+        """
+        batch_sizes.observe(len(batch))
+        try:
+            resp = requests.post(self.url,
+                                 data={
+                                     'access_token': self.page_token,
+                                     'batch': json.dumps([item.as_request(self.page_id) for item in batch]),
+                                 },
+                                 timeout=max(item.timeout for item in batch))
+        except requests.RequestException as e:
+            for item in batch:
+                item.future.set_exception(e)
+            return
+
+        if not resp.ok:
+            # The batch as a whole has been rejected, e.g. because the API is down
+            for item in batch:
+                item.future.set_result(BatchItemResponse(resp.status_code, resp.text))
+            return
+
+        results = resp.json()
+        # A missing result means that Graph ran out of time before getting to the request
+        results += [None] * (len(batch) - len(results))
+        retried = []
+        for item, result in zip(batch, results):
+            failed = result is None or result['code'] >= 500
+            if failed and item.attempts < self.item_retries and not item.abandoned:
+                item.attempts += 1
+                batch_item_retries.inc()
+                retried.append(item)
+                continue
+            if result is None:
+                item.future.set_result(BatchItemResponse(504, ''))
+            else:
+                item.future.set_result(BatchItemResponse(result['code'], result.get('body') or ''))
+        # Ahead of later messages to the same recipients
+        self._backlog.extendleft(reversed(retried))
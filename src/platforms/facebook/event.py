@@ -33,6 +33,11 @@ class FacebookEvent(Event):
     def text(self) -> str:
         return self.original.entry[0].messaging[0].message.text
 
+    @property
+    def timestamp(self) -> float:
+        # Facebook timestamps are in milliseconds
+        return self.original.entry[0].messaging[0].timestamp / 1000
+
     def _get_attachments(self) -> List[Attachment]:
         attachments = []
         original_attachments = self.original.entry[0].messaging[0].message.attachments
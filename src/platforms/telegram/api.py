@@ -1,15 +1,31 @@
 import requests
 from os import environ
+from dotenv import load_dotenv
 
+from src.breaker import platform_max_timeout_seconds
+from src.metrics import platform_send_seconds, timed
 
-def send_message(chat_id, text: str):
+load_dotenv()
+
+# Overridable to point the router at a local stand-in, e.g. for benchmarks
+telegram_api_url = environ.get('TELEGRAM_API_URL', 'https://api.telegram.org')
+
+
+@timed(platform_send_seconds, platform='telegram')
+def send_message(chat_id, text: str, timeout: float = platform_max_timeout_seconds):
     token = environ['TELEGRAM_TOKEN']
-    send_message_url = f'https://api.telegram.org/bot{token}/sendMessage'
+    send_message_url = f'{telegram_api_url}/bot{token}/sendMessage'
     resp = requests.post(send_message_url,
                          json={
                              'chat_id': chat_id,
                              'text': text,
                          },
+                         timeout=timeout,
                          headers={
                              'Content-Type': 'application/json',
                          })
+    return resp
+
+
+def is_delivered(resp: requests.Response) -> bool:
+    return resp.ok and resp.json().get('ok', False)
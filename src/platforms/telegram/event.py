@@ -4,6 +4,7 @@ from starlette.requests import Request
 
 from src.attachment import Attachment, AttachmentType
 from src.platforms.telegram import api
+from src.platforms.telegram.api import telegram_api_url
 from src.platforms.telegram.model import Model
 from src.event import Event
 
@@ -28,6 +29,10 @@ class TelegramEvent(Event):
     def text(self) -> str:
         return self.original.message.text
 
+    @property
+    def timestamp(self) -> float:
+        return self.original.message.date
+
     def _get_attachments(self) -> list:
         attachments = []
 
@@ -35,7 +40,7 @@ class TelegramEvent(Event):
             return attachments
 
         file_id = self.original.message.photo[-1].file_id
-        file_url = f"https://api.telegram.org/bot{telegram_token}/getFile?file_id={file_id}"
+        file_url = f"{telegram_api_url}/bot{telegram_token}/getFile?file_id={file_id}"
         response_json = requests.get(file_url).json()
         if not response_json["ok"]:
             raise ValueError('Error getting file path')
@@ -46,7 +51,7 @@ class TelegramEvent(Event):
                 name=file_name[0],
                 extension=file_name[-1],
                 type_=AttachmentType.Image,
-                url=f"https://api.telegram.org/file/bot{telegram_token}/{file_path}"
+                url=f"{telegram_api_url}/file/bot{telegram_token}/{file_path}"
             )
         )
         return attachments
@@ -0,0 +1,181 @@
+import asyncio
+import json
+import logging
+from collections import defaultdict
+from os import environ
+from typing import Awaitable, Callable
+
+import aiohttp
+from dotenv import load_dotenv
+
+from src.admission import AdmissionRejected
+from src.metrics import counter, histogram
+from src.platforms.telegram.api import telegram_api_url
+
+load_dotenv()
+
+# Ingests Telegram updates with getUpdates instead of a webhook, e.g. to run the router without a public endpoint
+telegram_polling_enabled = environ.get("TELEGRAM_POLLING_ENABLED", "false").lower() == "true"
+# Bot API returns at most 100 updates at a time
+telegram_polling_limit = min(int(environ.get("TELEGRAM_POLLING_LIMIT", 100)), 100)
+telegram_polling_timeout_seconds = int(environ.get("TELEGRAM_POLLING_TIMEOUT_SECONDS", 30))
+telegram_polling_retry_seconds = float(environ.get("TELEGRAM_POLLING_RETRY_SECONDS", 5))
+# An update that fails this many times is logged and skipped, so that it doesn't hold its chat up forever
+telegram_polling_max_attempts = int(environ.get("TELEGRAM_POLLING_MAX_ATTEMPTS", 5))
+
+polled_updates = counter('telegram_polled_updates_total', 'Telegram updates received with getUpdates by how they ended', ['outcome'])
+polled_batch_sizes = histogram('telegram_polled_batch_size', 'Updates per getUpdates response', buckets=(0, 1, 5, 10, 25, 50, 100))
+
+
+def update_chat_id(update: dict):
+    message = update.get('message')
+    return message['chat']['id'] if isinstance(message, dict) and 'chat' in message else None
+
+
+class TelegramPoller:
+    """
+    Long-polls getUpdates and hands every batch of updates to `handle`. Updates of a chat are handled in order,
+    different chats concurrently. Bot API forgets updates once getUpdates is called with a greater offset,
+    so the offset is only moved past updates that have been handled, and the batch is retried otherwise.
+    Updates that have already been handled come again with the retried batch and are skipped
+    """
+
+    def __init__(self, url: str, token: str, limit: int, timeout: int, retry_seconds: float,
+                 handle: Callable[[dict], Awaitable[None]], max_attempts: int = telegram_polling_max_attempts):
+        self.url = f'{url}/bot{token}'
+        self.limit = limit
+        self.timeout = timeout
+        self.retry_seconds = retry_seconds
+        self.handle = handle
+        self.max_attempts = max_attempts
+        self.offset: int | None = None
+        # Update ids at or past the offset that have been handled or given up on
+        self._handled: set[int] = set()
+        # update id -> number of times handling it has failed
+        self._failures: dict[int, int] = {}
+        self._task: asyncio.Task | None = None
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self.run(), name='telegram-polling')
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def run(self) -> None:
+        async with aiohttp.ClientSession() as session:
+            webhook_deleted = False
+            try:
+                while True:
+                    try:
+                        if not webhook_deleted:
+                            # getUpdates is refused while a webhook is set
+                            await self.call(session, 'deleteWebhook', {})
+                            webhook_deleted = True
+                        if not await self.poll_once(session):
+                            await asyncio.sleep(self.retry_seconds)
+                    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                        logging.warning(f"Telegram polling failed: {e}")
+                        await asyncio.sleep(self.retry_seconds)
+            finally:
+                await asyncio.shield(self.commit(session))
+
+    async def call(self, session: aiohttp.ClientSession, method: str, params: dict, timeout: float = 10):
+        async with session.post(f'{self.url}/{method}', json=params,
+                                timeout=aiohttp.ClientTimeout(total=timeout)) as resp:
+            body = await resp.json()
+        if not body.get('ok'):
+            raise ValueError(f"Telegram {method} failed: {body.get('description', resp.status)}")
+        return body['result']
+
+    async def poll_once(self, session: aiohttp.ClientSession) -> bool:
+        """
+        A method that fetches a batch of updates and handles it. The offset past the batch is committed
+        by the next getUpdates call
+        :param session: an http session
+        :return: False if some updates have failed and the batch should be retried after a pause
+        """
+        params = {'limit': self.limit, 'timeout': self.timeout, 'allowed_updates': json.dumps(['message'])}
+        if self.offset is not None:
+            params['offset'] = self.offset
+        updates = await self.call(session, 'getUpdates', params, timeout=self.timeout + 10)
+        polled_batch_sizes.observe(len(updates))
+        if not updates:
+            return True
+
+        offset = await self.handle_batch(updates)
+        failed = offset <= updates[-1]['update_id']
+        self.offset = offset
+        return not failed
+
+    async def handle_batch(self, updates: list[dict]) -> int:
+        """
+        A method that handles updates of every chat in order, stopping at the first update of a chat that fails.
+        An update that keeps failing is given up on after max_attempts, unless the router was only too busy for it
+        :param updates: updates ordered by update_id
+        :return: offset of the first update that has to be handled again or past the batch if there is none
+        """
+        by_chat: dict[object, list[dict]] = defaultdict(list)
+        for update in updates:
+            chat_id = update_chat_id(update)
+            by_chat[chat_id if chat_id is not None else ('update', update['update_id'])].append(update)
+
+        async def handle_chat(chat_updates: list[dict]) -> int | None:
+            for update in chat_updates:
+                update_id = update['update_id']
+                if update_id in self._handled:
+                    continue
+                try:
+                    await self.handle(update)
+                except AdmissionRejected as e:
+                    logging.warning(f"Telegram update {update_id} is put off: {e}")
+                    polled_updates.inc(outcome='failed')
+                    return update_id
+                except Exception as e:
+                    attempts = self._failures.get(update_id, 0) + 1
+                    if attempts < self.max_attempts:
+                        self._failures[update_id] = attempts
+                        logging.error(f"Unable to handle Telegram update {update_id}: {e}")
+                        polled_updates.inc(outcome='failed')
+                        return update_id
+                    logging.error(f"Gave up on Telegram update {update_id} after {attempts} attempts: {e}, "
+                                  f"update: {json.dumps(update)}")
+                    polled_updates.inc(outcome='dead_lettered')
+                else:
+                    polled_updates.inc(outcome='handled')
+                self._handled.add(update_id)
+            return None
+
+        failed = [update_id for update_id in await asyncio.gather(*map(handle_chat, by_chat.values()))
+                  if update_id is not None]
+        offset = min(failed) if failed else updates[-1]['update_id'] + 1
+        # Updates before the offset are never delivered again
+        self._handled = {update_id for update_id in self._handled if update_id >= offset}
+        self._failures = {update_id: attempts for update_id, attempts in self._failures.items() if update_id >= offset}
+        return offset
+
+    async def commit(self, session: aiohttp.ClientSession) -> None:
+        """
+        A method that confirms handled updates without waiting for new ones, so that they aren't redelivered
+        after a restart
+        :param session: an http session
+        :return: None
+        """
+        if self.offset is None:
+            return
+        try:
+            await self.call(session, 'getUpdates', {'offset': self.offset, 'limit': 1, 'timeout': 0})
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            logging.warning(f"Unable to commit Telegram offset {self.offset}: {e}")
+
+
+def create_poller(handle: Callable[[dict], Awaitable[None]]) -> TelegramPoller:
+    return TelegramPoller(telegram_api_url, environ['TELEGRAM_TOKEN'], telegram_polling_limit,
+                          telegram_polling_timeout_seconds, telegram_polling_retry_seconds, handle)
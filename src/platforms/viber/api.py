@@ -2,12 +2,22 @@ import os
 
 import requests
 from os import environ
+from dotenv import load_dotenv
 
+from src.breaker import platform_max_timeout_seconds
+from src.metrics import platform_send_seconds, timed
 
-def send_message(chat_id, text: str):
+load_dotenv()
+
+# Overridable to point the router at a local stand-in, e.g. for benchmarks
+viber_api_url = environ.get('VIBER_API_URL', 'https://chatapi.viber.com')
+
+
+@timed(platform_send_seconds, platform='viber')
+def send_message(chat_id, text: str, timeout: float = platform_max_timeout_seconds):
     viber_token, min_api_version = environ['VIBER_TOKEN'], environ['VIBER_MIN_API_VERSION']
 
-    send_message_url = 'https://chatapi.viber.com/pa/send_message'
+    send_message_url = f'{viber_api_url}/pa/send_message'
     resp = requests.post(send_message_url,
                          json={
                              "receiver": chat_id,
@@ -18,7 +28,13 @@ def send_message(chat_id, text: str):
                              "type": "text",
                              "text": text
                          },
+                         timeout=timeout,
                          headers={
                              'Content-Type': 'application/json',
                              'X-Viber-Auth-Token': viber_token
                          })
+    return resp
+
+
+def is_delivered(resp: requests.Response) -> bool:
+    return resp.ok and resp.json().get('status') == 0
@@ -30,6 +30,11 @@ class ViberEvent(Event):
     def text(self) -> str:
         return self.original.message.text
 
+    @property
+    def timestamp(self) -> float:
+        # Viber timestamps are in milliseconds
+        return self.original.timestamp / 1000
+
     def _get_attachments(self) -> List[Attachment]:
         attachments = []
         message = self.original.message
@@ -0,0 +1,197 @@
+import json
+from datetime import datetime, timezone
+from os import environ
+from threading import Lock
+
+from dotenv import load_dotenv
+from fastapi import Request
+from starlette.datastructures import Headers
+
+from src.background import PeriodicTask
+from src.db.engine import Session
+from src.db.queries import mark_chats_seen
+from src.event import Event
+from src.metrics import counter, webhook_stage_seconds
+from src.normalized_event import NormalizedEvent, decode_event
+from src.platforms import FacebookEvent, TelegramEvent, ViberEvent
+from src.tracing import traced
+
+load_dotenv()
+
+read_receipts_flush_interval_seconds = float(environ.get("READ_RECEIPTS_FLUSH_INTERVAL_SECONDS", 5))
+
+# A header that only the respective platform sends, so that a webhook can be routed without trying every Event
+platform_headers = {
+    'viber': 'X-Viber-Content-Signature',
+    'telegram': 'X-Telegram-Bot-Api-Secret-Token',
+    'facebook': 'X-Hub-Signature-256',
+}
+platform_events: dict[str, type[Event]] = {
+    'viber': ViberEvent,
+    'telegram': TelegramEvent,
+    'facebook': FacebookEvent,
+}
+
+prefiltered_events = counter('webhook_prefiltered_total', 'Webhooks by platform and kind of event they carry', ['platform', 'kind'])
+
+
+def detect_platform(headers: Headers) -> str | None:
+    """
+    A function that tells which platform a webhook claims to come from. The claim is not verified
+    :param headers: request headers
+    :return: a platform name or None
+    """
+    for platform, header in platform_headers.items():
+        if header in headers:
+            return platform
+    return None
+
+
+def classify_event(platform: str | None, body: bytes) -> tuple[str, dict | None]:
+    """
+    A function that tells what kind of event a webhook carries without validating it
+    :param platform: a platform name from detect_platform
+    :param body: a raw request body
+    :return: (kind of event, e.g. 'message', 'seen', 'delivery' or 'unknown', parsed body or None)
+    """
+    if platform is None:
+        return 'unknown', None
+    try:
+        data = json.loads(body)
+    except ValueError:
+        return 'unknown', None
+    if not isinstance(data, dict):
+        return 'unknown', None
+
+    match platform:
+        case 'viber':
+            return data.get('event', 'unknown'), data
+        case 'telegram':
+            return 'message' if 'message' in data else 'other', data
+        case 'facebook':
+            items = [item for entry in data.get('entry', []) for item in entry.get('messaging', [])]
+            for kind in ('message', 'read', 'delivery'):
+                if any(kind in item for item in items):
+                    return kind, data
+            return 'other', data
+    return 'unknown', None
+
+
+@traced("authenticate")
+async def is_authentic(request: Request, platform: str) -> bool:
+    """
+    A function that checks the signature or secret token of a webhook against its own platform only
+    :param request: an incoming request object
+    :param platform: a platform name from detect_platform
+    :return: True if the webhook comes from the platform
+    """
+    with webhook_stage_seconds.time(stage='authenticate'):
+        return await platform_events[platform].is_request_authentic(request)
+
+
+async def create_normalized_event(request: Request, platform: str | None, data: dict | None) -> NormalizedEvent:
+    """
+    A function that authenticates a message webhook against its own platform only and decodes it
+    :param request: an incoming request object
+    :param platform: a platform name from detect_platform
+    :param data: a parsed request body from classify_event
+    :return: a normalized event
+    :raises ValueError: if the webhook is not an authentic message with text
+    """
+    if platform is None or data is None:
+        raise ValueError("Unknown request origin")
+
+    if not await is_authentic(request, platform):
+        raise ValueError("Unknown request origin")
+
+    with webhook_stage_seconds.time(stage='validate'):
+        event = decode_event(platform, data)
+    if event is None:
+        raise ValueError(f"Invalid {platform} message")
+    if not event.text:
+        raise ValueError("Message is required")
+    return event
+
+
+class ReadReceipts:
+    """
+    Latest read receipt time per user, written to the db in batches, so that receipts never wait for the db
+    """
+
+    def __init__(self):
+        self._seen_at: dict[str, datetime] = {}
+        self._lock = Lock()
+
+    def record(self, user_id: str, timestamp: float) -> None:
+        seen_at = datetime.fromtimestamp(timestamp, tz=timezone.utc).replace(tzinfo=None)
+        with self._lock:
+            if user_id not in self._seen_at or self._seen_at[user_id] < seen_at:
+                self._seen_at[user_id] = seen_at
+
+    def flush(self) -> int:
+        """
+        A method that writes all buffered receipts in one statement
+        :return: number of updated chats
+        """
+        with self._lock:
+            seen_at, self._seen_at = self._seen_at, {}
+        if not seen_at:
+            return 0
+
+        try:
+            with Session() as session:
+                return mark_chats_seen(session, seen_at)
+        except Exception:
+            for user_id, value in seen_at.items():
+                self.record(user_id, value.replace(tzinfo=timezone.utc).timestamp())
+            raise
+
+    def __len__(self) -> int:
+        return len(self._seen_at)
+
+
+read_receipts = ReadReceipts()
+read_receipts_task = PeriodicTask("read-receipts", read_receipts_flush_interval_seconds, read_receipts.flush)
+
+
+async def handle_viber_seen(request: Request, data: dict) -> None:
+    if await ViberEvent.is_request_authentic(request):
+        # Viber timestamps are in milliseconds
+        read_receipts.record(f"viber_{data['user_id']}", data['timestamp'] / 1000)
+
+
+async def handle_facebook_read(request: Request, data: dict) -> None:
+    if not await FacebookEvent.is_request_authentic(request):
+        return
+    for entry in data['entry']:
+        for item in entry.get('messaging', []):
+            if 'read' in item:
+                # Everything sent before the watermark (in milliseconds) has been read
+                read_receipts.record(f"facebook_{item['sender']['id']}", item['read']['watermark'] / 1000)
+
+
+# Events that aren't listed here and aren't messages are acknowledged without any work,
+# e.g. Viber conversation_started and delivered or Facebook message_deliveries
+event_handlers = {
+    ('viber', 'seen'): handle_viber_seen,
+    ('facebook', 'read'): handle_facebook_read,
+}
+
+
+async def handle_non_message_event(request: Request, platform: str, kind: str, data: dict) -> None:
+    """
+    A function that handles a webhook that carries no user message
+    :param request: an incoming request object
+    :param platform: a platform name
+    :param kind: a kind of event from classify_event
+    :param data: a parsed request body
+    :return: None
+    """
+    prefiltered_events.inc(platform=platform, kind=kind)
+    handler = event_handlers.get((platform, kind))
+    if handler is not None:
+        try:
+            await handler(request, data)
+        except (KeyError, TypeError, ValueError):
+            # A malformed receipt is not worth a retry
+            pass
@@ -0,0 +1,104 @@
+import time
+from datetime import datetime, timezone
+from os import environ
+from threading import Lock
+
+from dotenv import load_dotenv
+
+from src.background import PeriodicTask
+from src.db.engine import Session
+from src.db.queries import record_presence
+from src.metrics import counter, gauge
+
+load_dotenv()
+
+presence_flush_interval_seconds = float(environ.get("PRESENCE_FLUSH_INTERVAL_SECONDS", 5))
+# Operators who have sent a heartbeat are considered gone once they haven't sent one for this long
+presence_timeout_seconds = float(environ.get("PRESENCE_TIMEOUT_SECONDS", 60))
+presence_reap_interval_seconds = float(environ.get("PRESENCE_REAP_INTERVAL_SECONDS", 10))
+# Busyness operators report is clamped to 0..this, so that a client can't push itself out of or into every assignment
+operator_max_busyness = int(environ.get("OPERATOR_MAX_BUSYNESS", 10))
+
+heartbeats_received = counter('operator_heartbeats_total', 'Heartbeats received from operators')
+reaped_connections = counter('operator_reaped_connections_total', 'Operator websockets closed for missing heartbeats')
+stale_operators = gauge('operators_stale', 'Connected operators whose heartbeats have stopped')
+
+
+def parse_busyness(value) -> int | None:
+    """
+    A function that reads busyness reported with a heartbeat
+    :param value: whatever the client has sent
+    :return: busyness clamped to 0..operator_max_busyness or None if it isn't an integer
+    """
+    # JSON true and false come as bools, which are ints to Python
+    if not isinstance(value, int) or isinstance(value, bool):
+        return None
+    return min(max(value, 0), operator_max_busyness)
+
+
+class Presence:
+    """
+    When operators have last been heard from. Heartbeats are kept in memory and written to "User" in batches,
+    so that presence is visible to every worker without a write per heartbeat. Assignment only reads the busyness,
+    "latestStatusConfirmationAt" is recorded for the dashboard and liveness is decided from memory.
+    Connections that have never sent a heartbeat, e.g. of older dashboards, are never considered stale
+    """
+
+    def __init__(self, timeout: float):
+        self.timeout = timeout
+        # personnel id -> monotonic time of the last heartbeat
+        self._last_seen: dict[str, float] = {}
+        # personnel id -> (time of the last heartbeat, busyness it has reported), waiting to be flushed
+        self._pending: dict[str, tuple[datetime, int | None]] = {}
+        self._lock = Lock()
+
+    def beat(self, personnel_id: str, busyness: int | None = None, now: float = None) -> None:
+        now = time.monotonic() if now is None else now
+        seen_at = datetime.now(timezone.utc).replace(tzinfo=None)
+        with self._lock:
+            self._last_seen[personnel_id] = now
+            if busyness is None and personnel_id in self._pending:
+                busyness = self._pending[personnel_id][1]
+            self._pending[personnel_id] = (seen_at, busyness)
+        heartbeats_received.inc()
+
+    def forget(self, personnel_id: str) -> None:
+        with self._lock:
+            self._last_seen.pop(personnel_id, None)
+
+    def is_stale(self, personnel_id: str, now: float = None) -> bool:
+        now = time.monotonic() if now is None else now
+        last_seen = self._last_seen.get(personnel_id)
+        return last_seen is not None and now - last_seen > self.timeout
+
+    def alive(self, personnel_ids: list[str], now: float = None) -> list[str]:
+        """
+        A method that leaves out operators whose connections have stopped sending heartbeats
+        :param personnel_ids: ids of connected personnel
+        :param now: current monotonic time, for tests
+        :return: ids of personnel who can be given chats
+        """
+        return [personnel_id for personnel_id in personnel_ids if not self.is_stale(personnel_id, now)]
+
+    def flush(self) -> int:
+        """
+        A method that writes all heartbeats received since the last flush in one statement
+        :return: number of updated users
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+
+        try:
+            with Session() as session:
+                return record_presence(session, pending)
+        except Exception:
+            with self._lock:
+                for personnel_id, heartbeat in pending.items():
+                    self._pending.setdefault(personnel_id, heartbeat)
+            raise
+
+
+presence = Presence(presence_timeout_seconds)
+presence_flush_task = PeriodicTask("presence-flush", presence_flush_interval_seconds, presence.flush)
@@ -0,0 +1,68 @@
+import sys
+import threading
+import time
+from collections import Counter
+from os import environ
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Empty disables the /debug endpoints
+profiling_token = environ.get("PROFILING_TOKEN", "")
+profiler_interval_seconds = float(environ.get("PROFILER_INTERVAL_MS", 5)) / 1000
+profiler_max_seconds = float(environ.get("PROFILER_MAX_SECONDS", 60))
+
+
+class ProfilerBusyError(Exception):
+    pass
+
+
+class SamplingProfiler:
+    """
+    Periodically samples stacks of all threads but its own and counts them in the collapsed format
+    ("frame;frame;frame count" per line), which flame graph tools accept as is.
+    Only one profile can be taken at a time
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def collapse(frame) -> str:
+        frames = []
+        while frame is not None:
+            code = frame.f_code
+            frames.append(f"{code.co_name} ({code.co_filename}:{code.co_firstlineno})")
+            frame = frame.f_back
+        return ';'.join(reversed(frames))
+
+    def sample(self, stacks: Counter) -> None:
+        own_thread_id = threading.get_ident()
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id != own_thread_id:
+                stacks[self.collapse(frame)] += 1
+
+    def profile(self, seconds: float) -> str:
+        """
+        A method that samples stacks for a given time, blocking the calling thread
+        :param seconds: how long to sample for
+        :return: collapsed stacks, the most frequent first
+        """
+        if not self._lock.acquire(blocking=False):
+            raise ProfilerBusyError("A profile is already being taken")
+
+        try:
+            stacks = Counter()
+            deadline = time.perf_counter() + seconds
+            while time.perf_counter() < deadline:
+                self.sample(stacks)
+                time.sleep(self.interval)
+        finally:
+            self._lock.release()
+
+        return ''.join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+profiler = SamplingProfiler(profiler_interval_seconds)
@@ -0,0 +1,86 @@
+import time
+from os import environ
+from threading import Lock
+
+from dotenv import load_dotenv
+from sqlalchemy.orm import Session
+
+from src.background import PeriodicTask
+from src.db.engine import Session as DBSession
+from src.db.queries import get_personnel_stats, get_least_busy_personnel_id
+from src.metrics import gauge, histogram
+
+load_dotenv()
+
+snapshot_enabled = environ.get("STATS_SNAPSHOT_ENABLED", "true").lower() == "true"
+snapshot_interval_seconds = float(environ.get("STATS_SNAPSHOT_INTERVAL_SECONDS", 10))
+# Past this age the snapshot is considered broken rather than stale and assignments query the db directly
+snapshot_max_age_seconds = float(environ.get("STATS_SNAPSHOT_MAX_AGE_SECONDS", 6 * snapshot_interval_seconds))
+
+snapshot_refresh_seconds = histogram('personnel_stats_refresh_seconds', 'Time spent recomputing the personnel stats snapshot')
+snapshot_age_seconds = gauge('personnel_stats_snapshot_age_seconds', 'Age of the personnel stats snapshot')
+
+
+class PersonnelStatsSnapshot:
+    """
+    The latest result of get_personnel_stats(), replaced as a whole by a background refresh,
+    so that readers never wait for the db and never see a half-updated table.
+    Chats assigned since the refresh are counted on top of it, so that a burst of new chats is spread out
+    instead of going to whoever was the least busy when the snapshot was taken
+    """
+
+    def __init__(self):
+        self.rows: tuple[dict, ...] = ()
+        self.refreshed_at: float | None = None
+        # personnel id -> chats assigned since the rows have been read
+        self._assigned: dict[str, int] = {}
+        self._lock = Lock()
+
+    def refresh(self) -> None:
+        with self._lock:
+            assigned_before = dict(self._assigned)
+        with snapshot_refresh_seconds.time():
+            with DBSession() as session:
+                rows = tuple(get_personnel_stats(session))
+        with self._lock:
+            # Rows include chats assigned before they were read, only later ones are still counted on top
+            self._assigned = {
+                personnel_id: count - assigned_before.get(personnel_id, 0)
+                for personnel_id, count in self._assigned.items() if count > assigned_before.get(personnel_id, 0)
+            }
+            self.rows, self.refreshed_at = rows, time.monotonic()
+
+    def age(self) -> float:
+        return time.monotonic() - self.refreshed_at if self.refreshed_at is not None else float('inf')
+
+    def is_fresh(self) -> bool:
+        return self.age() <= snapshot_max_age_seconds
+
+    def least_busy_personnel_id(self, session: Session, available_personnel_ids: list[str]):
+        """
+        A method that picks the least busy available personnel from the snapshot, or from the db if it is too old
+        :param session: a db session to fall back to
+        :param available_personnel_ids: ids of personnel who are online
+        :return: personnel id or None
+        """
+        if not self.is_fresh():
+            return get_least_busy_personnel_id(session, available_personnel_ids)
+
+        scores = {row['personnelid']: row['normalizedscore'] for row in self.rows}
+        # A chat adds this much to the normalized score of its operator
+        chat_score = 1 / max(max((row.get('totalchats', 0) for row in self.rows), default=0), 1)
+        with self._lock:
+            # Personnel without stats yet go first
+            personnel_id = min(
+                available_personnel_ids,
+                key=lambda candidate: (scores.get(candidate, 0) + self._assigned.get(candidate, 0) * chat_score, candidate in scores),
+                default=None
+            )
+            if personnel_id is not None:
+                self._assigned[personnel_id] = self._assigned.get(personnel_id, 0) + 1
+        return personnel_id
+
+
+personnel_stats_snapshot = PersonnelStatsSnapshot()
+snapshot_age_seconds.set_function(personnel_stats_snapshot.age)
+snapshot_task = PeriodicTask("personnel-stats-snapshot", snapshot_interval_seconds, personnel_stats_snapshot.refresh)
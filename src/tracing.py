@@ -0,0 +1,143 @@
+import inspect
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from os import environ
+from threading import Lock
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+trace_buffer_size = int(environ.get("TRACE_BUFFER_SIZE", 500))
+trace_id_header = "X-Trace-Id"
+
+
+class Trace:
+    """
+    Spans recorded while handling one request. Spans are kept flat, in the order they have finished
+    """
+
+    def __init__(self, trace_id: str, name: str):
+        self.trace_id = trace_id
+        self.name = name
+        self.started_at = time.time()
+        self._started_at_perf = time.perf_counter()
+        self.duration: float | None = None
+        self.spans: list[dict] = []
+        self._lock = Lock()
+
+    def add_span(self, name: str, started_at: float, duration: float, error: str | None = None) -> None:
+        # Spans may finish in worker threads, e.g. DB helpers run through asyncio.to_thread
+        with self._lock:
+            self.spans.append({
+                'name': name,
+                'offset': started_at - self._started_at_perf,
+                'duration': duration,
+                'error': error,
+            })
+
+    def finish(self) -> None:
+        self.duration = time.perf_counter() - self._started_at_perf
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            spans = list(self.spans)
+        return {
+            'traceId': self.trace_id,
+            'name': self.name,
+            'startedAt': self.started_at,
+            'duration': self.duration,
+            'spans': spans,
+        }
+
+
+current_trace: ContextVar[Trace | None] = ContextVar("current_trace", default=None)
+recent_traces: deque[Trace] = deque(maxlen=trace_buffer_size)
+
+
+def new_trace_id() -> str:
+    return uuid.uuid4().hex
+
+
+def get_trace_id() -> str | None:
+    trace = current_trace.get()
+    return trace.trace_id if trace else None
+
+
+@contextmanager
+def start_trace(name: str, trace_id: str = None):
+    """
+    A context manager that makes spans recorded inside of it (including in threads started with asyncio.to_thread)
+    belong to a new trace, which is kept in recent_traces once finished
+    :param name: what is being traced, e.g. 'webhook'
+    :param trace_id: an id to continue, a new one is generated if not given
+    :return: the trace
+    """
+    trace = Trace(trace_id or new_trace_id(), name)
+    token = current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        trace.finish()
+        current_trace.reset(token)
+        recent_traces.append(trace)
+
+
+@contextmanager
+def span(name: str):
+    """
+    A context manager that records a span in the current trace, does nothing outside of a trace
+    :param name: a span name
+    """
+    trace = current_trace.get()
+    if trace is None:
+        yield
+        return
+
+    started_at = time.perf_counter()
+    error = None
+    try:
+        yield
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        trace.add_span(name, started_at, time.perf_counter() - started_at, error)
+
+
+def traced(name: str = None):
+    """
+    A decorator that records every call of a sync or async function as a span
+    :param name: a span name, defaults to the qualified name of the function
+    """
+    def decorator(func):
+        span_name = name or func.__qualname__
+
+        if inspect.iscoroutinefunction(func):
+            @wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with span(span_name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(span_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def find_traces(trace_id: str = None, limit: int = 50) -> list[dict]:
+    """
+    A function that returns the most recent finished traces, newest first
+    :param trace_id: only return traces with this id, e.g. a webhook and the operator reply that continued it
+    :param limit: max number of traces
+    :return: traces as dicts
+    """
+    traces = [trace for trace in reversed(recent_traces) if trace_id is None or trace.trace_id == trace_id]
+    return [trace.as_dict() for trace in traces[:limit]]
@@ -11,9 +11,13 @@ from random import choice as random_choice
 import boto3
 from botocore.exceptions import ClientError
 
+from src.metrics import counter
+
 load_dotenv()
 local_storage_path = environ.get("LOCAL_STORAGE_PATH")
 
+emails_sent = counter('emails_sent_total', 'Missed message notifications sent to personnel', ['outcome'])
+
 def send_missed_a_message_email(to: str, chat_id: int):
     ses_client = boto3.client(
         'ses',
@@ -39,7 +43,9 @@ def send_missed_a_message_email(to: str, chat_id: int):
                 }
             }
         )
+        emails_sent.inc(outcome='sent')
     except ClientError as e:
+        emails_sent.inc(outcome='error')
         print("An error occurred: ", e.response['Error']['Message'])
 
 def choose_personnel(personnel_ids: list[str]):
@@ -0,0 +1,169 @@
+import asyncio
+import heapq
+import logging
+import time
+from dataclasses import dataclass, field
+from os import environ
+from typing import Awaitable, Callable
+
+from dotenv import load_dotenv
+
+from src.db.engine import Session
+from src.db.queries import assign_chats, get_open_chat_counts, get_waiting_chats
+from src.metrics import counter, gauge, histogram
+
+load_dotenv()
+
+waiting_room_drain_interval_seconds = float(environ.get("WAITING_ROOM_DRAIN_INTERVAL_SECONDS", 10))
+# Chats an operator may have before the waiting room stops giving them more, 0 is unlimited
+operator_max_chats = int(environ.get("OPERATOR_MAX_CHATS", 20))
+# Returning users are queued as if they had been waiting this much longer
+waiting_room_affinity_bonus_seconds = float(environ.get("WAITING_ROOM_AFFINITY_BONUS_SECONDS", 300))
+
+waiting_chats = gauge('waiting_room_chats', 'Chats waiting for an operator')
+waiting_room_oldest_seconds = gauge('waiting_room_oldest_wait_seconds', 'How long the longest waiting chat has been waiting')
+waiting_room_wait_seconds = histogram('waiting_room_wait_seconds', 'Time chats have spent waiting for an operator',
+                                      buckets=(1, 10, 60, 300, 900, 1800, 3600, 3 * 3600, 8 * 3600, 24 * 3600))
+waiting_room_assignments = counter('waiting_room_assignments_total', 'Chats handed to operators from the waiting room', ['affinity'])
+
+
+@dataclass(order=True)
+class WaitingChat:
+    priority: float
+    chat_id: int
+    user_id: str = field(compare=False)
+    waiting_since: float = field(compare=False)
+    affinity_personnel_id: str | None = field(compare=False, default=None)
+
+
+def plan_assignments(queue: list[WaitingChat], loads: dict[str, int], capacity: int) -> tuple[list[tuple[WaitingChat, str]], list[WaitingChat]]:
+    """
+    A function that hands waiting chats, highest priority first, to the operator the user has last talked to
+    if they have room, or to the least loaded operator otherwise. Every assignment is O(log n)
+    :param queue: a heap of waiting chats, chats are popped from it
+    :param loads: online personnel id -> number of chats they have
+    :param capacity: max number of chats of an operator, 0 is unlimited
+    :return: (assignments as (chat, personnel id), chats that couldn't be assigned and are still waiting)
+    """
+    def has_room(load: int) -> bool:
+        return not capacity or load < capacity
+
+    loads = dict(loads)
+    # Stale entries, whose load has changed since they were pushed, are skipped when popped
+    operators = [(load, personnel_id) for personnel_id, load in loads.items() if has_room(load)]
+    heapq.heapify(operators)
+    assignments = []
+
+    while queue and operators:
+        chat = heapq.heappop(queue)
+        personnel_id = chat.affinity_personnel_id
+        if personnel_id not in loads or not has_room(loads[personnel_id]):
+            personnel_id = None
+            while operators:
+                load, candidate = heapq.heappop(operators)
+                if loads[candidate] == load:
+                    personnel_id = candidate
+                    break
+            if personnel_id is None:
+                heapq.heappush(queue, chat)
+                break
+
+        loads[personnel_id] += 1
+        if has_room(loads[personnel_id]):
+            heapq.heappush(operators, (loads[personnel_id], personnel_id))
+        assignments.append((chat, personnel_id))
+
+    return assignments, queue
+
+
+class WaitingRoom:
+    """
+    A priority queue of chats that have no operator, ordered by how long they have been waiting, with returning users
+    moved ahead. Every drain rebuilds it from the chats it claims in the db, so that every worker sees chats created
+    by the others, and chats survive a restart
+    """
+
+    def __init__(self, capacity: int, affinity_bonus: float,
+                 announce: Callable[[dict, WaitingChat], Awaitable[None]] = None):
+        self.capacity = capacity
+        self.affinity_bonus = affinity_bonus
+        # Called with (assigned chat, the waiting chat) once a chat has been assigned
+        self.announce = announce
+        self._queue: list[WaitingChat] = []
+        self._chat_ids: set[int] = set()
+        self._lock = asyncio.Lock()
+        waiting_chats.set_function(lambda: len(self._queue))
+        waiting_room_oldest_seconds.set_function(
+            lambda: time.time() - min(chat.waiting_since for chat in self._queue) if self._queue else 0
+        )
+
+    def __len__(self) -> int:
+        return len(self._queue)
+
+    def __contains__(self, chat_id: int) -> bool:
+        return chat_id in self._chat_ids
+
+    def waiting_chat(self, chat_id: int, user_id: str, waiting_since: float,
+                     affinity_personnel_id: str | None = None) -> WaitingChat:
+        priority = waiting_since - (self.affinity_bonus if affinity_personnel_id else 0)
+        return WaitingChat(priority, chat_id, user_id, waiting_since, affinity_personnel_id)
+
+    def add(self, chat_id: int, user_id: str, waiting_since: float, affinity_personnel_id: str | None = None) -> None:
+        if chat_id in self._chat_ids:
+            return
+        heapq.heappush(self._queue, self.waiting_chat(chat_id, user_id, waiting_since, affinity_personnel_id))
+        self._chat_ids.add(chat_id)
+
+    def plan_and_assign(self, online_personnel_ids: list[str]) -> tuple[list[tuple[WaitingChat, str]], list[dict], list[WaitingChat]]:
+        """
+        A method that claims waiting chats, plans their assignments and stores them in one transaction
+        :param online_personnel_ids: ids of personnel who are online
+        :return: (planned assignments as (chat, personnel id), assigned chats, chats that are still waiting)
+        """
+        with Session() as session:
+            queue = [
+                self.waiting_chat(chat['id'], chat['userId'], chat['createdAt'].timestamp(), chat['affinityPersonnelId'])
+                for chat in get_waiting_chats(session)
+            ]
+            heapq.heapify(queue)
+            if not queue or not online_personnel_ids:
+                return [], [], queue
+
+            counts = get_open_chat_counts(session, online_personnel_ids)
+            assignments, queue = plan_assignments(
+                queue, {personnel_id: counts.get(personnel_id, 0) for personnel_id in online_personnel_ids},
+                self.capacity
+            )
+            if not assignments:
+                return [], [], queue
+            assigned = assign_chats(session, {chat.chat_id: personnel_id for chat, personnel_id in assignments})
+        return assignments, assigned, queue
+
+    async def drain(self, online_personnel_ids: list[str]) -> int:
+        """
+        A method that assigns waiting chats to online operators who have room for them
+        :param online_personnel_ids: ids of personnel who are online
+        :return: number of assigned chats
+        """
+        async with self._lock:
+            assignments, assigned, self._queue = await asyncio.to_thread(self.plan_and_assign, online_personnel_ids)
+            # Chats claimed by other workers' drains are left out until the next one
+            self._chat_ids = {chat.chat_id for chat in self._queue}
+            if not assigned:
+                return 0
+
+        waiting = {chat.chat_id: chat for chat, _ in assignments}
+        now = time.time()
+        for assigned_chat in assigned:
+            chat = waiting[assigned_chat['id']]
+            waiting_room_wait_seconds.observe(now - chat.waiting_since)
+            waiting_room_assignments.inc(affinity=str(assigned_chat['personnelId'] == chat.affinity_personnel_id).lower())
+            if self.announce is not None:
+                try:
+                    await self.announce(assigned_chat, chat)
+                except Exception as e:
+                    logging.error(f"Unable to announce chat {chat.chat_id} to its operator: {e}")
+        return len(assigned)
+
+
+waiting_room = WaitingRoom(operator_max_chats, waiting_room_affinity_bonus_seconds)
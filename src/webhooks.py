@@ -7,6 +7,10 @@ import aiohttp
 
 from dotenv import load_dotenv
 
+from src.platforms.facebook.api import facebook_graph_url
+from src.platforms.telegram.api import telegram_api_url
+from src.platforms.telegram.polling import telegram_polling_enabled
+from src.platforms.viber.api import viber_api_url
 
 load_dotenv()
 
@@ -42,7 +46,7 @@ async def set_telegram_webhook() -> None:
     Set webhook for Telegram
     :return:
     """
-    url = f"https://api.telegram.org/bot{telegram_token}/setWebhook"
+    url = f"{telegram_api_url}/bot{telegram_token}/setWebhook"
     headers = {}
     body = {
         "url": urljoin(api_url, webhook_path),
@@ -63,7 +67,7 @@ async def set_viber_webhook() -> None:
     Set webhook for Viber
     :return:
     """
-    url = "https://chatapi.viber.com/pa/set_webhook"
+    url = f"{viber_api_url}/pa/set_webhook"
     headers = {
         "X-Viber-Auth-Token": viber_token,
         "Content-Type": "application/json",
@@ -92,7 +96,7 @@ async def set_facebook_webhook() -> None:
     Set webhook for Facebook
     :return:
     """
-    url = f"https://graph.facebook.com/v{facebook_api_version}/me/subscribed_apps"
+    url = f"{facebook_graph_url}/v{facebook_api_version}/me/subscribed_apps"
     headers = {}
     body = {
         "access_token": facebook_page_token,
@@ -111,11 +115,11 @@ async def set_facebook_webhook() -> None:
 
 async def init() -> None:
     """
-    Set webhooks for all platforms
+    Set webhooks for all platforms, except Telegram if its updates are polled
     :return:
     """
     await asyncio.gather(
-        set_telegram_webhook(),
+        *([] if telegram_polling_enabled else [set_telegram_webhook()]),
         set_viber_webhook(),
         set_facebook_webhook()
     )
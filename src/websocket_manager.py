@@ -3,6 +3,8 @@ import asyncio
 from dotenv import load_dotenv
 from starlette.websockets import WebSocket, WebSocketState, WebSocketDisconnect
 
+from src.tracing import traced
+
 load_dotenv()
 
 def handle_websocket_disconnect(func):
@@ -28,8 +30,15 @@ class WebSocketManager:
 
     # Connect
     async def connect(self, user_id: str, websocket: WebSocket):
-        await self.disconnect(user_id)
         await websocket.accept()
+        await self.register(user_id, websocket)
+
+    async def register(self, user_id: str, websocket: WebSocket):
+        """
+        Starts live delivery to an already accepted websocket, replacing the previous one of the user
+        """
+        if self.clients.get(user_id) is not websocket:
+            await self.disconnect(user_id)
         self.clients[user_id] = websocket
 
     def get_client(self, user_id: str):
@@ -82,6 +91,7 @@ class WebSocketManager:
     async def broadcast_text(self, message: str):
         return await self.broadcast(self.send_text, message)
 
+    @traced("WebSocketManager.send_json")
     @handle_websocket_disconnect
     async def send_json(self, user_id, data: dict):
         await self.clients[user_id].send_json(data)
@@ -0,0 +1,84 @@
+from os import environ
+
+import pytest
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import Session
+
+from src.db.queries import register_queries
+
+# Tests of SQL functions and triggers need a disposable PostgreSQL db and are skipped without one
+test_db_connection_string = environ.get("TEST_DB_CONNECTION_STRING")
+
+# Tables the router shares with the dashboard, which owns them through Prisma. Only the columns the router uses
+create_prisma_tables = text("""
+    CREATE TABLE "User" (
+        "id" TEXT PRIMARY KEY,
+        "name" TEXT,
+        "email" TEXT UNIQUE,
+        "busyness" INT NOT NULL DEFAULT 0,
+        "latestStatusConfirmationAt" TIMESTAMP(3) NOT NULL DEFAULT NOW(),
+        "suspended" BOOLEAN NOT NULL DEFAULT FALSE
+    );
+    CREATE TABLE "Permission" ("id" SERIAL PRIMARY KEY, "title" TEXT NOT NULL UNIQUE);
+    CREATE TABLE "Role" ("id" SERIAL PRIMARY KEY);
+    CREATE TABLE "_PermissionToUser" ("A" INT NOT NULL REFERENCES "Permission"("id"), "B" TEXT NOT NULL REFERENCES "User"("id"));
+    CREATE TABLE "_RoleToUser" ("A" INT NOT NULL REFERENCES "Role"("id"), "B" TEXT NOT NULL REFERENCES "User"("id"));
+    CREATE TABLE "_PermissionToRole" ("A" INT NOT NULL REFERENCES "Permission"("id"), "B" INT NOT NULL REFERENCES "Role"("id"));
+    CREATE TABLE "Chat" (
+        "id" SERIAL PRIMARY KEY,
+        "createdAt" TIMESTAMP(3) NOT NULL DEFAULT NOW(),
+        "userId" TEXT NOT NULL UNIQUE REFERENCES "User"("id"),
+        "personnelId" TEXT REFERENCES "User"("id")
+    );
+    CREATE TABLE "Message" (
+        "id" SERIAL PRIMARY KEY,
+        "createdAt" TIMESTAMP(3) NOT NULL DEFAULT NOW(),
+        "text" TEXT NOT NULL,
+        "chatId" INT NOT NULL REFERENCES "Chat"("id"),
+        "isFromUser" BOOLEAN NOT NULL
+    );
+    CREATE INDEX "Message_chatId_createdAt_idx" ON "Message"("chatId", "createdAt");
+    CREATE TABLE "ArchivedChat" (
+        "id" SERIAL PRIMARY KEY,
+        "createdAt" TIMESTAMP(3) NOT NULL DEFAULT NOW(),
+        "endedAt" TIMESTAMP(3) NOT NULL DEFAULT NOW(),
+        "userId" TEXT NOT NULL REFERENCES "User"("id"),
+        "personnelId" TEXT REFERENCES "User"("id")
+    );
+    CREATE TABLE "ArchivedMessage" (
+        "id" SERIAL PRIMARY KEY,
+        "createdAt" TIMESTAMP(3) NOT NULL DEFAULT NOW(),
+        "text" TEXT NOT NULL,
+        "chatId" INT NOT NULL REFERENCES "ArchivedChat"("id"),
+        "isFromUser" BOOLEAN NOT NULL
+    );
+""")
+
+
+@pytest.fixture
+def anyio_backend():
+    return 'asyncio'
+
+
+@pytest.fixture(scope='session')
+def db_engine():
+    if not test_db_connection_string:
+        pytest.skip("TEST_DB_CONNECTION_STRING is not set")
+    engine = create_engine(test_db_connection_string, future=True)
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture
+def db_session(db_engine):
+    """
+    A fixture that gives every test an empty schema with registered queries applied
+    """
+    with db_engine.begin() as connection:
+        connection.execute(text("DROP SCHEMA IF EXISTS public CASCADE; CREATE SCHEMA public"))
+        connection.execute(create_prisma_tables)
+        for query in register_queries:
+            connection.execute(query)
+
+    with Session(db_engine) as session:
+        yield session
@@ -0,0 +1,87 @@
+import asyncio
+
+import pytest
+
+from src.admission import AdmissionController, AdmissionRejected, SpillQueue, as_request
+
+
+class TestAdmissionController:
+    #  Tests that webhooks over the concurrency limit wait and are rejected once their queue time runs out
+    @pytest.mark.anyio
+    async def test_queue_timeout(self):
+        controller = AdmissionController(max_concurrency=1, max_queue=10, queue_timeout=0.01, shed_threshold=1)
+        async with controller.admit():
+            with pytest.raises(AdmissionRejected) as e:
+                async with controller.admit():
+                    pass
+        assert e.value.reason == 'queue_timeout'
+        assert controller.in_flight == 0
+
+    #  Tests that webhooks are rejected right away once the queue is full
+    @pytest.mark.anyio
+    async def test_queue_full(self):
+        controller = AdmissionController(max_concurrency=1, max_queue=1, queue_timeout=1, shed_threshold=1)
+        await controller.acquire()
+        waiter = asyncio.create_task(controller.acquire())
+        await asyncio.sleep(0)
+
+        with pytest.raises(AdmissionRejected) as e:
+            await controller.acquire()
+        assert e.value.reason == 'queue_full'
+
+        controller.release()
+        await waiter
+        assert controller.in_flight == 1
+
+    #  Tests that sheddable webhooks are dropped before the concurrency limit is reached
+    @pytest.mark.anyio
+    async def test_shed(self):
+        controller = AdmissionController(max_concurrency=10, max_queue=10, queue_timeout=1, shed_threshold=0.1)
+        async with controller.admit(sheddable=True):
+            with pytest.raises(AdmissionRejected) as e:
+                await controller.acquire(sheddable=True)
+            assert e.value.reason == 'shed'
+            await controller.acquire()
+
+
+class TestSpillQueue:
+    #  Tests that spilled webhooks come back byte for byte with their headers, oldest first
+    @pytest.mark.anyio
+    async def test_round_trip(self, tmp_path):
+        queue = SpillQueue(str(tmp_path))
+        first = queue.put(b'{"event": "message"}', {'X-Viber-Content-Signature': 'abc'})
+        second = queue.put(b'{}', {})
+
+        assert queue.pending(10) == [first, second]
+        body, headers = queue.claim(first)
+        request = as_request(body, headers, '/webhook')
+        assert await request.body() == b'{"event": "message"}'
+        assert request.headers['x-viber-content-signature'] == 'abc'
+
+        queue.remove(first)
+        queue.fail(second)
+        assert len(queue) == 0
+
+    #  Tests that a webhook is only replayed by the worker that has claimed it, until it is released
+    def test_claim(self, tmp_path):
+        worker, other_worker = SpillQueue(str(tmp_path)), SpillQueue(str(tmp_path))
+        name = worker.put(b'{}', {})
+
+        assert worker.claim(name) is not None
+        assert other_worker.claim(name) is None
+        worker.release(name)
+        assert other_worker.claim(name) is not None
+
+        other_worker.remove(name)
+        assert worker.claim(name) is None
+
+    #  Tests that nothing is spilled past max_files until replayed webhooks make room
+    def test_max_files(self, tmp_path):
+        queue = SpillQueue(str(tmp_path), max_files=2)
+        first = queue.put(b'{}', {})
+        assert queue.put(b'{}', {}) is not None
+        assert queue.put(b'{}', {}) is None
+
+        SpillQueue(str(tmp_path)).remove(first)
+        assert queue.put(b'{}', {}) is not None
+        assert len(queue) == 2
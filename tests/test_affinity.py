@@ -0,0 +1,83 @@
+import pytest
+
+import src.db.queries as queries
+from src.db.affinity import AffinityCache
+
+
+class TestAffinityCache:
+    #  Tests that a stored entry is returned
+    def test_put_get(self):
+        cache = AffinityCache(max_size=2)
+        cache.put('telegram_1', 'personnel', 10)
+        assert cache.get('telegram_1') == ('personnel', 10)
+
+    #  Tests that a missing entry returns None
+    def test_miss(self):
+        assert AffinityCache(max_size=2).get('telegram_1') is None
+
+    #  Tests that the least recently used entry is evicted
+    def test_eviction(self):
+        cache = AffinityCache(max_size=2)
+        cache.put('telegram_1', 'a', 1)
+        cache.put('telegram_2', 'b', 2)
+        cache.get('telegram_1')
+        cache.put('telegram_3', 'c', 3)
+        assert cache.get('telegram_2') is None
+        assert cache.get('telegram_1') == ('a', 1)
+        assert len(cache) == 2
+
+    #  Tests that a discarded entry is no longer returned
+    def test_discard(self):
+        cache = AffinityCache(max_size=2)
+        cache.put('telegram_1', 'a', 1)
+        cache.discard('telegram_1')
+        cache.discard('telegram_2')
+        assert cache.get('telegram_1') is None
+
+
+class TestReactivateAcquaintedChat:
+    @pytest.fixture(autouse=True)
+    def cache(self, mocker):
+        cache = AffinityCache(max_size=10)
+        mocker.patch.object(queries, 'affinity_cache', cache)
+        return cache
+
+    #  Tests that the chat of the operator the user has last talked to is reactivated if they are online
+    def test_last_operator(self, mocker):
+        mocker.patch.object(queries, 'fetch_user_affinity', return_value=('a', 10))
+        fetch_acquainted_chat = mocker.patch.object(queries, 'fetch_acquainted_chat')
+        unarchive_chat = mocker.patch.object(queries, 'unarchive_chat', return_value=1)
+
+        assert queries.reactivate_acquainted_chat(mocker.MagicMock(), ['a'], 'telegram_1') == 1
+        unarchive_chat.assert_called_once_with(mocker.ANY, 10)
+        fetch_acquainted_chat.assert_not_called()
+
+    #  Tests that an earlier operator who is online is used if the last one is offline
+    def test_earlier_operator(self, mocker):
+        mocker.patch.object(queries, 'fetch_user_affinity', return_value=('a', 10))
+        mocker.patch.object(queries, 'fetch_acquainted_chat', return_value=7)
+        unarchive_chat = mocker.patch.object(queries, 'unarchive_chat', return_value=2)
+
+        assert queries.reactivate_acquainted_chat(mocker.MagicMock(), ['b'], 'telegram_1') == 2
+        unarchive_chat.assert_called_once_with(mocker.ANY, 7)
+
+    #  Tests that nothing is reactivated for new users or if nobody the user has talked to is online
+    def test_none(self, mocker):
+        fetch_user_affinity = mocker.patch.object(queries, 'fetch_user_affinity', return_value=None)
+        mocker.patch.object(queries, 'fetch_acquainted_chat', return_value=None)
+        unarchive_chat = mocker.patch.object(queries, 'unarchive_chat')
+
+        assert queries.reactivate_acquainted_chat(mocker.MagicMock(), ['a'], 'telegram_1') is None
+        fetch_user_affinity.return_value = ('a', 10)
+        assert queries.reactivate_acquainted_chat(mocker.MagicMock(), ['b'], 'telegram_1') is None
+        unarchive_chat.assert_not_called()
+
+    #  Tests that a stale cache entry is dropped and the lookup is retried once against the db
+    def test_stale_cache(self, mocker, cache):
+        cache.put('telegram_1', 'a', 10)
+        mocker.patch.object(queries, 'fetch_user_affinity', return_value=('a', 11))
+        unarchive_chat = mocker.patch.object(queries, 'unarchive_chat', side_effect=[None, 3])
+
+        assert queries.reactivate_acquainted_chat(mocker.MagicMock(), ['a'], 'telegram_1') == 3
+        assert [call.args[1] for call in unarchive_chat.call_args_list] == [10, 11]
+        assert cache.get('telegram_1') is None
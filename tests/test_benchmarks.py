@@ -0,0 +1,47 @@
+import pytest
+from starlette.requests import Request
+
+from benchmarks.payloads import PayloadFactory
+from benchmarks.report import percentile
+from src.platforms import FacebookEvent, TelegramEvent, ViberEvent
+
+events = {'telegram': TelegramEvent, 'viber': ViberEvent, 'facebook': FacebookEvent}
+
+
+def as_request(payload) -> Request:
+    async def receive():
+        return {'type': 'http.request', 'body': payload.body, 'more_body': False}
+
+    scope = {
+        'type': 'http',
+        'method': 'POST',
+        'path': '/webhook',
+        'headers': [(key.lower().encode(), value.encode()) for key, value in payload.headers.items()],
+    }
+    return Request(scope, receive)
+
+
+class TestPayloadFactory:
+    #  Tests that generated payloads are accepted by the matching platform and only by it
+    @pytest.mark.anyio
+    @pytest.mark.parametrize('platform', list(events))
+    async def test_payload_is_valid(self, platform):
+        payload = PayloadFactory(seed=1).create(platform, text='Привіт')
+        event = await events[platform].create_if_valid(as_request(payload))
+        assert event is not None
+        assert event.text == 'Привіт'
+        assert event.user_unique_id == payload.user_unique_id
+        # Telegram dates are whole seconds
+        assert abs(event.timestamp - payload.sent_at) < 1
+        for other, event_class in events.items():
+            if other != platform:
+                assert await event_class.create_if_valid(as_request(payload)) is None
+
+
+class TestPercentile:
+    #  Tests nearest-rank percentiles
+    def test_percentile(self):
+        values = list(range(1, 101))
+        assert percentile(values, 50) == 50
+        assert percentile(values, 99) == 99
+        assert percentile([], 50) is None
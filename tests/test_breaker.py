@@ -0,0 +1,142 @@
+import pytest
+import requests
+
+import src.api as api
+from src.breaker import BreakerState, CircuitBreaker
+
+
+def create_breaker(**kwargs) -> CircuitBreaker:
+    options = dict(failure_threshold=2, reset_seconds=10, min_timeout=1, max_timeout=10, timeout_multiplier=3)
+    options.update(kwargs)
+    return CircuitBreaker('test', **options)
+
+
+class TestCircuitBreaker:
+    #  Tests that the breaker opens after consecutive failures and lets a single probe through after the reset time
+    def test_open_and_probe(self):
+        breaker = create_breaker()
+        breaker.record_failure(now=0)
+        assert breaker.allow(now=0)
+        breaker.record_failure(now=0)
+        assert breaker.state is BreakerState.Open
+        assert not breaker.allow(now=5)
+
+        assert breaker.allow(now=10)
+        assert breaker.state is BreakerState.HalfOpen
+        assert not breaker.allow(now=10)
+
+        breaker.record_success(0.1)
+        assert breaker.state is BreakerState.Closed
+        assert breaker.allow(now=10)
+
+    #  Tests that a failed probe keeps the breaker open for another reset time
+    def test_failed_probe(self):
+        breaker = create_breaker()
+        breaker.record_failure(now=0)
+        breaker.record_failure(now=0)
+        assert breaker.allow(now=10)
+        breaker.record_failure(now=10)
+        assert breaker.state is BreakerState.Open
+        assert not breaker.allow(now=15)
+        assert breaker.allow(now=20)
+
+    #  Tests that the timeout follows recent latency within its bounds
+    def test_adaptive_timeout(self):
+        breaker = create_breaker()
+        assert breaker.timeout() == 10
+        for _ in range(CircuitBreaker.min_latency_samples):
+            breaker.record_success(0.5)
+        assert breaker.timeout() == 1.5
+        for _ in range(CircuitBreaker.latency_window):
+            breaker.record_success(0.01)
+        assert breaker.timeout() == 1
+
+    #  Tests that a breaker that honors retry_after opens on the first rate limited call for as long as asked
+    def test_retry_after(self):
+        breaker = create_breaker(honors_retry_after=True)
+        breaker.record_failure(now=0, retry_after=2)
+        assert breaker.state is BreakerState.Open
+        assert breaker.remaining_seconds(now=1) == 1
+        assert not breaker.allow(now=1)
+        assert breaker.allow(now=2)
+
+        live = create_breaker()
+        live.record_failure(now=0, retry_after=2)
+        assert live.state is BreakerState.Closed
+
+
+class TestSendMessage:
+    @pytest.fixture
+    def viber(self, mocker):
+        mocker.patch.dict(api.breakers, {'viber': create_breaker(failure_threshold=1)})
+        mocker.patch.dict(api.parked_messages, {'viber': api.ParkedMessages('viber', 10)})
+        send = mocker.MagicMock()
+        mocker.patch.dict(api.platform_sm, {'viber': send})
+        return send
+
+    #  Tests that messages are parked while the platform is down and sent in order once it is back
+    def test_park_and_retry(self, viber, mocker):
+        viber.side_effect = requests.ConnectTimeout()
+        assert api.send_message('viber_1', 'first') is None
+        assert api.send_message('viber_1', 'second') is None
+        assert viber.call_count == 1
+        assert len(api.parked_messages['viber']) == 2
+
+        viber.side_effect = None
+        viber.return_value = mocker.MagicMock(status_code=200)
+        api.breakers['viber'].opened_at -= 10
+        assert api.retry_parked_messages() == 2
+        assert [call.args[1] for call in viber.call_args_list[1:]] == ['first', 'second']
+        assert len(api.parked_messages['viber']) == 0
+
+    #  Tests that the delay a rate limited platform asks for is read from the header or Telegram's body
+    def test_retry_after(self, mocker):
+        assert api.get_retry_after(mocker.MagicMock(headers={'Retry-After': '3'})) == 3
+        telegram = mocker.MagicMock(headers={}, json=lambda: {'ok': False, 'parameters': {'retry_after': 5}})
+        assert api.get_retry_after(telegram) == 5
+        assert api.get_retry_after(mocker.MagicMock(headers={}, json=lambda: {})) is None
+
+    #  Tests that client errors don't open the breaker
+    def test_client_error(self, viber, mocker):
+        viber.return_value = mocker.MagicMock(status_code=400)
+        assert api.send_message('viber_1', 'text') is not None
+        assert api.breakers['viber'].state is BreakerState.Closed
+
+    #  Tests that messages are given up on after too many failed attempts
+    def test_max_attempts(self, viber):
+        viber.side_effect = requests.ConnectTimeout()
+        api.send_message('viber_1', 'text', attempts=api.parked_message_max_attempts - 1)
+        assert len(api.parked_messages['viber']) == 0
+
+    #  Tests that messages the platform might have accepted are never sent again
+    def test_read_timeout(self, viber):
+        viber.side_effect = requests.ReadTimeout()
+        assert api.send_message('viber_1', 'text') is None
+        assert len(api.parked_messages['viber']) == 0
+        assert api.breakers['viber'].state is BreakerState.Open
+
+    #  Tests that messages which failed again keep their place ahead of messages parked in the meantime
+    def test_retry_order(self, viber, mocker):
+        parked = api.parked_messages['viber']
+        parked.park('viber_1', 'first', 1)
+        parked.park('viber_1', 'second', 1)
+
+        def fail(*args, **kwargs):
+            # A live send that has been parked while the retry was in flight
+            parked.park('viber_1', 'third', 0)
+            raise requests.ConnectTimeout()
+
+        viber.side_effect = fail
+        assert api.retry_parked_messages() == 0
+        assert [(message[1], message[2]) for message in parked.take()] == [('first', 2), ('second', 1), ('third', 0)]
+
+    #  Tests that a live send waits behind a parked message instead of overtaking it
+    def test_park_behind(self, viber, mocker):
+        viber.return_value = mocker.MagicMock(status_code=200)
+        api.parked_messages['viber'].park('viber_1', 'first', 1)
+        assert api.send_message('viber_1', 'second') is None
+        assert viber.call_count == 0
+
+        assert api.retry_parked_messages() == 2
+        assert [call.args[1] for call in viber.call_args_list] == ['first', 'second']
+        assert api.send_message('viber_1', 'third') is not None
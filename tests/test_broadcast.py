@@ -0,0 +1,114 @@
+import pytest
+
+import src.api as api
+import src.broadcast as broadcast
+from src.breaker import BreakerState
+from src.broadcast import Pacer, broadcast_report, broadcast_to_platform
+
+
+class TestPacer:
+    #  Tests that calls are spaced out to the rate and idle time isn't saved up for a burst
+    def test_delay(self):
+        pacer = Pacer(rate=10)
+        assert pacer.delay(now=0) == 0
+        assert pacer.delay(now=0) == pytest.approx(0.1)
+        assert pacer.delay(now=0) == pytest.approx(0.2)
+        assert pacer.delay(now=5) == 0
+        assert pacer.delay(now=5) == pytest.approx(0.1)
+
+
+class TestBroadcastToPlatform:
+    @pytest.fixture
+    def recipients(self, mocker):
+        users = [f'viber_{i}' for i in range(5)]
+
+        def fetch(platform, after):
+            start = users.index(after) + 1 if after else 0
+            return users[start:start + 2]
+
+        mocker.patch.object(broadcast, 'broadcast_page_size', 2)
+        mocker.patch.object(broadcast, 'fetch_recipients', side_effect=fetch)
+        mocker.patch.dict(broadcast.pacers, {'viber': Pacer(0)})
+        return users
+
+    #  Tests that every user is sent to once, page by page, with a checkpoint after every page
+    @pytest.mark.anyio
+    async def test_pages(self, recipients, mocker):
+        call_platform = mocker.patch('src.broadcast.call_platform', return_value=mocker.MagicMock())
+        mocker.patch('src.broadcast.is_delivered', side_effect=[True, True, False, True, True])
+        checkpoint = mocker.patch('src.broadcast.checkpoint')
+
+        assert await broadcast_to_platform(1, 'viber', 'news', None) == (4, 1)
+
+        assert sorted(call.args[1] for call in call_platform.call_args_list) == ['0', '1', '2', '3', '4']
+        assert [call.args for call in checkpoint.call_args_list] == [
+            (1, 'viber', 'viber_1', 2, 0, False),
+            (1, 'viber', 'viber_3', 1, 1, False),
+            (1, 'viber', 'viber_4', 1, 0, True),
+        ]
+
+    #  Tests that a resumed job starts after its last checkpoint
+    @pytest.mark.anyio
+    async def test_resume(self, recipients, mocker):
+        call_platform = mocker.patch('src.broadcast.call_platform', return_value=mocker.MagicMock())
+        mocker.patch('src.broadcast.is_delivered', return_value=True)
+        mocker.patch('src.broadcast.checkpoint')
+
+        assert await broadcast_to_platform(1, 'viber', 'news', 'viber_3') == (1, 0)
+        assert [call.args[1] for call in call_platform.call_args_list] == ['4']
+
+    #  Tests that sends wait while the platform's circuit breaker is open and give up after too many failures
+    @pytest.mark.anyio
+    async def test_breaker(self, recipients, mocker):
+        breaker = mocker.MagicMock()
+        breaker.remaining_seconds.return_value = 0.01
+        breaker.allow.side_effect = [False, True, True, True]
+        mocker.patch.dict(broadcast.breakers, {'viber': breaker})
+        mocker.patch.object(broadcast, 'broadcast_max_attempts', 3)
+        call_platform = mocker.patch('src.broadcast.call_platform', return_value=None)
+
+        assert not await broadcast.send_to('viber', 'viber_1', 'news')
+        assert breaker.allow.call_count == 4
+        assert call_platform.call_count == 3
+
+    #  Tests that rate limits broadcasts run into open their own breaker for as long as asked and not the live chat one
+    @pytest.mark.anyio
+    async def test_rate_limited(self, recipients, mocker):
+        mocker.patch.dict(broadcast.breakers, {'viber': broadcast.create_breaker('test', honors_retry_after=True)})
+        mocker.patch.dict(api.platform_sm, {'viber': mocker.MagicMock(side_effect=[
+            mocker.MagicMock(status_code=429, headers={'Retry-After': '0.05'}),
+            mocker.MagicMock(status_code=200),
+        ])})
+        mocker.patch('src.broadcast.is_delivered', return_value=True)
+
+        assert await broadcast.send_to('viber', 'viber_1', 'news')
+        assert api.platform_sm['viber'].call_count == 2
+        assert api.breakers['viber'].state is BreakerState.Closed
+
+    #  Tests that Facebook is skipped without a message tag, as Graph rejects broadcasts outside of the 24-hour window
+    @pytest.mark.anyio
+    async def test_facebook_without_tag(self, mocker):
+        mocker.patch.object(broadcast, 'facebook_broadcast_message_tag', None)
+        call_platform = mocker.patch('src.broadcast.call_platform')
+        checkpoint = mocker.patch('src.broadcast.checkpoint')
+
+        assert 'facebook' not in broadcast.broadcast_platforms()
+        assert await broadcast_to_platform(1, 'facebook', 'news', None) == (0, 0)
+        assert not call_platform.called
+        assert checkpoint.call_args.args == (1, 'facebook', None, 0, 0, True)
+
+
+class TestBroadcastReport:
+    #  Tests that progress is summed over platforms
+    def test_report(self, mocker):
+        job = {
+            'id': 1, 'status': 'running', 'createdAt': mocker.MagicMock(timestamp=lambda: 100.0), 'finishedAt': None,
+            'elapsedSeconds': 10.0,
+            'progress': [
+                {'platform': 'telegram', 'sent': 40, 'failed': 10, 'finishedAt': None},
+                {'platform': 'viber', 'sent': 50, 'failed': 0, 'finishedAt': mocker.MagicMock()},
+            ],
+        }
+        report = broadcast_report(job)
+        assert (report['sent'], report['failed'], report['messagesPerSecond']) == (90, 10, 10)
+        assert report['platforms']['viber']['finished'] and not report['platforms']['telegram']['finished']
@@ -0,0 +1,63 @@
+import asyncio
+from datetime import datetime
+
+import pytest
+
+import src.catch_up as catch_up
+
+
+def message_row(message_id: int) -> dict:
+    return {'id': message_id, 'text': 'hi', 'createdAt': datetime(2024, 1, 1), 'chatId': 1, 'isFromUser': True}
+
+
+class TestCatchUp:
+    @pytest.fixture
+    def websocket(self, mocker):
+        mocker.patch.object(catch_up, 'catch_up_frame_size', 2)
+        return mocker.AsyncMock()
+
+    @pytest.fixture
+    def messages(self, mocker):
+        rows = [message_row(message_id) for message_id in range(1, 6)]
+        return mocker.patch.object(catch_up, 'fetch_missed_messages', side_effect=lambda personnel_id, after, limit: [
+            row for row in rows if row['id'] > after
+        ][:limit])
+
+    def frames(self, websocket) -> list[dict]:
+        return [call.args[0] for call in websocket.send_json.call_args_list]
+
+    #  Tests that missed messages are streamed in bounded frames starting after the last message the operator has
+    @pytest.mark.anyio
+    async def test_missed_messages(self, websocket, messages):
+        assert await catch_up.send_missed_messages(websocket, 'p', after=1, limit=100) == (5, False)
+        assert [[message['id'] for message in frame['messages']] for frame in self.frames(websocket)] == [[2, 3], [4, 5]]
+        assert messages.call_args_list[-1].args == ('p', 5, 2)
+
+    #  Tests that missed messages are cut off at the limit
+    @pytest.mark.anyio
+    async def test_limit(self, websocket, messages):
+        assert await catch_up.send_missed_messages(websocket, 'p', after=0, limit=3) == (3, True)
+        assert [len(frame['messages']) for frame in self.frames(websocket)] == [2, 1]
+
+    #  Tests that only chats are sent without a last message id
+    @pytest.mark.anyio
+    async def test_chats_only(self, websocket, messages, mocker):
+        chats = [{'id': 1, 'userId': 'viber_1', 'createdAt': datetime(2024, 1, 1), 'lastUserMessageAt': None, 'userLastSeenAt': None}]
+        mocker.patch.object(catch_up, 'fetch_open_chats', return_value=chats)
+
+        assert await catch_up.send_catch_up(websocket, 'p', None) == (None, False)
+        assert self.frames(websocket) == [{'type': 'chats', 'chats': [catch_up.serialize_chat(chats[0])]}]
+        messages.assert_not_called()
+
+    #  Tests that a catch-up slot is only held while querying and not while a frame is being sent
+    @pytest.mark.anyio
+    async def test_slot_released_while_sending(self, websocket, messages, mocker):
+        slots = mocker.patch.object(catch_up, 'catch_up_slots', asyncio.Semaphore(1))
+
+        def send_json(frame):
+            assert not slots.locked()
+
+        websocket.send_json.side_effect = send_json
+
+        assert await catch_up.send_missed_messages(websocket, 'p', after=0, limit=100) == (5, False)
+        assert websocket.send_json.call_count == 3
@@ -0,0 +1,199 @@
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import select, text
+from sqlalchemy.orm import Session
+
+from src.db.models.chat import Chat
+from src.db.queries import (archive_idle_chats, create_response_time_tracking, get_missed_messages, get_user_affinity,
+                            get_waiting_chats, unarchive_chat)
+
+
+def add_user(session, user_id: str) -> None:
+    session.execute(text('INSERT INTO "User" ("id") VALUES (:id)'), {'id': user_id})
+
+
+def add_archived_chat(session, user_id: str, personnel_id: str, ended_at: datetime, messages: list[str] = ()) -> int:
+    chat_id = session.execute(text("""
+        INSERT INTO "ArchivedChat" ("userId", "personnelId", "createdAt", "endedAt")
+        VALUES (:user_id, :personnel_id, :ended_at, :ended_at) RETURNING "id"
+    """), {'user_id': user_id, 'personnel_id': personnel_id, 'ended_at': ended_at}).scalar_one()
+    for message in messages:
+        session.execute(text("""
+            INSERT INTO "ArchivedMessage" ("chatId", "text", "createdAt", "isFromUser") VALUES (:chat_id, :text, :created_at, TRUE)
+        """), {'chat_id': chat_id, 'text': message, 'created_at': ended_at})
+    return chat_id
+
+
+def add_message(session, chat_id: int, message: str, created_at: datetime = None, is_from_user: bool = True) -> None:
+    session.execute(text("""
+        INSERT INTO "Message" ("chatId", "text", "createdAt", "isFromUser") VALUES (:chat_id, :text, :created_at, :is_from_user)
+    """), {'chat_id': chat_id, 'text': message, 'created_at': created_at or datetime.now(), 'is_from_user': is_from_user})
+
+
+def chat_history(session, chat_id: int) -> list[str]:
+    return session.execute(text('SELECT "text" FROM "ChatHistory" WHERE "chatId" = :chat_id ORDER BY "createdAt", "id"'),
+                           {'chat_id': chat_id}).scalars().all()
+
+
+class TestUnarchiveChat:
+    #  Tests that a chat can be reactivated, archived back into the same archived chat and reactivated again
+    def test_round_trip(self, db_session):
+        for user_id in ['personnel', 'telegram_1']:
+            add_user(db_session, user_id)
+        archived_chat_id = add_archived_chat(db_session, 'telegram_1', 'personnel', datetime(2024, 1, 1), ['first'])
+        db_session.commit()
+
+        chat_id = unarchive_chat(db_session, archived_chat_id)
+        assert chat_history(db_session, chat_id) == ['first']
+        add_message(db_session, chat_id, 'second', datetime(2024, 1, 2))
+        db_session.commit()
+
+        assert archive_idle_chats(db_session, 0, 10) == (1, 1)
+        assert db_session.execute(text('SELECT COUNT(*) FROM "ArchivedChat"')).scalar_one() == 1
+        assert get_user_affinity(db_session, 'telegram_1') == ('personnel', archived_chat_id)
+
+        chat_id = unarchive_chat(db_session, archived_chat_id)
+        assert chat_history(db_session, chat_id) == ['first', 'second']
+
+    #  Tests that nothing is reactivated if the user already has a chat or the archived chat is already reactivated
+    def test_conflict(self, db_session):
+        for user_id in ['personnel', 'telegram_1']:
+            add_user(db_session, user_id)
+        archived_chat_id = add_archived_chat(db_session, 'telegram_1', 'personnel', datetime(2024, 1, 1))
+        db_session.commit()
+
+        assert unarchive_chat(db_session, archived_chat_id) is not None
+        assert unarchive_chat(db_session, archived_chat_id) is None
+        assert unarchive_chat(db_session, archived_chat_id + 1) is None
+        assert db_session.execute(text('SELECT COUNT(*) FROM "Chat"')).scalar_one() == 1
+
+
+def add_chat(session, user_id: str, personnel_id: str | None, created_at: datetime) -> int:
+    return session.execute(text("""
+        INSERT INTO "Chat" ("userId", "personnelId", "createdAt") VALUES (:user_id, :personnel_id, :created_at) RETURNING "id"
+    """), {'user_id': user_id, 'personnel_id': personnel_id, 'created_at': created_at}).scalar_one()
+
+
+class TestArchiveIdleChats:
+    @pytest.fixture
+    def chats(self, db_session):
+        long_ago = datetime.now() - timedelta(days=2)
+        for user_id in ['personnel', 'telegram_1', 'telegram_2', 'telegram_3']:
+            add_user(db_session, user_id)
+        chat_ids = [add_chat(db_session, f'telegram_{n}', 'personnel', long_ago) for n in range(1, 4)]
+        add_message(db_session, chat_ids[0], 'idle', long_ago + timedelta(minutes=1))
+        add_message(db_session, chat_ids[1], 'active')
+        db_session.commit()
+        return chat_ids
+
+    #  Tests that only chats without recent messages are archived, together with their messages
+    def test_idle(self, db_session, chats):
+        assert archive_idle_chats(db_session, 24 * 60 * 60, 10) == (2, 1)
+        assert db_session.execute(text('SELECT "id" FROM "Chat"')).scalars().all() == [chats[1]]
+        assert db_session.execute(text('SELECT "text" FROM "ArchivedMessage"')).scalars().all() == ['idle']
+        assert db_session.execute(text('SELECT COUNT(*) FROM "Message"')).scalar_one() == 1
+
+    #  Tests that a batch is no larger than batch_size, the longest idle chats going first
+    def test_batch_size(self, db_session, chats):
+        assert archive_idle_chats(db_session, 24 * 60 * 60, 1) == (1, 0)
+        assert archive_idle_chats(db_session, 24 * 60 * 60, 1) == (1, 1)
+        assert archive_idle_chats(db_session, 24 * 60 * 60, 1) == (0, 0)
+
+    #  Tests that a chat the webhook path is storing a message in is skipped instead of being archived under it
+    def test_locked(self, db_session, db_engine, chats):
+        with Session(db_engine) as webhook_session:
+            webhook_session.execute(
+                select(Chat).where(Chat.id == chats[0]).with_for_update(key_share=True)
+            ).scalar_one()
+            assert archive_idle_chats(db_session, 24 * 60 * 60, 10) == (1, 0)
+
+            add_message(webhook_session, chats[0], 'new')
+            webhook_session.commit()
+        assert archive_idle_chats(db_session, 24 * 60 * 60, 10) == (0, 0)
+
+    #  Tests that a reactivated chat isn't archived again before it has been idle for long enough
+    def test_reactivated(self, db_session, chats):
+        archive_idle_chats(db_session, 24 * 60 * 60, 10)
+        archived_chat_id = db_session.execute(text('SELECT MIN("id") FROM "ArchivedChat"')).scalar_one()
+
+        assert unarchive_chat(db_session, archived_chat_id) is not None
+        assert archive_idle_chats(db_session, 24 * 60 * 60, 10) == (0, 0)
+
+    #  Tests that operator replies keep a chat active as well
+    def test_reply(self, db_session, chats):
+        add_message(db_session, chats[2], 'hi', is_from_user=False)
+        db_session.commit()
+        assert archive_idle_chats(db_session, 24 * 60 * 60, 10) == (1, 1)
+
+
+class TestTrackResponseTime:
+    @pytest.fixture
+    def chat_id(self, db_session):
+        for user_id in ['personnel', 'telegram_1']:
+            add_user(db_session, user_id)
+        chat_id = add_chat(db_session, 'telegram_1', 'personnel', datetime.now() - timedelta(hours=1))
+        started_at = datetime.now() - timedelta(minutes=30)
+        add_message(db_session, chat_id, 'hello', started_at)
+        add_message(db_session, chat_id, 'anybody?', started_at + timedelta(seconds=60))
+        add_message(db_session, chat_id, 'hi', started_at + timedelta(seconds=90), is_from_user=False)
+        add_message(db_session, chat_id, 'how can I help?', started_at + timedelta(seconds=100), is_from_user=False)
+        add_message(db_session, chat_id, 'thanks', started_at + timedelta(seconds=200))
+        db_session.commit()
+        return chat_id
+
+    def stats(self, session) -> tuple[int, float]:
+        return tuple(session.execute(text(
+            'SELECT "responseCount", "responseSeconds" FROM "PersonnelResponseStats" WHERE "personnelId" = \'personnel\''
+        )).one())
+
+    #  Tests that only the first reply is timed, from the latest user message, and the chat is left waiting after it
+    def test_trigger(self, db_session, chat_id):
+        assert self.stats(db_session) == (1, 30)
+        assert db_session.execute(text('SELECT "lastUserMessageAt" FROM "Chat"')).scalar_one() is not None
+
+    #  Tests that registration fills in stats of existing messages the way the trigger would have, only once
+    def test_backfill(self, db_session, chat_id):
+        db_session.execute(text('DELETE FROM "PersonnelResponseStats"'))
+        db_session.execute(text('UPDATE "Chat" SET "lastUserMessageAt" = NULL'))
+        db_session.execute(create_response_time_tracking)
+        db_session.execute(create_response_time_tracking)
+
+        assert self.stats(db_session) == (1, 30)
+        assert db_session.execute(text('SELECT "lastUserMessageAt" FROM "Chat"')).scalar_one() is not None
+        decayed = db_session.execute(text('SELECT "decayedResponseSeconds" / "decayedResponseCount" FROM "PersonnelResponseStats"')).scalar_one()
+        assert decayed == pytest.approx(30)
+
+
+class TestGetMissedMessages:
+    #  Tests that only messages of the operator's chats are paged through, in id order across chats
+    def test_pages(self, db_session):
+        for user_id in ['personnel', 'other', 'telegram_1', 'telegram_2', 'telegram_3']:
+            add_user(db_session, user_id)
+        first = add_chat(db_session, 'telegram_1', 'personnel', datetime(2024, 1, 1))
+        second = add_chat(db_session, 'telegram_2', 'personnel', datetime(2024, 1, 1))
+        others = add_chat(db_session, 'telegram_3', 'other', datetime(2024, 1, 1))
+        for chat_id, message in [(first, 'a'), (others, 'x'), (second, 'b'), (first, 'c'), (second, 'd')]:
+            add_message(db_session, chat_id, message)
+        db_session.commit()
+
+        page = get_missed_messages(db_session, 'personnel', 0, 3)
+        assert [message['text'] for message in page] == ['a', 'b', 'c']
+        page = get_missed_messages(db_session, 'personnel', page[-1]['id'], 3)
+        assert [message['text'] for message in page] == ['d']
+
+
+class TestGetWaitingChats:
+    #  Tests that waiting chats claimed by one drain are skipped by another until it ends
+    def test_claim(self, db_session, db_engine):
+        for user_id in ['personnel', 'telegram_1', 'telegram_2']:
+            add_user(db_session, user_id)
+        waiting = add_chat(db_session, 'telegram_1', None, datetime(2024, 1, 1))
+        add_chat(db_session, 'telegram_2', 'personnel', datetime(2024, 1, 1))
+        db_session.commit()
+
+        assert [chat['id'] for chat in get_waiting_chats(db_session)] == [waiting]
+        with Session(db_engine) as other_session:
+            assert get_waiting_chats(other_session) == []
+            db_session.rollback()
+            assert [chat['id'] for chat in get_waiting_chats(other_session)] == [waiting]
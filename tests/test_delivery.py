@@ -0,0 +1,76 @@
+import time
+
+from src.delivery import DeliveryTracker, delivery_seconds, observe_outbound, unacknowledged_messages
+
+
+class TestDeliveryTracker:
+    #  Tests that an ack observes the time since the platform timestamp
+    def test_ack(self):
+        tracker = DeliveryTracker(300)
+        before = delivery_seconds.count(direction='inbound', platform='viber', operator='op-ack')
+        tracker.expect(1, time.time() - 2, 'viber', 'op-ack')
+
+        elapsed = tracker.ack(1, 'op-ack')
+
+        assert 2 <= elapsed < 3
+        assert len(tracker) == 0
+        assert delivery_seconds.count(direction='inbound', platform='viber', operator='op-ack') == before + 1
+
+    #  Tests that acks of unknown messages or from another operator are ignored
+    def test_ack_mismatch(self):
+        tracker = DeliveryTracker(300)
+        tracker.expect(1, time.time(), 'viber', 'op-1')
+        assert tracker.ack(1, 'op-2') is None
+        assert tracker.ack(2, 'op-1') is None
+        assert len(tracker) == 1
+
+    #  Tests that messages that were never acknowledged are counted and forgotten
+    def test_expire(self, mocker):
+        tracker = DeliveryTracker(60)
+        before = unacknowledged_messages.value(direction='inbound', platform='telegram')
+        tracker.expect(1, time.time(), 'telegram', 'op-1')
+
+        mocker.patch('src.delivery.time.time', return_value=time.time() + 60)
+        tracker.expect(2, time.time(), 'telegram', 'op-1')
+
+        assert len(tracker) == 1
+        assert tracker.ack(1, 'op-1') is None
+        assert unacknowledged_messages.value(direction='inbound', platform='telegram') == before + 1
+
+    #  Tests that a message that arrives late is kept until ack_timeout after it has been pushed
+    #  and its slow ack is observed
+    def test_late_arrival(self, mocker):
+        tracker = DeliveryTracker(60)
+        before = delivery_seconds.count(direction='inbound', platform='telegram', operator='op-late')
+        tracker.expect(1, time.time() - 120, 'telegram', 'op-late')
+        tracker.expect(2, time.time(), 'telegram', 'op-late')
+        assert sorted(tracker._pending) == [1, 2]
+
+        assert tracker.ack(1, 'op-late') >= 120
+        assert delivery_seconds.count(direction='inbound', platform='telegram', operator='op-late') == before + 1
+
+        mocker.patch('src.delivery.time.time', return_value=time.time() + 60)
+        tracker.expect(3, time.time(), 'telegram', 'op-late')
+        assert sorted(tracker._pending) == [3]
+
+    #  Tests that acknowledged messages are never counted as unacknowledged later
+    def test_expire_acknowledged(self, mocker):
+        tracker = DeliveryTracker(60)
+        before = unacknowledged_messages.value(direction='inbound', platform='viber')
+        tracker.expect(1, time.time(), 'viber', 'op-1')
+        tracker.ack(1, 'op-1')
+
+        mocker.patch('src.delivery.time.time', return_value=time.time() + 60)
+        tracker.expect(2, time.time(), 'viber', 'op-1')
+
+        assert unacknowledged_messages.value(direction='inbound', platform='viber') == before
+        assert len(tracker._expiry) == 1
+
+
+class TestObserveOutbound:
+    #  Tests that failed platform sends are counted instead of observed
+    def test_failed(self):
+        before = unacknowledged_messages.value(direction='outbound', platform='facebook')
+        observe_outbound(time.time(), 'facebook', 'op-1', delivered=False)
+        assert unacknowledged_messages.value(direction='outbound', platform='facebook') == before + 1
+        assert delivery_seconds.count(direction='outbound', platform='facebook', operator='op-1') == 0
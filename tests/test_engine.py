@@ -0,0 +1,27 @@
+import src.db.engine as engine
+from src.db.engine import apply_registered_queries, registered_queries_hash
+from src.db.queries import register_queries
+
+
+class TestApplyRegisteredQueries:
+    #  Tests that registered queries are skipped when their hash is already recorded
+    def test_up_to_date(self, mocker):
+        connection = mocker.Mock()
+        connection.execute.return_value.scalar_one_or_none.return_value = registered_queries_hash
+        assert apply_registered_queries(connection) is False
+        executed = [call.args[0] for call in connection.execute.call_args_list]
+        assert not any(query in executed for query in register_queries)
+
+    #  Tests that registered queries are applied when their hash has changed
+    def test_outdated(self, mocker):
+        connection = mocker.Mock()
+        connection.execute.return_value.scalar_one_or_none.return_value = 'outdated'
+        assert apply_registered_queries(connection) is True
+        executed = [call.args[0] for call in connection.execute.call_args_list]
+        assert all(query in executed for query in register_queries)
+
+
+class TestImport:
+    #  Tests that importing the engine module doesn't create an engine
+    def test_no_engine_on_import(self):
+        assert engine.engine is None
@@ -0,0 +1,118 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+
+import pytest
+import requests
+
+from src.platforms.facebook.batch import BatchItem, FacebookBatchSender
+
+
+def graph_response(mocker, results, status_code=200):
+    return mocker.MagicMock(ok=status_code == 200, status_code=status_code, text='', json=lambda: results)
+
+
+def sent_batch(post) -> list[dict]:
+    return json.loads(post.call_args.kwargs['data']['batch'])
+
+
+class TestFacebookBatchSender:
+    @pytest.fixture
+    def sender(self):
+        return FacebookBatchSender('https://graph/v16.0/', 'page', 'token', linger=0.05, max_size=50, item_retries=1)
+
+    #  Tests that every message gets its own result and the batch is encoded the way Graph expects
+    def test_send_batch(self, sender, mocker):
+        post = mocker.patch('requests.post', return_value=graph_response(mocker, [
+            {'code': 200, 'body': '{"message_id": "m_1"}'},
+            {'code': 400, 'body': '{"error": {}}'},
+        ]))
+        batch = [BatchItem('1', 'first', 5), BatchItem('2', 'second', 5)]
+
+        sender.send_batch(batch)
+
+        assert batch[0].future.result().json() == {'message_id': 'm_1'}
+        assert not batch[1].future.result().ok
+        request = sent_batch(post)[0]
+        assert request['relative_url'] == 'page/messages'
+        assert json.loads(parse_qs(request['body'])['recipient'][0]) == {'id': '1'}
+        assert parse_qs(request['body'])['messaging_type'] == ['RESPONSE']
+
+    #  Tests that tagged messages, e.g. broadcasts, are sent as such
+    def test_tag(self):
+        body = parse_qs(BatchItem('1', 'news', 5, 'ACCOUNT_UPDATE').as_request('page')['body'])
+        assert (body['messaging_type'], body['tag']) == (['MESSAGE_TAG'], ['ACCOUNT_UPDATE'])
+
+    #  Tests that items that failed on their own are queued again until they run out of retries
+    def test_item_retry(self, sender, mocker):
+        mocker.patch('requests.post', return_value=graph_response(mocker, [None]))
+        item = BatchItem('1', 'text', 5)
+
+        sender.send_batch([item])
+        assert not item.future.done()
+        assert list(sender._backlog) == [item]
+
+        sender.send_batch([item])
+        assert item.future.result().status_code == 504
+
+    #  Tests that messages Graph returned no results for are retried rather than left waiting
+    def test_missing_results(self, sender, mocker):
+        mocker.patch('requests.post', return_value=graph_response(mocker, [{'code': 200, 'body': '{}'}]))
+        batch = [BatchItem('1', 'first', 5), BatchItem('2', 'second', 5)]
+        sender.send_batch(batch)
+        assert batch[0].future.result().ok
+        assert list(sender._backlog) == [batch[1]]
+
+    #  Tests that a batch holds one message per recipient and a retried message stays ahead of later ones
+    def test_one_per_recipient(self, sender, mocker):
+        first, second, other = BatchItem('1', 'first', 5), BatchItem('1', 'second', 5), BatchItem('2', 'other', 5)
+        sender._backlog.extend([first, second, other])
+        assert sender.take_batch() == [first, other]
+
+        mocker.patch('requests.post', return_value=graph_response(mocker, [None, {'code': 200, 'body': '{}'}]))
+        sender.send_batch([first, other])
+        assert list(sender._backlog) == [first, second]
+        assert sender.take_batch() == [first]
+
+    #  Tests that a message whose caller has timed out before it was sent is dropped and reported as never sent
+    def test_timeout(self, sender, mocker):
+        mocker.patch.object(sender, '_ensure_started')
+        with pytest.raises(requests.ConnectTimeout):
+            sender.send('1', 'text', 0)
+        sender._backlog.append(sender._queue.get_nowait())
+        assert sender.take_batch() == []
+
+    #  Tests that a message whose caller has timed out while it was in flight isn't retried
+    def test_timeout_in_flight(self, sender, mocker):
+        mocker.patch.object(sender, '_ensure_started')
+        mocker.patch.object(sender._queue, 'put', side_effect=lambda item: item.future.set_running_or_notify_cancel())
+        with pytest.raises(requests.Timeout) as e:
+            sender.send('1', 'text', 0)
+        assert not isinstance(e.value, requests.ConnectTimeout)
+
+        item = sender._queue.put.call_args.args[0]
+        mocker.patch('requests.post', return_value=graph_response(mocker, [None]))
+        sender.send_batch([item])
+        assert len(sender._backlog) == 0
+        assert item.future.result().status_code == 504
+
+    #  Tests that a failed batch request fails every message in it
+    def test_batch_failure(self, sender, mocker):
+        mocker.patch('requests.post', side_effect=requests.ConnectionError())
+        batch = [BatchItem('1', 'first', 5), BatchItem('2', 'second', 5)]
+        sender.send_batch(batch)
+        for item in batch:
+            with pytest.raises(requests.ConnectionError):
+                item.future.result()
+
+    #  Tests that messages sent at about the same time end up in one batch
+    def test_linger(self, sender, mocker):
+        post = mocker.patch('requests.post', side_effect=lambda url, data, timeout: graph_response(
+            mocker, [{'code': 200, 'body': '{}'}] * len(json.loads(data['batch']))
+        ))
+        with ThreadPoolExecutor(5) as executor:
+            responses = list(executor.map(lambda i: sender.send(str(i), 'text', 5), range(5)))
+
+        assert all(resp.ok for resp in responses)
+        assert post.call_count == 1
+        assert len(sent_batch(post)) == 5
@@ -0,0 +1,76 @@
+import pytest
+
+from src.flood import FloodProtection, TokenBucketLimiter, dropped_messages
+
+
+class TestTokenBucketLimiter:
+    #  Tests that a burst is allowed, the rest is dropped and tokens come back over time
+    def test_allow(self):
+        limiter = TokenBucketLimiter(rate=1, burst=2, max_keys=10)
+        assert limiter.allow('viber_1', now=0) == (True, 0)
+        assert limiter.allow('viber_1', now=0) == (True, 0)
+        assert limiter.allow('viber_1', now=0) == (False, 1)
+        assert limiter.allow('viber_1', now=0.5) == (False, 2)
+        assert limiter.allow('viber_1', now=1) == (True, 0)
+
+    #  Tests that users have separate buckets
+    def test_separate_keys(self):
+        limiter = TokenBucketLimiter(rate=1, burst=1, max_keys=10)
+        assert limiter.allow('viber_1', now=0)[0]
+        assert limiter.allow('viber_2', now=0)[0]
+
+    #  Tests that least recently used buckets are evicted
+    def test_eviction(self):
+        limiter = TokenBucketLimiter(rate=1, burst=1, max_keys=2)
+        limiter.allow('viber_1', now=0)
+        limiter.allow('viber_2', now=0)
+        limiter.allow('viber_3', now=0)
+        assert len(limiter) == 2
+        assert limiter.allow('viber_1', now=0)[0]
+
+
+class TestFloodProtection:
+    #  Tests that persistent offenders are suspended in one batch
+    def test_suspension(self, mocker):
+        session = mocker.MagicMock()
+        mocker.patch('src.flood.Session', return_value=session)
+        suspend_users = mocker.patch('src.flood.suspend_users', return_value=1)
+        protection = FloodProtection(TokenBucketLimiter(rate=0, burst=1, max_keys=10), suspend_after_drops=2)
+        before = dropped_messages.value(platform='telegram')
+
+        assert protection.allow('telegram_1', 'telegram')
+        assert not protection.allow('telegram_1', 'telegram')
+        assert not protection.allow('telegram_1', 'telegram')
+        assert not protection.allow('telegram_1', 'telegram')
+
+        assert dropped_messages.value(platform='telegram') == before + 3
+        assert protection.flush_suspensions() == 1
+        suspend_users.assert_called_once_with(session.__enter__.return_value, ['telegram_1'])
+        assert protection.flush_suspensions() == 0
+
+    #  Tests that suspensions are kept for the next flush if the db is unavailable
+    def test_suspension_failure(self, mocker):
+        mocker.patch('src.flood.Session')
+        mocker.patch('src.flood.suspend_users', side_effect=RuntimeError())
+        protection = FloodProtection(TokenBucketLimiter(rate=0, burst=0, max_keys=10), suspend_after_drops=1)
+        protection.allow('telegram_1', 'telegram')
+
+        with pytest.raises(RuntimeError):
+            protection.flush_suspensions()
+        assert protection._pending_suspensions == {'telegram_1'}
+
+    #  Tests that a throttled user is due one notice per run of dropped messages
+    def test_notice(self):
+        protection = FloodProtection(TokenBucketLimiter(rate=0, burst=1, max_keys=10), suspend_after_drops=0)
+        assert protection.allow('telegram_1', 'telegram')
+        assert not protection.take_notice('telegram_1')
+
+        assert not protection.allow('telegram_1', 'telegram')
+        assert not protection.allow('telegram_1', 'telegram')
+        assert protection.take_notice('telegram_1')
+        assert not protection.take_notice('telegram_1')
+
+        protection.limiter.forget('telegram_1')
+        assert protection.allow('telegram_1', 'telegram')
+        assert not protection.allow('telegram_1', 'telegram')
+        assert protection.take_notice('telegram_1')
@@ -0,0 +1,98 @@
+import json
+from datetime import datetime
+
+import pytest
+
+import src.history as history
+from src.db.queries import get_history_page, is_history_visible, unarchive_chat
+from tests.test_db_functions import add_archived_chat, add_chat, add_message, add_user
+
+
+def message_row(message_id: int, is_archived: bool = False) -> dict:
+    return {'id': message_id, 'chatId': 1, 'text': 'Привіт', 'createdAt': datetime(2024, 1, 1, 12, 0, message_id % 60),
+            'isFromUser': True, 'isArchived': is_archived}
+
+
+class TestCursor:
+    #  Tests that a cursor points at the message it has been made of
+    def test_round_trip(self):
+        message = message_row(7, is_archived=True)
+        assert history.decode_cursor(history.encode_cursor(message)) == (message['createdAt'], True, 7)
+
+    #  Tests that malformed cursors are rejected
+    @pytest.mark.parametrize('cursor', ['', 'not a cursor', 'MjAyNA=='])
+    def test_invalid(self, cursor):
+        with pytest.raises(ValueError):
+            history.decode_cursor(cursor)
+
+
+class TestStreamHistory:
+    #  Tests that history is read page by page and ends with a cursor of the last message
+    @pytest.mark.anyio
+    async def test_pages(self, mocker):
+        mocker.patch.object(history, 'history_page_size', 2)
+        rows = [message_row(message_id) for message_id in range(10, 0, -1)]
+        fetch = mocker.patch.object(history, 'fetch_history_page', side_effect=lambda chat_id, user_id, before, limit, archived_chat_id: [
+            row for row in rows if before is None or row['id'] < before[2]
+        ][:limit])
+
+        lines = [line for chunk in [chunk async for chunk in history.stream_history(1, None, None, 5)]
+                 for line in chunk.splitlines()]
+
+        assert [json.loads(line)['id'] for line in lines[:-1]] == [10, 9, 8, 7, 6]
+        assert history.decode_cursor(json.loads(lines[-1])['nextCursor'])[2] == 6
+        assert [call.args[3] for call in fetch.call_args_list] == [2, 2, 1]
+
+    #  Tests that the cursor is null once history runs out
+    @pytest.mark.anyio
+    async def test_end(self, mocker):
+        mocker.patch.object(history, 'fetch_history_page', return_value=[message_row(1)])
+        chunks = [chunk async for chunk in history.stream_history(None, 'viber_1', None, 100)]
+        assert json.loads(chunks[-1]) == {'nextCursor': None}
+
+
+class TestGetHistoryPage:
+    #  Tests that live messages created at the same time as an archived cursor have already been read
+    def test_archived_cursor(self, mocker):
+        session = mocker.MagicMock()
+        created_at = datetime(2024, 1, 1)
+        get_history_page(session, 1, None, (created_at, True, 5), 10)
+        params = session.execute.call_args.args[1]
+        assert (params['created_at'], params['live_id'], params['archived_id']) == (created_at, 0, 5)
+
+
+class TestArchivedChatHistory:
+    @pytest.fixture
+    def chats(self, db_session):
+        for user_id in ['personnel', 'other', 'telegram_1', 'telegram_2']:
+            add_user(db_session, user_id)
+        archived_chat_id = add_archived_chat(db_session, 'telegram_1', 'personnel', datetime(2024, 1, 1), ['archived'])
+        # Live and archived ids come from different sequences, so this one is the same as the archived chat's
+        live_chat_id = add_chat(db_session, 'telegram_2', 'other', datetime(2024, 1, 1))
+        add_message(db_session, live_chat_id, 'live')
+        db_session.commit()
+        assert archived_chat_id == live_chat_id
+        return archived_chat_id, live_chat_id
+
+    #  Tests that an archived chat is read by its own id, including its reactivation, and never mixed up with a live chat
+    def test_archived_chat(self, db_session, chats):
+        archived_chat_id, live_chat_id = chats
+        assert [row['text'] for row in get_history_page(db_session, None, None, None, 10, archived_chat_id)] == ['archived']
+        assert [row['text'] for row in get_history_page(db_session, live_chat_id, None, None, 10)] == ['live']
+
+        chat_id = unarchive_chat(db_session, archived_chat_id)
+        add_message(db_session, chat_id, 'reactivated', datetime(2024, 1, 2))
+        db_session.commit()
+        assert [row['text'] for row in get_history_page(db_session, None, None, None, 10, archived_chat_id)] == [
+            'reactivated', 'archived'
+        ]
+
+    #  Tests that operators only see history of chats they are or were assigned to
+    def test_visibility(self, db_session, chats):
+        archived_chat_id, live_chat_id = chats
+        assert is_history_visible(db_session, 'personnel', None, None, archived_chat_id)
+        assert is_history_visible(db_session, 'personnel', None, 'telegram_1', None)
+        assert not is_history_visible(db_session, 'personnel', live_chat_id, None, None)
+        assert not is_history_visible(db_session, 'personnel', None, 'telegram_2', None)
+        assert is_history_visible(db_session, 'other', live_chat_id, None, None)
+        assert not is_history_visible(db_session, 'other', None, None, archived_chat_id)
@@ -0,0 +1,66 @@
+import pytest
+
+from src.metrics import Counter, Gauge, Histogram, Registry, timed
+
+
+class TestCounter:
+    #  Tests that a counter sums increments per label set
+    def test_inc(self):
+        counter = Counter('requests_total', 'Requests', ['platform'])
+        counter.inc(platform='viber')
+        counter.inc(2, platform='viber')
+        counter.inc(platform='telegram')
+        assert counter.value(platform='viber') == 3
+        assert 'requests_total{platform="telegram"} 1' in counter.render()
+
+    #  Tests that wrong labels are rejected
+    def test_wrong_labels(self):
+        counter = Counter('requests_total', 'Requests', ['platform'])
+        with pytest.raises(ValueError):
+            counter.inc(stage='auth')
+
+
+class TestGauge:
+    #  Tests that a function-backed gauge is read at render time
+    def test_set_function(self):
+        values = [1]
+        gauge = Gauge('connected', 'Connected operators')
+        gauge.set_function(lambda: values[0])
+        values[0] = 5
+        assert 'connected 5' in gauge.render()
+
+
+class TestHistogram:
+    #  Tests that observations land in cumulative buckets
+    def test_observe(self):
+        histogram = Histogram('latency_seconds', 'Latency', buckets=(0.1, 1))
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+        histogram.observe(5)
+        rendered = histogram.render()
+        assert 'latency_seconds_bucket{le="0.1"} 1' in rendered
+        assert 'latency_seconds_bucket{le="1"} 2' in rendered
+        assert 'latency_seconds_bucket{le="+Inf"} 3' in rendered
+        assert 'latency_seconds_count 3' in rendered
+        assert histogram.count() == 3
+
+    #  Tests that a timed function is observed even if it raises
+    def test_timed(self):
+        histogram = Histogram('query_seconds', 'Queries', ['query'])
+
+        @timed(histogram, query='failing')
+        def failing():
+            raise RuntimeError()
+
+        with pytest.raises(RuntimeError):
+            failing()
+        assert histogram.count(query='failing') == 1
+
+
+class TestRegistry:
+    #  Tests that a metric name can only be registered once
+    def test_duplicate(self):
+        registry = Registry()
+        registry.register(Counter('requests_total', 'Requests'))
+        with pytest.raises(ValueError):
+            registry.register(Counter('requests_total', 'Requests'))
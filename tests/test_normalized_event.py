@@ -0,0 +1,55 @@
+import dataclasses
+import json
+import pickle
+
+import pytest
+
+from benchmarks.payloads import PayloadFactory
+from src.normalized_event import AttachmentRef, NormalizedEvent, decode_event
+from src.platforms import FacebookEvent, TelegramEvent, ViberEvent
+
+events = {'telegram': TelegramEvent, 'viber': ViberEvent, 'facebook': FacebookEvent}
+
+
+class TestDecodeEvent:
+    #  Tests that decoded events agree with the pydantic models of each platform
+    @pytest.mark.parametrize('platform', list(events))
+    def test_matches_event(self, platform):
+        payload = PayloadFactory(seed=1).create(platform, text='Привіт')
+        data = json.loads(payload.body)
+        event = events[platform].create(events[platform].is_json_valid(data))
+
+        normalized = decode_event(platform, data)
+
+        assert normalized.platform == event.platform_name
+        assert normalized.user_id == event.user_unique_id
+        assert normalized.text == event.text
+        assert normalized.timestamp == event.timestamp
+
+    #  Tests that bodies without a message are rejected
+    @pytest.mark.parametrize('platform', list(events))
+    def test_invalid(self, platform):
+        assert decode_event(platform, {'event': 'seen', 'entry': [{}]}) is None
+
+    #  Tests that Facebook attachments of unsupported types are skipped
+    def test_facebook_attachments(self):
+        data = {'entry': [{'messaging': [{
+            'sender': {'id': '1'},
+            'timestamp': 1000,
+            'message': {'mid': 'm', 'attachments': [
+                {'type': 'image', 'payload': {'url': 'https://cdn.example.com/a/photo.jpg?x=1'}},
+                {'type': 'fallback', 'payload': {'url': 'https://example.com'}},
+            ]},
+        }]}]}
+        normalized = decode_event('facebook', data)
+        assert normalized.attachments == (AttachmentRef('image', 'https://cdn.example.com/a/photo.jpg?x=1', 'photo', '.jpg'),)
+
+
+class TestNormalizedEvent:
+    #  Tests that events are immutable, slotted and survive pickling
+    def test_compact(self):
+        event = NormalizedEvent('viber', '1', 'viber_1', 'Привіт', '42', 1.5, (AttachmentRef('image', 'https://x'),))
+        assert not hasattr(event, '__dict__')
+        with pytest.raises(dataclasses.FrozenInstanceError):
+            event.text = ''
+        assert pickle.loads(pickle.dumps(event)) == event
@@ -0,0 +1,90 @@
+from datetime import date
+
+import pytest
+from sqlalchemy import text
+
+import src.db.partitions as partitions
+from src.db.partitions import (PartitioningError, add_months, convert_tables, drop_expired_partitions, is_partitioned,
+                               maintain_partitions)
+
+
+def partitions_of(session, table: str) -> list[str]:
+    return sorted(row.name for row in session.execute(partitions.table_partitions_query, {'table': table}))
+
+
+class TestAddMonths:
+    #  Tests that months roll over into the next and the previous year
+    @pytest.mark.parametrize('month, months, expected', [
+        (date(2024, 11, 1), 2, date(2025, 1, 1)),
+        (date(2024, 1, 1), -1, date(2023, 12, 1)),
+        (date(2024, 5, 1), 0, date(2024, 5, 1)),
+    ])
+    def test_add_months(self, month, months, expected):
+        assert add_months(month, months) == expected
+
+
+class TestConvertTables:
+    #  Tests that existing rows stay in a legacy partition, future months get partitions and triggers keep working
+    def test_convert(self, db_session, mocker):
+        mocker.patch.object(partitions, 'partitions_ahead_months', 1)
+        db_session.execute(text('INSERT INTO "User" ("id") VALUES (\'personnel\'), (\'telegram_1\')'))
+        chat_id = db_session.execute(text(
+            'INSERT INTO "Chat" ("userId", "personnelId") VALUES (\'telegram_1\', \'personnel\') RETURNING "id"'
+        )).scalar_one()
+        db_session.execute(text('INSERT INTO "Message" ("chatId", "text", "isFromUser") VALUES (:chat_id, \'old\', TRUE)'),
+                           {'chat_id': chat_id})
+        db_session.commit()
+
+        assert convert_tables(db_session) == ['Message', 'ArchivedMessage']
+
+        month = date.today().replace(day=1)
+        assert partitions_of(db_session, 'Message') == sorted([
+            'Message_default', 'Message_legacy', partitions.partition_name('Message', add_months(month, 1))
+        ])
+        db_session.execute(text('INSERT INTO "Message" ("chatId", "text", "isFromUser") VALUES (:chat_id, \'new\', TRUE)'),
+                           {'chat_id': chat_id})
+        assert db_session.execute(text('SELECT "text" FROM "Message" ORDER BY "id"')).scalars().all() == ['old', 'new']
+        assert db_session.execute(text('SELECT "lastUserMessageAt" FROM "Chat"')).scalar_one() is not None
+        assert convert_tables(db_session) == []
+
+    #  Tests that a unique index that can't be kept stops the conversion before anything has changed
+    def test_unique_index(self, db_session):
+        db_session.execute(text('CREATE UNIQUE INDEX "Message_text_key" ON "Message"("text")'))
+        db_session.commit()
+
+        with pytest.raises(PartitioningError):
+            convert_tables(db_session)
+        db_session.rollback()
+        assert not is_partitioned(db_session, 'Message')
+
+
+class TestMaintainPartitions:
+    #  Tests that maintenance never converts tables, which is left to the offline migration
+    def test_not_converted(self, db_session):
+        maintain_partitions(db_session)
+        assert not is_partitioned(db_session, 'Message')
+        assert partitions_of(db_session, 'Message') == []
+
+    #  Tests that partitions are created ahead of time
+    def test_maintain(self, db_session, mocker):
+        convert_tables(db_session)
+        mocker.patch.object(partitions, 'partitions_ahead_months', 2)
+
+        maintain_partitions(db_session)
+
+        month = date.today().replace(day=1)
+        assert partitions.partition_name('Message', add_months(month, 2)) in partitions_of(db_session, 'Message')
+
+    #  Tests that only partitions that end before the retention period are dropped
+    def test_drop_expired(self, db_session):
+        month = date.today().replace(day=1)
+        db_session.execute(text('CREATE TABLE "Sample" ("createdAt" TIMESTAMP(3)) PARTITION BY RANGE ("createdAt")'))
+        for months_ago in [3, 2, 1]:
+            start = add_months(month, -months_ago)
+            db_session.execute(text(f"""
+                CREATE TABLE "{partitions.partition_name('Sample', start)}" PARTITION OF "Sample"
+                FOR VALUES FROM ('{start}') TO ('{add_months(start, 1)}')
+            """))
+
+        assert drop_expired_partitions(db_session, 'Sample', 2) == [partitions.partition_name('Sample', add_months(month, -3))]
+        assert len(partitions_of(db_session, 'Sample')) == 2
@@ -0,0 +1,86 @@
+import json
+from datetime import datetime
+
+import pytest
+from starlette.datastructures import Headers
+
+from src.prefilter import (ReadReceipts, classify_event, detect_platform, handle_non_message_event, is_authentic,
+                           read_receipts)
+from src.tracing import start_trace
+
+
+class TestDetectPlatform:
+    #  Tests that the platform is told by its signature header
+    @pytest.mark.parametrize('header, platform', [
+        ('X-Viber-Content-Signature', 'viber'),
+        ('X-Telegram-Bot-Api-Secret-Token', 'telegram'),
+        ('X-Hub-Signature-256', 'facebook'),
+        ('Content-Type', None),
+    ])
+    def test_detect_platform(self, header, platform):
+        assert detect_platform(Headers({header: 'abc'})) == platform
+
+
+class TestClassifyEvent:
+    #  Tests that messages are told from receipts and other events
+    @pytest.mark.parametrize('platform, body, kind', [
+        ('viber', {'event': 'seen', 'timestamp': 1}, 'seen'),
+        ('viber', {'event': 'conversation_started'}, 'conversation_started'),
+        ('viber', {'event': 'message'}, 'message'),
+        ('telegram', {'update_id': 1, 'edited_message': {}}, 'other'),
+        ('telegram', {'update_id': 1, 'message': {}}, 'message'),
+        ('facebook', {'object': 'page', 'entry': [{'messaging': [{'delivery': {}}]}]}, 'delivery'),
+        ('facebook', {'object': 'page', 'entry': [{'messaging': [{'read': {}}]}]}, 'read'),
+        ('facebook', {'object': 'page', 'entry': [{'messaging': [{'message': {}}]}]}, 'message'),
+        ('viber', [], 'unknown'),
+        (None, {'event': 'message'}, 'unknown'),
+    ])
+    def test_classify_event(self, platform, body, kind):
+        assert classify_event(platform, json.dumps(body).encode())[0] == kind
+
+
+class TestIsAuthentic:
+    #  Tests that authentication is recorded as its own span of the webhook trace
+    @pytest.mark.anyio
+    async def test_span(self, mocker):
+        mocker.patch('src.prefilter.TelegramEvent.is_request_authentic', return_value=True)
+        with start_trace('webhook') as trace:
+            assert await is_authentic(None, 'telegram')
+        assert [s['name'] for s in trace.spans] == ['authenticate']
+
+
+class TestReadReceipts:
+    #  Tests that only the latest receipt per user is flushed, in one statement
+    def test_flush(self, mocker):
+        session = mocker.MagicMock()
+        mocker.patch('src.prefilter.Session', return_value=session)
+        mark_chats_seen = mocker.patch('src.prefilter.mark_chats_seen', return_value=1)
+        receipts = ReadReceipts()
+        receipts.record('viber_1', 20)
+        receipts.record('viber_1', 10)
+
+        assert receipts.flush() == 1
+        mark_chats_seen.assert_called_once_with(session.__enter__.return_value, {'viber_1': datetime(1970, 1, 1, 0, 0, 20)})
+        assert len(receipts) == 0
+
+    #  Tests that receipts are kept for the next flush if the db is unavailable
+    def test_flush_failure(self, mocker):
+        mocker.patch('src.prefilter.Session')
+        mocker.patch('src.prefilter.mark_chats_seen', side_effect=RuntimeError())
+        receipts = ReadReceipts()
+        receipts.record('viber_1', 20)
+
+        with pytest.raises(RuntimeError):
+            receipts.flush()
+        assert len(receipts) == 1
+
+
+class TestHandleNonMessageEvent:
+    #  Tests that authentic Viber seen events are recorded and forged ones are not
+    @pytest.mark.anyio
+    @pytest.mark.parametrize('authentic, recorded', [(True, 1), (False, 0)])
+    async def test_viber_seen(self, mocker, authentic, recorded):
+        mocker.patch('src.prefilter.ViberEvent.is_request_authentic', return_value=authentic)
+        record = mocker.patch.object(read_receipts, 'record')
+        await handle_non_message_event(None, 'viber', 'seen', {'event': 'seen', 'user_id': 'abc', 'timestamp': 1000})
+        assert record.call_count == recorded
@@ -0,0 +1,50 @@
+import pytest
+
+from src.presence import Presence, operator_max_busyness, parse_busyness
+
+
+class TestPresence:
+    #  Tests that only operators who have sent heartbeats and then stopped are considered stale
+    def test_alive(self):
+        presence = Presence(timeout=10)
+        presence.beat('a', now=0)
+        presence.beat('b', now=5)
+
+        assert presence.alive(['a', 'b', 'legacy'], now=12) == ['b', 'legacy']
+        presence.forget('a')
+        assert not presence.is_stale('a', now=100)
+
+    #  Tests that heartbeats are written in one batch with the latest reported busyness
+    def test_flush(self, mocker):
+        session = mocker.MagicMock()
+        mocker.patch('src.presence.Session', return_value=session)
+        record_presence = mocker.patch('src.presence.record_presence', return_value=2)
+        presence = Presence(timeout=10)
+        presence.beat('a', busyness=3)
+        presence.beat('a')
+        presence.beat('b')
+
+        assert presence.flush() == 2
+        heartbeats = record_presence.call_args.args[1]
+        assert {personnel_id: busyness for personnel_id, (_, busyness) in heartbeats.items()} == {'a': 3, 'b': None}
+        assert presence.flush() == 0
+
+    #  Tests that heartbeats are kept for the next flush if the db is unavailable
+    def test_flush_failure(self, mocker):
+        mocker.patch('src.presence.Session')
+        mocker.patch('src.presence.record_presence', side_effect=RuntimeError())
+        presence = Presence(timeout=10)
+        presence.beat('a', busyness=1)
+
+        with pytest.raises(RuntimeError):
+            presence.flush()
+        assert presence._pending['a'][1] == 1
+
+
+class TestParseBusyness:
+    #  Tests that reported busyness is clamped to its range and anything but an integer is ignored
+    @pytest.mark.parametrize('value, busyness', [
+        (3, 3), (-5, 0), (10 ** 9, operator_max_busyness), (True, None), (False, None), (1.5, None), ('3', None), (None, None),
+    ])
+    def test_parse(self, value, busyness):
+        assert parse_busyness(value) == busyness
@@ -0,0 +1,46 @@
+import pytest
+from sqlalchemy.exc import OperationalError
+
+import src.db.routing as routing
+from src.db.routing import read_only, mark_written
+
+
+@read_only
+def which_session(session):
+    return session.name
+
+
+@pytest.fixture
+def primary(mocker):
+    session = mocker.Mock(info={})
+    session.name = 'primary'
+    return session
+
+
+@pytest.fixture
+def replica(mocker):
+    session = mocker.MagicMock()
+    session.__enter__.return_value.name = 'replica'
+    mocker.patch.object(routing, 'replica_enabled', True)
+    mocker.patch.object(routing, 'ReplicaSession', return_value=session)
+    return session
+
+
+class TestReadOnly:
+    #  Tests that reads go to the primary when no replica is configured
+    def test_no_replica(self, primary):
+        assert which_session(primary) == 'primary'
+
+    #  Tests that reads go to the replica when one is configured
+    def test_replica(self, primary, replica):
+        assert which_session(primary) == 'replica'
+
+    #  Tests that a session that has written keeps reading from the primary
+    def test_read_your_writes(self, primary, replica):
+        mark_written(primary)
+        assert which_session(primary) == 'primary'
+
+    #  Tests that an unreachable replica falls back to the primary
+    def test_fallback(self, primary, replica):
+        replica.__enter__.side_effect = OperationalError('SELECT 1', {}, Exception('down'))
+        assert which_session(primary) == 'primary'
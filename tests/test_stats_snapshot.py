@@ -0,0 +1,55 @@
+import time
+
+from src.stats_snapshot import PersonnelStatsSnapshot
+
+
+def fresh_snapshot(*personnel_ids):
+    snapshot = PersonnelStatsSnapshot()
+    snapshot.rows = tuple({'personnelid': personnel_id, 'normalizedscore': i} for i, personnel_id in enumerate(personnel_ids))
+    snapshot.refreshed_at = time.monotonic()
+    return snapshot
+
+
+class TestLeastBusyPersonnelId:
+    #  Tests that the least busy available personnel is picked from the snapshot
+    def test_available_filter(self, mocker):
+        snapshot = fresh_snapshot('a', 'b', 'c')
+        assert snapshot.least_busy_personnel_id(mocker.Mock(), ['c', 'b']) == 'b'
+
+    #  Tests that available personnel without stats go first
+    def test_unmentioned_first(self, mocker):
+        snapshot = fresh_snapshot('a', 'b')
+        assert snapshot.least_busy_personnel_id(mocker.Mock(), ['b', 'new']) == 'new'
+
+    #  Tests that nobody is picked when nobody is available
+    def test_nobody_available(self, mocker):
+        assert fresh_snapshot('a').least_busy_personnel_id(mocker.Mock(), []) is None
+
+    #  Tests that a snapshot that has never been refreshed falls back to the db
+    def test_stale_fallback(self, mocker):
+        fallback = mocker.patch('src.stats_snapshot.get_least_busy_personnel_id', return_value='db')
+        session = mocker.Mock()
+        assert PersonnelStatsSnapshot().least_busy_personnel_id(session, ['a']) == 'db'
+        fallback.assert_called_once_with(session, ['a'])
+
+    #  Tests that a burst of new chats is spread over personnel instead of going to the same one until a refresh
+    def test_burst(self, mocker):
+        snapshot = fresh_snapshot('a', 'b')
+        snapshot.rows = ({'personnelid': 'a', 'normalizedscore': 1.0, 'totalchats': 2},
+                         {'personnelid': 'b', 'normalizedscore': 1.25, 'totalchats': 2})
+        picked = [snapshot.least_busy_personnel_id(mocker.Mock(), ['a', 'b']) for _ in range(4)]
+        assert picked == ['a', 'b', 'a', 'b']
+
+    #  Tests that chats assigned before a refresh are no longer counted on top of it, while later ones still are
+    def test_refresh_resets_assignments(self, mocker):
+        snapshot = fresh_snapshot('a', 'b')
+        snapshot.least_busy_personnel_id(mocker.Mock(), ['a'])
+
+        def get_personnel_stats(session):
+            snapshot.least_busy_personnel_id(mocker.Mock(), ['b'])
+            return [{'personnelid': 'a', 'normalizedscore': 0}]
+
+        mocker.patch('src.stats_snapshot.DBSession')
+        mocker.patch('src.stats_snapshot.get_personnel_stats', side_effect=get_personnel_stats)
+        snapshot.refresh()
+        assert snapshot._assigned == {'b': 1}
@@ -0,0 +1,108 @@
+import asyncio
+
+import aiohttp
+import pytest
+
+from benchmarks import standins
+from src.platforms.telegram.polling import TelegramPoller
+
+
+def telegram_update(chat_id: int, text: str) -> dict:
+    return {'message': {'message_id': 1, 'chat': {'id': chat_id, 'type': 'private'}, 'date': 0, 'text': text}}
+
+
+class TestTelegramPoller:
+    @pytest.fixture
+    async def standin(self):
+        state = standins.StandInState()
+        runner = await standins.start(state, port=0)
+        host, port = runner.addresses[0]
+        yield state, f'http://{host}:{port}'
+        await runner.cleanup()
+
+    #  Tests that a batch is handled in order per chat and the offset moves past it on the next call
+    @pytest.mark.anyio
+    async def test_poll(self, standin):
+        state, url = standin
+        for chat_id, text in [(1, 'first'), (2, 'other'), (1, 'second')]:
+            state.push_update(telegram_update(chat_id, text))
+        handled = []
+
+        async def handle(update):
+            handled.append(update['message']['text'])
+
+        poller = TelegramPoller(url, 'token', limit=100, timeout=0, retry_seconds=0, handle=handle)
+        async with aiohttp.ClientSession() as session:
+            assert await poller.poll_once(session)
+            assert poller.offset == 4
+            assert await poller.poll_once(session)
+
+        assert sorted(handled) == ['first', 'other', 'second']
+        assert handled.index('first') < handled.index('second')
+        assert state.update_offsets == [4]
+        assert state.updates == []
+
+    #  Tests that a failed update and the rest of its chat are polled again, while other chats go on
+    #  and aren't handled twice
+    @pytest.mark.anyio
+    async def test_failure(self, standin):
+        state, url = standin
+        for chat_id, text in [(1, 'fails'), (2, 'other'), (1, 'after')]:
+            state.push_update(telegram_update(chat_id, text))
+        handled = []
+
+        async def handle(update):
+            if update['message']['text'] == 'fails' and 'other' not in handled:
+                raise RuntimeError('db is down')
+            handled.append(update['message']['text'])
+
+        poller = TelegramPoller(url, 'token', limit=100, timeout=0, retry_seconds=0, handle=handle)
+        async with aiohttp.ClientSession() as session:
+            assert not await poller.poll_once(session)
+            assert poller.offset == 1
+            assert handled == ['other']
+
+            assert await poller.poll_once(session)
+            await poller.commit(session)
+
+        assert handled == ['other', 'fails', 'after']
+        assert state.update_offsets == [1, 4]
+        assert state.updates == []
+
+    #  Tests that an update that keeps failing is given up on and the rest of its chat goes on
+    @pytest.mark.anyio
+    async def test_dead_letter(self):
+        updates = [dict(telegram_update(chat_id, text), update_id=update_id)
+                   for update_id, chat_id, text in [(1, 1, 'poison'), (2, 2, 'other'), (3, 1, 'after')]]
+        handled = []
+
+        async def handle(update):
+            if update['message']['text'] == 'poison':
+                raise ValueError('malformed')
+            handled.append(update['message']['text'])
+
+        poller = TelegramPoller('http://telegram', 'token', limit=100, timeout=0, retry_seconds=0, handle=handle,
+                                max_attempts=2)
+        assert await poller.handle_batch(updates) == 1
+        assert await poller.handle_batch(updates) == 4
+        assert handled == ['other', 'after']
+        assert poller._handled == set() and poller._failures == {}
+
+    #  Tests that polling starts once deleting the webhook succeeds instead of dying on the first error
+    @pytest.mark.anyio
+    async def test_delete_webhook_retry(self, mocker):
+        calls = []
+
+        async def call(session, method, params, timeout=10):
+            calls.append(method)
+            if calls == ['deleteWebhook']:
+                raise aiohttp.ClientError('unreachable')
+            if method == 'getUpdates':
+                raise asyncio.CancelledError()
+            return True
+
+        poller = TelegramPoller('http://telegram', 'token', limit=100, timeout=0, retry_seconds=0, handle=None)
+        mocker.patch.object(poller, 'call', side_effect=call)
+        with pytest.raises(asyncio.CancelledError):
+            await poller.run()
+        assert calls == ['deleteWebhook', 'deleteWebhook', 'getUpdates']
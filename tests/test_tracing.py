@@ -0,0 +1,67 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from src.profiler import ProfilerBusyError, SamplingProfiler
+from src.tracing import find_traces, get_trace_id, span, start_trace, traced
+
+
+class TestTracing:
+    #  Tests that spans of sync, async and threaded calls end up in the same trace
+    @pytest.mark.anyio
+    async def test_spans(self):
+        @traced('sync_step')
+        def sync_step():
+            return get_trace_id()
+
+        @traced('async_step')
+        async def async_step():
+            return await asyncio.to_thread(sync_step)
+
+        with start_trace('webhook', 'abc') as trace:
+            assert await async_step() == 'abc'
+
+        assert [s['name'] for s in trace.spans] == ['sync_step', 'async_step']
+        assert find_traces('abc')[0]['name'] == 'webhook'
+
+    #  Tests that a failed span records the exception type
+    def test_span_error(self):
+        with start_trace('webhook') as trace:
+            with pytest.raises(KeyError):
+                with span('lookup'):
+                    raise KeyError()
+        assert trace.spans[0]['error'] == 'KeyError'
+
+    #  Tests that spans are ignored outside of a trace
+    def test_no_trace(self):
+        with span('lookup'):
+            assert get_trace_id() is None
+
+
+class TestSamplingProfiler:
+    #  Tests that stacks of other threads are sampled in the collapsed format
+    def test_profile(self):
+        stop = threading.Event()
+
+        def busy_worker():
+            while not stop.is_set():
+                time.sleep(0.001)
+
+        worker = threading.Thread(target=busy_worker)
+        worker.start()
+        try:
+            stacks = SamplingProfiler(0.001).profile(0.05)
+        finally:
+            stop.set()
+            worker.join()
+        assert 'busy_worker' in stacks
+        assert stacks.splitlines()[0].rsplit(' ', 1)[1].isdigit()
+
+    #  Tests that only one profile can be taken at a time
+    def test_busy(self):
+        profiler = SamplingProfiler(0.001)
+        profiler._lock.acquire()
+        with pytest.raises(ProfilerBusyError):
+            profiler.profile(0.01)
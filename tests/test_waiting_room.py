@@ -0,0 +1,88 @@
+import heapq
+from datetime import datetime
+
+import pytest
+
+import src.waiting_room as waiting_room_module
+from src.waiting_room import WaitingChat, WaitingRoom, plan_assignments
+
+
+def waiting_chat(chat_id: int, waiting_since: float, affinity_personnel_id: str = None) -> WaitingChat:
+    return WaitingChat(waiting_since, chat_id, f'viber_{chat_id}', waiting_since, affinity_personnel_id)
+
+
+def waiting_row(chat_id: int, affinity_personnel_id: str = None) -> dict:
+    return {'id': chat_id, 'userId': f'viber_{chat_id}', 'createdAt': datetime.fromtimestamp(chat_id),
+            'affinityPersonnelId': affinity_personnel_id}
+
+
+def assigned_chat(chat_id: int, personnel_id: str) -> dict:
+    return {'id': chat_id, 'userId': f'viber_{chat_id}', 'personnelId': personnel_id}
+
+
+class TestPlanAssignments:
+    #  Tests that the longest waiting chats go first, each to the least loaded operator with room for it
+    def test_capacity(self):
+        queue = [waiting_chat(chat_id, chat_id) for chat_id in range(1, 6)]
+        heapq.heapify(queue)
+
+        assignments, rest = plan_assignments(queue, {'a': 1, 'b': 0}, capacity=2)
+
+        assert [(chat.chat_id, personnel_id) for chat, personnel_id in assignments] == [(1, 'b'), (2, 'a'), (3, 'b')]
+        assert sorted(chat.chat_id for chat in rest) == [4, 5]
+
+    #  Tests that returning users go to the operator they have last talked to if they have room
+    def test_affinity(self):
+        queue = [waiting_chat(1, 1, 'a'), waiting_chat(2, 2, 'a'), waiting_chat(3, 3, 'offline')]
+        heapq.heapify(queue)
+
+        assignments, rest = plan_assignments(queue, {'a': 0, 'b': 5}, capacity=1)
+
+        assert [(chat.chat_id, personnel_id) for chat, personnel_id in assignments] == [(1, 'a')]
+        assert len(rest) == 2
+
+    #  Tests that a capacity of 0 means no limit
+    def test_unlimited(self):
+        queue = [waiting_chat(chat_id, chat_id) for chat_id in range(1, 4)]
+        assignments, rest = plan_assignments(queue, {'a': 100}, capacity=0)
+        assert len(assignments) == 3 and not rest
+
+
+class TestWaitingRoom:
+    @pytest.fixture
+    def room(self, mocker):
+        mocker.patch.object(waiting_room_module, 'Session')
+        mocker.patch.object(waiting_room_module, 'get_waiting_chats', return_value=[waiting_row(1), waiting_row(2)])
+        mocker.patch.object(waiting_room_module, 'get_open_chat_counts', return_value={})
+        room = WaitingRoom(capacity=10, affinity_bonus=100, announce=mocker.AsyncMock())
+        return room
+
+    #  Tests that returning users are moved ahead and chats are only queued once
+    def test_add(self, room):
+        room.add(1, 'viber_1', waiting_since=50)
+        room.add(2, 'viber_2', waiting_since=100, affinity_personnel_id='a')
+        room.add(1, 'viber_1', waiting_since=50)
+        assert len(room) == 2
+        assert room._queue[0].chat_id == 2
+
+    #  Tests that every drain works on the chats waiting in the db, including ones other workers have queued,
+    #  and that assigned chats are announced while chats taken in the meantime are dropped
+    @pytest.mark.anyio
+    async def test_drain(self, room, mocker):
+        assign = mocker.patch.object(waiting_room_module, 'assign_chats', return_value=[assigned_chat(1, 'a')])
+        room.add(3, 'viber_3', waiting_since=3)
+
+        assert await room.drain(['a']) == 1
+
+        assert assign.call_args.args[1] == {1: 'a', 2: 'a'}
+        assert len(room) == 0 and 3 not in room
+        room.announce.assert_awaited_once()
+        assert room.announce.call_args.args[1].chat_id == 1
+
+    #  Tests that waiting chats are only queued while nobody is online
+    @pytest.mark.anyio
+    async def test_drain_offline(self, room, mocker):
+        assign = mocker.patch.object(waiting_room_module, 'assign_chats')
+        assert await room.drain([]) == 0
+        assert not assign.called
+        assert 1 in room and 2 in room